@@ -16,8 +16,10 @@ for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
         sys.path.insert(0, path)
 
 from state_manager import StateManager
-from utils.visual_center import compute_visual_center
+from utils.pet_cutout import PetCutout
 from run_pet_layout_adjustment import adjust_pet_layout
+from utils.template_registry import get_template_descriptor
+from utils.pet_transform import compute_centered_transform
 
 
 def align_pets_to_same_horizontal(session_id: str) -> str:
@@ -41,9 +43,7 @@ def align_pets_to_same_horizontal(session_id: str) -> str:
     
     # 加载宠物图像和模板
     extracted_dir = os.path.join("sessions", session_id, "extracted")
-    template = Image.open(state.template)
-    template_size = template.size
-    template.close()
+    template_size = get_template_descriptor(state.template).size
     
     # 先运行一次合成以获取实际的布局参数（包括视觉面积归一化后的scale）
     from run_multi_pet_composition import run_multi_pet_composition
@@ -57,7 +57,7 @@ def align_pets_to_same_horizontal(session_id: str) -> str:
         if not os.path.exists(pet_image_path):
             raise FileNotFoundError(f"找不到宠物 {pet_id} 的抠图结果: {pet_image_path}")
         pet_image = Image.open(pet_image_path).convert('RGBA')
-        pet_images.append(pet_image)
+        pet_images.append(PetCutout.from_image(pet_image))
     
     # 获取实际布局（包括增强功能应用后的）
     pet_sizes = [(img.width, img.height) for img in pet_images]
@@ -79,20 +79,16 @@ def align_pets_to_same_horizontal(session_id: str) -> str:
     
     for i, (pet_image, layout) in enumerate(zip(pet_images, layouts)):
         pet = state.pets[i]
-        # 使用实际的scale缩放图像
-        scaled_width = int(pet_image.width * layout.scale)
-        scaled_height = int(pet_image.height * layout.scale)
-        scaled_pet = pet_image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS)
-        
-        # 计算缩放后的视觉中心（相对于缩放后图像）
-        cx_local, cy_local = compute_visual_center(scaled_pet)
+        # 视觉中心在裁剪区域上计算（原帧坐标），按实际 scale 做坐标变换（不重采样图像）
+        local_center = pet_image.visual_center()
         
         # 转换为模板坐标系（使用state中的anchor，因为这是当前实际的位置）
         anchor_x_px = pet.anchor[0] * template_size[0]
         anchor_y_px = pet.anchor[1] * template_size[1]
         
         # 视觉中心在模板中的Y坐标
-        pet_center_y = anchor_y_px - (scaled_height / 2 - cy_local)
+        transform = compute_centered_transform(pet_image.size, layout.scale, (anchor_x_px, anchor_y_px))
+        pet_center_y = transform.map_point(local_center)[1]
         
         pet_visual_centers_y.append(pet_center_y)
         
@@ -109,13 +105,9 @@ def align_pets_to_same_horizontal(session_id: str) -> str:
     
     for i, (pet_image, layout) in enumerate(zip(pet_images, layouts)):
         pet = state.pets[i]
-        # 使用实际的scale缩放图像
-        scaled_width = int(pet_image.width * layout.scale)
-        scaled_height = int(pet_image.height * layout.scale)
-        scaled_pet = pet_image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS)
-        
-        # 计算缩放后的视觉中心
-        cx_local, cy_local = compute_visual_center(scaled_pet)
+        # 缩放后的视觉中心（坐标变换，不重采样图像）
+        scaled_height = pet_image.height * layout.scale
+        cy_local = pet_image.visual_center()[1] * layout.scale
         
         # 计算需要的anchor Y坐标，使视觉中心对齐到目标水平线
         # target_y = anchor_y_px - (scaled_height / 2 - cy_local)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+多宠物抠图压测：N 个会话同时运行 run_multi_pet_matting（各自一个进程，与线上多会话并行一致），
+远程调用打到本地模拟服务器（mock_replicate_server），用来调并发上限而不产生 Replicate 费用。
+- 每个会话的宠物图按会话与序号生成，内容各不相同（不命中上传复用与结果缓存）；也可用 --images 指定
+- 子进程关闭结果缓存（REMOTE_RESULT_CACHE_MAX_BYTES=0），上传登记表按会话分开，远程预测按 --priority 排队（默认 batch）
+- 给出 --rate 时各会话共用一个跨进程令牌桶（REMOTE_SCHEDULER_STATE 指向工作目录中的桶文件）
+- 报告：会话耗时分位、宠物吞吐、模拟服务器的请求 / 注入错误 / 同时进行的预测数峰值
+用法:
+    python load_test_matting.py --sessions 8 --pets 2 [--workers 4] [--in-memory] [--nano-latency 8,0.5] [--rate 5]
+    python load_test_matting.py --sessions 8 --base-url http://127.0.0.1:8787   # 使用已启动的模拟服务器
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+# 统一使用 UTF-8，避免中文路径与打印乱码
+if hasattr(sys.stdout, "reconfigure"):
+    sys.stdout.reconfigure(encoding="utf-8")
+    sys.stderr.reconfigure(encoding="utf-8")
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from PIL import Image, ImageDraw
+
+from metrics_utils import percentile
+from mock_replicate_server import MockConfig, MockReplicateServer, add_config_arguments, config_from_args
+from state_manager import StateManager
+
+MATTING_SCRIPT = os.path.join(_SCRIPT_DIR, "run_multi_pet_matting.py")
+# 单个会话子进程的时限（秒）
+SESSION_TIMEOUT = 1800
+
+
+@dataclass
+class SessionRun:
+    session_id: str
+    returncode: int
+    elapsed: float
+    log_path: str
+
+
+@dataclass
+class LoadTestResult:
+    runs: List[SessionRun]
+    elapsed: float
+    pets: int
+    server_stats: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def failed(self) -> List[SessionRun]:
+        return [run for run in self.runs if run.returncode != 0]
+
+    def summary_lines(self) -> List[str]:
+        times = [run.elapsed for run in self.runs]
+        lines = [
+            f"会话: {len(self.runs)}（失败 {len(self.failed)}），宠物: {self.pets}，总耗时 {self.elapsed:.1f}s",
+            f"会话耗时: p50 {percentile(times, 0.5):.1f}s, p95 {percentile(times, 0.95):.1f}s, "
+            f"最长 {percentile(times, 1.0):.1f}s",
+            f"吞吐: {self.pets / self.elapsed * 60 if self.elapsed > 0 else 0.0:.1f} 只宠物/分钟",
+        ]
+        if self.server_stats:
+            stats = self.server_stats
+            lines.append(f"模拟服务器: 预测 {stats['predictions']}，同时进行峰值 {stats['peak_active_predictions']}，"
+                         f"取消 {stats['cancelled']}，注入错误 {stats['injected'] or '无'}")
+            lines.append(f"请求: {stats['requests']}")
+        for run in self.failed:
+            lines.append(f"失败会话 {run.session_id}（退出码 {run.returncode}），日志: {run.log_path}")
+        return lines
+
+
+def make_pet_image(path: str, seed: int, size: int = 640) -> str:
+    """生成测试宠物图：浅色背景上的随机颜色 / 位置椭圆（seed 不同则内容不同）"""
+    import random
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (size, size), tuple(rng.randint(225, 250) for _ in range(3)))
+    margin = rng.randint(size // 10, size // 4)
+    ImageDraw.Draw(image).ellipse([margin, margin + rng.randint(-20, 20), size - margin, size - margin],
+                                  fill=tuple(rng.randint(40, 200) for _ in range(3)))
+    image.save(path, "JPEG", quality=90)
+    return path
+
+
+def prepare_sessions(run_id: str, sessions: int, pets: int, work_dir: str,
+                     images: Optional[Sequence[str]] = None) -> List[str]:
+    """创建会话并加入宠物；images 为空时为每只宠物生成不同的图"""
+    state_manager = StateManager()
+    session_ids = []
+    for i in range(sessions):
+        session_id = f"loadtest_{run_id}_{i}"
+        for j in range(pets):
+            if images:
+                image_path = os.path.abspath(images[(i * pets + j) % len(images)])
+            else:
+                image_path = make_pet_image(os.path.join(work_dir, f"{session_id}_{j}.jpg"), seed=i * 1000 + j)
+            state_manager.add_pet(session_id, image_path)
+        session_ids.append(session_id)
+    return session_ids
+
+
+def _run_session(session_id: str, base_url: str, work_dir: str, workers: int, in_memory: bool,
+                 priority: str = "batch", rate: Optional[float] = None) -> SessionRun:
+    env = dict(os.environ)
+    env.update({
+        "REPLICATE_API_BASE": base_url,
+        "REPLICATE_API_TOKEN": env.get("MOCK_REPLICATE_TOKEN", "mock-token"),
+        "REMOTE_RESULT_CACHE_MAX_BYTES": "0",
+        "UPLOAD_REGISTRY_PATH": os.path.join(work_dir, f"{session_id}_uploads.json"),
+        "MATTING_BACKEND": "replicate",
+        "REMOTE_PRIORITY": priority,
+        "PYTHONIOENCODING": "utf-8",
+    })
+    if rate:
+        env["REMOTE_RATE"] = str(rate)
+        env["REMOTE_SCHEDULER_STATE"] = os.path.join(work_dir, "token_bucket.json")
+    command = [sys.executable, MATTING_SCRIPT, session_id, "--workers", str(workers)]
+    if in_memory:
+        command.append("--in-memory")
+    log_path = os.path.join(work_dir, f"{session_id}.log")
+    start = time.perf_counter()
+    with open(log_path, "wb") as log:
+        try:
+            returncode = subprocess.run(command, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                        timeout=SESSION_TIMEOUT).returncode
+        except subprocess.TimeoutExpired:
+            returncode = -1
+    return SessionRun(session_id, returncode, time.perf_counter() - start, log_path)
+
+
+def run_load_test(sessions: int, pets: int = 2, workers: int = 4, in_memory: bool = False,
+                  config: Optional[MockConfig] = None, base_url: Optional[str] = None,
+                  images: Optional[Sequence[str]] = None, work_dir: Optional[str] = None,
+                  keep: bool = False, priority: str = "batch", rate: Optional[float] = None) -> LoadTestResult:
+    """
+    sessions 个会话同时抠图；base_url 为空时启动进程内模拟服务器（config 为其延迟 / 错误设置）
+    work_dir 存放生成的图与各会话日志；keep=False 时结束后删除会话目录
+    rate 给出时所有会话共用一个跨进程令牌桶（个/秒）
+    """
+    run_id = f"{time.strftime('%H%M%S')}_{os.getpid()}"
+    work_dir = work_dir or tempfile.mkdtemp(prefix="matting_load_")
+    os.makedirs(work_dir, exist_ok=True)
+    session_ids = prepare_sessions(run_id, sessions, pets, work_dir, images)
+
+    server = None if base_url else MockReplicateServer(config).start()
+    target = base_url or server.base_url
+    print(f"压测: {sessions} 个会话 x {pets} 只宠物 -> {target}（workers={workers}, in_memory={in_memory}）")
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as executor:
+            runs = list(executor.map(lambda sid: _run_session(sid, target, work_dir, workers, in_memory,
+                                                              priority, rate),
+                                     session_ids))
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            server.stop()
+        if not keep:
+            for session_id in session_ids:
+                shutil.rmtree(os.path.join("sessions", session_id), ignore_errors=True)
+
+    return LoadTestResult(runs=runs, elapsed=elapsed, pets=sessions * pets,
+                          server_stats=server.stats.summary() if server is not None else {})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多宠物抠图压测（本地模拟 Replicate）")
+    parser.add_argument("--sessions", type=int, default=4, help="同时运行的会话数")
+    parser.add_argument("--pets", type=int, default=2, help="每个会话的宠物数")
+    parser.add_argument("--workers", type=int, default=4, help="每个会话同时抠图的宠物数上限")
+    parser.add_argument("--in-memory", action="store_true", help="会话使用内存交接模式")
+    parser.add_argument("--images", nargs="*", default=None, help="使用这些图片（默认为每只宠物生成不同的图）")
+    parser.add_argument("--base-url", default=None, help="已启动的模拟服务器地址（默认启动进程内服务器）")
+    parser.add_argument("--work-dir", default=None, help="生成图与会话日志的目录（默认临时目录）")
+    parser.add_argument("--keep", action="store_true", help="保留会话目录")
+    parser.add_argument("--priority", choices=["interactive", "batch"], default="batch", help="会话的远程预测优先级")
+    parser.add_argument("--rate", type=float, default=None, help="所有会话共用的创建预测速率上限（个/秒，跨进程令牌桶）")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    result = run_load_test(args.sessions, args.pets, args.workers, args.in_memory,
+                           config=None if args.base_url else config_from_args(args),
+                           base_url=args.base_url, images=args.images, work_dir=args.work_dir, keep=args.keep,
+                           priority=args.priority, rate=args.rate)
+    for line in result.summary_lines():
+        print(line)
+    sys.exit(1 if result.failed else 0)
+
+
+if __name__ == "__main__":
+    main()
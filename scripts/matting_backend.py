@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+抠图后端接口
+抠图链的两种操作——去背景、抠出主体——都是「输入文件字节 -> 结果 PNG 字节」。
+run_background_removal、run_pet_image_matting 与 run_multi_pet_matting 依赖 MattingBackend，而不是直接调用 Replicate：
+- ReplicateMattingBackend：851-labs/background-remover 与 google/nano-banana（结果缓存、上传复用、重试策略照旧）
+- LocalMattingBackend：本地 GrabCut（utils/local_matting.py），不需要网络与令牌，pet_type 不区分
+- FakeMattingBackend：确定性的假结果，可设固定延迟模拟远程耗时，用于测吞吐与 CI
+环境变量 MATTING_BACKEND（replicate / local / fake）选择默认后端，默认 replicate。
+"""
+import asyncio
+import io
+import os
+import sys
+import threading
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+# 确保脚本目录和项目根目录在 path 中（utils 在项目根目录）
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from remote_policy import RetryPolicy
+from remote_result_cache import RemoteResultCache
+from remote_scheduler import Priority
+from replicate_async import AsyncReplicateClient, client_scope
+from run_background_removal import remove_background_bytes
+from run_pet_image_matting import PROMPTS, matting_bytes
+from utils.local_matting import remove_background_local
+
+DEFAULT_BACKEND = "replicate"
+
+
+class MattingBackend(ABC):
+    """
+    抠图后端；子类须实现 remove_background 与 extract_subject（均可在同一事件循环上并发调用），
+    缺少任一方法的子类在创建时即报错
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def remove_background(self, content: bytes, filename: str = "input.png") -> bytes:
+        """去背景：输入文件字节 -> RGBA PNG 字节"""
+
+    @abstractmethod
+    async def extract_subject(self, content: bytes, pet_type: str = "head", filename: str = "input.png") -> bytes:
+        """抠出主体（head / half_body / full_body）：输入文件字节 -> PNG 字节（可能是 RGB，调用方用 ensure_rgba 统一）"""
+
+
+class ReplicateMattingBackend(MattingBackend):
+    """
+    Replicate 后端；client 为空时每次调用临时创建客户端（可跨事件循环使用，如文件模式的同步封装），
+    传入 client 时只能在该客户端所在的事件循环上使用；priority 为空时取 REMOTE_PRIORITY；
+    refresh=True 时两种操作都不读结果缓存，重新调用并覆盖条目
+    """
+
+    name = "replicate"
+
+    def __init__(self, client: Optional[AsyncReplicateClient] = None,
+                 result_cache: Optional[RemoteResultCache] = None,
+                 policy: Optional[RetryPolicy] = None,
+                 priority: Optional[Priority] = None,
+                 refresh: bool = False):
+        self.client = client
+        self.result_cache = result_cache
+        self.policy = policy
+        self.priority = priority
+        self.refresh = refresh
+
+    async def remove_background(self, content: bytes, filename: str = "input.png") -> bytes:
+        return await remove_background_bytes(content, client=self.client, result_cache=self.result_cache,
+                                             filename=filename, policy=self.policy, priority=self.priority,
+                                             refresh=self.refresh)
+
+    async def extract_subject(self, content: bytes, pet_type: str = "head", filename: str = "input.png") -> bytes:
+        return await matting_bytes(content, pet_type, client=self.client, result_cache=self.result_cache,
+                                   filename=filename, policy=self.policy, priority=self.priority,
+                                   refresh=self.refresh)
+
+
+def _encode_png(image: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _check_pet_type(pet_type: str):
+    if pet_type not in PROMPTS:
+        raise ValueError(f"pet_type 须为 head/half_body/full_body，当前: {pet_type}")
+
+
+class LocalMattingBackend(MattingBackend):
+    """本地离线后端：两种操作都用 remove_background_local（CPU 计算放到线程中）"""
+
+    name = "local"
+
+    async def remove_background(self, content: bytes, filename: str = "input.png") -> bytes:
+        return await asyncio.to_thread(self._run, content)
+
+    async def extract_subject(self, content: bytes, pet_type: str = "head", filename: str = "input.png") -> bytes:
+        _check_pet_type(pet_type)
+        return await asyncio.to_thread(self._run, content)
+
+    @staticmethod
+    def _run(content: bytes) -> bytes:
+        return _encode_png(remove_background_local(Image.open(io.BytesIO(content))))
+
+
+class FakeMattingBackend(MattingBackend):
+    """
+    确定性假后端：已有透明通道的输入原样保留 alpha，不透明输入取居中内切椭圆为前景；
+    latency 秒的固定延迟模拟远程耗时（不占线程）；calls 按操作计数
+    """
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Dict[str, int] = {"remove_background": 0, "extract_subject": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, operation: str):
+        with self._lock:
+            self.calls[operation] += 1
+
+    async def remove_background(self, content: bytes, filename: str = "input.png") -> bytes:
+        self._count("remove_background")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(self._run, content)
+
+    async def extract_subject(self, content: bytes, pet_type: str = "head", filename: str = "input.png") -> bytes:
+        _check_pet_type(pet_type)
+        self._count("extract_subject")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await asyncio.to_thread(self._run, content)
+
+    @staticmethod
+    def _run(content: bytes) -> bytes:
+        image = Image.open(io.BytesIO(content)).convert("RGBA")
+        alpha = np.asarray(image.getchannel("A"))
+        if alpha.min() == 255:
+            width, height = image.size
+            mask = Image.new("L", image.size, 0)
+            ImageDraw.Draw(mask).ellipse([width * 0.1, height * 0.1, width * 0.9, height * 0.9], fill=255)
+            image.putalpha(mask)
+        return _encode_png(image)
+
+
+BACKENDS = {
+    "replicate": ReplicateMattingBackend,
+    "local": LocalMattingBackend,
+    "fake": FakeMattingBackend,
+}
+
+
+def resolve_backend_name(name: Optional[str] = None) -> str:
+    """显式传入的名称优先，其次环境变量 MATTING_BACKEND，默认 replicate"""
+    name = (name or os.getenv("MATTING_BACKEND") or DEFAULT_BACKEND).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"未知的抠图后端: {name}（可选 {'/'.join(BACKENDS)}）")
+    return name
+
+
+def create_backend(name: Optional[str] = None, **kwargs) -> MattingBackend:
+    """按名称创建后端；kwargs 传给对应的构造函数"""
+    return BACKENDS[resolve_backend_name(name)](**kwargs)
+
+
+def with_refresh(backend: Optional[MattingBackend] = None) -> MattingBackend:
+    """
+    不读结果缓存的同一后端：Replicate 后端返回 refresh=True 的副本（重新调用并覆盖缓存条目），
+    其余后端不经结果缓存，原样返回；未传入时按 MATTING_BACKEND 创建
+    """
+    if backend is None:
+        backend = create_backend()
+    if isinstance(backend, ReplicateMattingBackend):
+        return ReplicateMattingBackend(backend.client, backend.result_cache, backend.policy, backend.priority,
+                                       refresh=True)
+    return backend
+
+
+@asynccontextmanager
+async def backend_scope(backend: Optional[MattingBackend] = None) -> AsyncIterator[MattingBackend]:
+    """
+    未传入时按 MATTING_BACKEND 创建；未指定客户端的 Replicate 后端在整个作用域内共用一个客户端
+    （连接池、上传登记），结束时关闭；其余后端原样使用
+    """
+    if backend is None:
+        backend = create_backend()
+    if isinstance(backend, ReplicateMattingBackend) and backend.client is None:
+        async with client_scope() as client:
+            yield ReplicateMattingBackend(client, backend.result_cache, backend.policy, backend.priority,
+                                          backend.refresh)
+        return
+    yield backend
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""指标统计的公共工具：下载、远程调用策略、远程调度与压测报告共用"""
+from typing import Iterable
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    """最近秩分位数（q 取 0~1）；空序列返回 0.0"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+本地 Replicate 模拟服务器（压测用）
+实现脚本用到的接口：POST /v1/files 上传、POST /v1/predictions 与 /v1/models/{owner}/{name}/predictions 创建预测、
+GET /v1/predictions/{id} 轮询、POST /v1/predictions/{id}/cancel 取消、GET /delivery/{id}.png 下载结果。
+- 延迟：上传 / 下载按分布同步等待；预测耗时按模型抽样（对数正态），轮询在到期前返回 processing，不占线程
+- 错误：上传 / 创建 / 下载按概率返回 503，创建按概率返回 429，预测按概率 failed；
+  max_active_predictions 限制同时进行的预测数，超出返回 429（模拟账户并发上限）
+- 输出：fixtures 目录中的 RGBA PNG（未给出时用内置的椭圆假宠物），按输入内容固定选取，缩放到输入图尺寸
+用法:
+    python mock_replicate_server.py [--port 8787] [--bg-latency 2,0.3] [--nano-latency 8,0.5] [--failure-rate 0.02]
+    REPLICATE_API_BASE=http://127.0.0.1:8787 REPLICATE_API_TOKEN=mock python run_multi_pet_matting.py <session_id>
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+from replicate_utils import BG_REMOVER_VERSION
+
+# 统一使用 UTF-8，避免中文路径与打印乱码
+if hasattr(sys.stdout, "reconfigure"):
+    sys.stdout.reconfigure(encoding="utf-8")
+    sys.stderr.reconfigure(encoding="utf-8")
+
+DEFAULT_PORT = 8787
+# 上传文件的有效期（与 Replicate 一致为 24 小时）
+FILE_TTL = timedelta(hours=24)
+
+
+@dataclass
+class Latency:
+    """对数正态延迟：median 秒，spread 为 ln 尺度的标准差（0 为固定值）"""
+    median: float
+    spread: float = 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(rng.gauss(0.0, self.spread)) if self.spread else self.median
+
+    @classmethod
+    def parse(cls, text: str) -> "Latency":
+        """"median" 或 "median,spread" """
+        parts = [float(p) for p in text.split(",")]
+        return cls(*parts[:2])
+
+
+def _default_model_latency() -> Dict[str, Latency]:
+    return {"background-remover": Latency(2.0, 0.3), "nano-banana": Latency(8.0, 0.5)}
+
+
+def _default_version_models() -> Dict[str, str]:
+    model, version = BG_REMOVER_VERSION.split(":", 1)
+    return {version: model}
+
+
+@dataclass
+class MockConfig:
+    """
+    model_latency: 模型名片段 -> 预测耗时分布（未匹配的用 prediction_latency）；
+    版本号创建的预测按版本号匹配，version_models 给出版本号 -> 模型名
+    *_error_rate / failure_rate: 对应请求返回 503 / 预测失败的概率；rate_limit_rate: 创建返回 429 的概率
+    """
+    upload_latency: Latency = field(default_factory=lambda: Latency(0.05, 0.3))
+    download_latency: Latency = field(default_factory=lambda: Latency(0.05, 0.3))
+    prediction_latency: Latency = field(default_factory=lambda: Latency(3.0, 0.4))
+    model_latency: Dict[str, Latency] = field(default_factory=_default_model_latency)
+    version_models: Dict[str, str] = field(default_factory=_default_version_models)
+    upload_error_rate: float = 0.0
+    create_error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    failure_rate: float = 0.0
+    download_error_rate: float = 0.0
+    max_active_predictions: Optional[int] = None
+    fixtures_dir: Optional[str] = None
+    seed: Optional[int] = None
+
+
+def default_fixtures() -> List[Image.Image]:
+    """内置假宠物：透明底上的椭圆（不同颜色与长宽比），边缘干净"""
+    fixtures = []
+    for color, box in (((200, 120, 40), (64, 48, 448, 464)), ((90, 90, 90), (48, 96, 464, 416)),
+                       ((240, 220, 200), (96, 32, 416, 480))):
+        image = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+        ImageDraw.Draw(image).ellipse(box, fill=color + (255,))
+        fixtures.append(image)
+    return fixtures
+
+
+def load_fixtures(fixtures_dir: Optional[str]) -> List[Image.Image]:
+    """fixtures 目录中的 PNG（转为 RGBA）；目录为空或未给出时用内置假宠物"""
+    if not fixtures_dir:
+        return default_fixtures()
+    fixtures = [Image.open(path).convert("RGBA") for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.png")))]
+    return fixtures or default_fixtures()
+
+
+class MockStats:
+    """请求计数、注入的错误与同时进行的预测数峰值"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.injected: Dict[str, int] = {}
+        self.predictions = 0
+        self.cancelled = 0
+        self.peak_active = 0
+
+    def count(self, route: str):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def inject(self, kind: str):
+        with self._lock:
+            self.injected[kind] = self.injected.get(kind, 0) + 1
+
+    def created(self, active: int):
+        with self._lock:
+            self.predictions += 1
+            self.peak_active = max(self.peak_active, active)
+
+    def canceled(self):
+        with self._lock:
+            self.cancelled += 1
+
+    def summary(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "injected": dict(self.injected),
+                "predictions": self.predictions,
+                "cancelled": self.cancelled,
+                "peak_active_predictions": self.peak_active,
+            }
+
+
+@dataclass
+class _Prediction:
+    id: str
+    model: str
+    ready_at: float
+    fail: bool
+    output_key: Tuple[int, Optional[Tuple[int, int]]]
+    status: str = "starting"
+
+
+class MockReplicate:
+    """模拟服务器的状态与路由（与 HTTP 层分开，便于直接调用）"""
+
+    def __init__(self, config: Optional[MockConfig] = None):
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.base_url = ""
+        self._rng = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._fixtures = load_fixtures(self.config.fixtures_dir)
+        self._files: Dict[str, Tuple[str, Optional[Tuple[int, int]]]] = {}  # id -> (sha256, 尺寸)
+        self._predictions: Dict[str, _Prediction] = {}
+        self._outputs: Dict[Tuple[int, Optional[Tuple[int, int]]], bytes] = {}
+
+    def _chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._rng.random() < rate
+
+    def _sample(self, latency: Latency) -> float:
+        with self._lock:
+            return latency.sample(self._rng)
+
+    def _model_latency(self, model: str) -> Latency:
+        for key, latency in self.config.model_latency.items():
+            if key in model:
+                return latency
+        return self.config.prediction_latency
+
+    def _active(self, now: float) -> int:
+        return sum(1 for p in self._predictions.values() if p.status != "canceled" and p.ready_at > now)
+
+    # 路由：返回 (状态码, JSON 或字节)
+    def upload(self, filename: str, content: bytes) -> Tuple[int, object]:
+        time.sleep(self._sample(self.config.upload_latency))
+        if self._chance(self.config.upload_error_rate):
+            self.stats.inject("upload_503")
+            return 503, {"detail": "injected upload error"}
+        try:
+            with Image.open(io.BytesIO(content)) as image:
+                size = image.size
+        except OSError:
+            size = None
+        with self._lock:
+            file_id = f"file{len(self._files)}"
+            self._files[file_id] = (hashlib.sha256(content).hexdigest(), size)
+        expires_at = (datetime.now(timezone.utc) + FILE_TTL).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return 201, {"id": file_id, "name": filename, "size": len(content), "expires_at": expires_at,
+                     "urls": {"get": f"{self.base_url}/v1/files/{file_id}"}}
+
+    def _input_file(self, model_input: Dict) -> Optional[Tuple[str, Optional[Tuple[int, int]]]]:
+        """预测输入中引用的第一个上传文件"""
+        values = list(model_input.values())
+        while values:
+            value = values.pop(0)
+            if isinstance(value, list):
+                values.extend(value)
+            elif isinstance(value, str) and "/v1/files/" in value:
+                return self._files.get(value.rsplit("/", 1)[-1])
+        return None
+
+    def create(self, model: str, body: Dict) -> Tuple[int, object]:
+        if "version" in body:
+            model = self.config.version_models.get(body["version"], body["version"])
+        if self._chance(self.config.rate_limit_rate):
+            self.stats.inject("create_429")
+            return 429, {"detail": "injected rate limit"}
+        if self._chance(self.config.create_error_rate):
+            self.stats.inject("create_503")
+            return 503, {"detail": "injected server error"}
+
+        source = self._input_file(body.get("input") or {})
+        digest, size = source if source else ("", None)
+        now = time.monotonic()
+        with self._lock:
+            limit = self.config.max_active_predictions
+            if limit is not None and self._active(now) >= limit:
+                self.stats.inject("concurrency_429")
+                return 429, {"detail": f"too many active predictions (limit {limit})"}
+            prediction_id = f"pred{len(self._predictions)}"
+            fixture = int(digest[:8], 16) % len(self._fixtures) if digest else 0
+            prediction = _Prediction(
+                id=prediction_id, model=model,
+                ready_at=now + self._model_latency(model).sample(self._rng),
+                fail=self._rng.random() < self.config.failure_rate,
+                output_key=(fixture, size),
+            )
+            self._predictions[prediction_id] = prediction
+            self.stats.created(self._active(now))
+        return 201, self._prediction_json(prediction)
+
+    def _prediction_json(self, prediction: _Prediction) -> Dict:
+        succeeded = prediction.status == "succeeded"
+        return {
+            "id": prediction.id, "model": prediction.model, "status": prediction.status,
+            "error": "injected prediction failure" if prediction.status == "failed" else None,
+            "output": [f"{self.base_url}/delivery/{prediction.id}.png"] if succeeded else None,
+            "urls": {"get": f"{self.base_url}/v1/predictions/{prediction.id}",
+                     "cancel": f"{self.base_url}/v1/predictions/{prediction.id}/cancel"},
+        }
+
+    def get(self, prediction_id: str) -> Tuple[int, object]:
+        with self._lock:
+            prediction = self._predictions.get(prediction_id)
+            if prediction is None:
+                return 404, {"detail": "prediction not found"}
+            if prediction.status in ("starting", "processing"):
+                if time.monotonic() >= prediction.ready_at:
+                    prediction.status = "failed" if prediction.fail else "succeeded"
+                    if prediction.fail:
+                        self.stats.inject("prediction_failed")
+                else:
+                    prediction.status = "processing"
+            return 200, self._prediction_json(prediction)
+
+    def cancel(self, prediction_id: str) -> Tuple[int, object]:
+        with self._lock:
+            prediction = self._predictions.get(prediction_id)
+            if prediction is None:
+                return 404, {"detail": "prediction not found"}
+            if prediction.status in ("starting", "processing"):
+                prediction.status = "canceled"
+                self.stats.canceled()
+            return 200, self._prediction_json(prediction)
+
+    def _render(self, key: Tuple[int, Optional[Tuple[int, int]]]) -> bytes:
+        with self._lock:
+            cached = self._outputs.get(key)
+        if cached is not None:
+            return cached
+        fixture, size = key
+        image = self._fixtures[fixture]
+        if size and size != image.size:
+            image = image.resize(size, Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG", compress_level=1)
+        with self._lock:
+            self._outputs[key] = buffer.getvalue()
+        return self._outputs[key]
+
+    def delivery(self, prediction_id: str) -> Tuple[int, object]:
+        time.sleep(self._sample(self.config.download_latency))
+        with self._lock:
+            prediction = self._predictions.get(prediction_id)
+        if prediction is None or prediction.status != "succeeded":
+            return 404, {"detail": "output not found"}
+        if self._chance(self.config.download_error_rate):
+            self.stats.inject("download_503")
+            return 503, {"detail": "injected download error"}
+        return 200, self._render(prediction.output_key)
+
+
+def _multipart_file(content_type: str, body: bytes) -> Tuple[str, bytes]:
+    """multipart/form-data 中的第一个文件字段 -> (文件名, 内容)"""
+    boundary = content_type.split("boundary=", 1)[-1].strip('"').encode()
+    for part in body.split(b"--" + boundary):
+        head, sep, data = part.partition(b"\r\n\r\n")
+        if sep and b"filename=" in head:
+            filename = head.split(b'filename="', 1)[1].split(b'"', 1)[0].decode("utf-8", "replace")
+            return filename, data[:-2] if data.endswith(b"\r\n") else data
+    return "", b""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock: MockReplicate = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, payload: object):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "image/png" if isinstance(payload, bytes) else "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _authorized(self) -> bool:
+        if (self.headers.get("Authorization") or "").startswith("Bearer "):
+            return True
+        self._send(401, {"detail": "missing token"})
+        return False
+
+    def do_POST(self):
+        body = self._body()
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if not self._authorized():
+            return
+        if path == "/v1/files":
+            self.mock.stats.count("upload")
+            self._send(*self.mock.upload(*_multipart_file(self.headers.get("Content-Type", ""), body)))
+        elif path.endswith("/cancel"):
+            self.mock.stats.count("cancel")
+            self._send(*self.mock.cancel(path.split("/")[-2]))
+        elif path == "/v1/predictions" or (path.startswith("/v1/models/") and path.endswith("/predictions")):
+            self.mock.stats.count("create")
+            model = path[len("/v1/models/"):-len("/predictions")] if path.startswith("/v1/models/") else ""
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                self._send(400, {"detail": "invalid json"})
+                return
+            self._send(*self.mock.create(model, payload))
+        else:
+            self._send(404, {"detail": "not found"})
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.startswith("/delivery/"):
+            self.mock.stats.count("download")
+            self._send(*self.mock.delivery(os.path.splitext(path.rsplit("/", 1)[-1])[0]))
+            return
+        if not self._authorized():
+            return
+        if path.startswith("/v1/predictions/"):
+            self.mock.stats.count("poll")
+            self._send(*self.mock.get(path.rsplit("/", 1)[-1]))
+        else:
+            self._send(404, {"detail": "not found"})
+
+
+class MockReplicateServer:
+    """
+    在后台线程中运行的模拟服务器，用作上下文管理器：
+
+        with MockReplicateServer(MockConfig(failure_rate=0.05)) as server:
+            os.environ["REPLICATE_API_BASE"] = server.base_url
+    """
+
+    def __init__(self, config: Optional[MockConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.mock = MockReplicate(config)
+        handler = type("MockReplicateHandler", (_Handler,), {"mock": self.mock})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.base_url = f"http://{host}:{self._server.server_address[1]}"
+        self.mock.base_url = self.base_url
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def stats(self) -> MockStats:
+        return self.mock.stats
+
+    def start(self) -> "MockReplicateServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-replicate", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockReplicateServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """模拟服务器的延迟 / 错误参数（压测脚本共用）"""
+    parser.add_argument("--bg-latency", default="2,0.3", help="去背景预测耗时：中位数秒[,ln 标准差]")
+    parser.add_argument("--nano-latency", default="8,0.5", help="nano-banana 预测耗时：中位数秒[,ln 标准差]")
+    parser.add_argument("--transfer-latency", default="0.05,0.3", help="上传 / 下载耗时：中位数秒[,ln 标准差]")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="预测失败概率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="上传 / 创建 / 下载返回 503 的概率")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="创建预测返回 429 的概率")
+    parser.add_argument("--max-active", type=int, default=None, help="同时进行的预测数上限（超出返回 429）")
+    parser.add_argument("--fixtures", default=None, help="输出用的 RGBA PNG 目录（默认内置假宠物）")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    transfer = Latency.parse(args.transfer_latency)
+    return MockConfig(
+        upload_latency=transfer, download_latency=transfer,
+        model_latency={"background-remover": Latency.parse(args.bg_latency),
+                       "nano-banana": Latency.parse(args.nano_latency)},
+        upload_error_rate=args.error_rate, create_error_rate=args.error_rate, download_error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit, failure_rate=args.failure_rate,
+        max_active_predictions=args.max_active, fixtures_dir=args.fixtures, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Replicate 模拟服务器（压测用）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockReplicateServer(config_from_args(args), args.host, args.port).start()
+    print(f"模拟服务器已启动: {server.base_url}")
+    print(f"  REPLICATE_API_BASE={server.base_url} REPLICATE_API_TOKEN=mock REMOTE_RESULT_CACHE_MAX_BYTES=0")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(json.dumps(server.stats.summary(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+远程模型调用的重试 / 超时 / 对冲策略
+去背景与 nano-banana 原先没有超时也不重试：一次慢预测或偶发失败会拖住整个会话。
+一次「调用」= 上传 -> 预测 -> 下载，整体可重复执行（相同输入得到同一结果、上传按内容复用），
+因此以整次调用为重试单位：
+- 时限：每次尝试 attempt_timeout，整次调用 deadline（含退避等待）
+- 重试：可重试的错误（连接 / 超时、429 与 5xx、预测等待超时）按指数退避 + 全抖动重试，
+  4xx 等确定性错误直接抛出；模型返回 failed 多半是确定性的（重试同样失败且每次计费），
+  默认不重试，retry_failed_predictions=True 时才重试。轮询中的暂时性错误由客户端在轮询内重试，
+  预测未结束就放弃时客户端先取消远程预测，重试不会留下重复计费的预测
+- 对冲：开启 hedge_percentile 后，尝试耗时超过该操作历史成功耗时的分位数时再发一份相同请求，
+  先成功者胜出，另一份取消（远程预测一并取消）
+- 排队：传入 Admission（如全局调度器的 slot）时每个请求（含对冲）先排队获准再开始计时，
+  排队时间不计入 attempt_timeout 与成功耗时（否则长队列会触发超时、重试回到队尾，并抬高对冲阈值）；
+  调度器仍有排队者时不发对冲请求（拥塞时对冲只会加倍负载）。整次调用的 deadline 包含排队时间
+每个请求记录到 CallMetrics（操作名、第几次、是否对冲、耗时、结果）。
+环境变量 REMOTE_MAX_ATTEMPTS / REMOTE_ATTEMPT_TIMEOUT / REMOTE_DEADLINE / REMOTE_HEDGE_PERCENTILE 覆盖默认策略。
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncContextManager, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from metrics_utils import percentile
+from replicate_async import PredictionFailed, PredictionTimeout, ReplicateAPIError, is_transient_error
+
+T = TypeVar("T")
+
+
+class AttemptTimeout(ReplicateAPIError):
+    """单次尝试超过 attempt_timeout"""
+
+
+class RemoteCallTimeout(ReplicateAPIError):
+    """整次调用超过 deadline"""
+
+
+@dataclass
+class RetryPolicy:
+    """
+    max_attempts: 最多尝试次数（含首次）
+    attempt_timeout / deadline: 单次尝试与整次调用的时限（秒）
+    base_delay / max_delay: 退避基数与上限，第 n 次重试前等待 uniform(0, min(max_delay, base_delay * 2^(n-1)))
+    hedge_percentile: 对冲触发的历史耗时分位数（如 0.95）；None 关闭对冲
+    hedge_min_samples: 历史成功样本不足时不对冲
+    retry_failed_predictions: 模型返回 failed 时是否重试（默认否）
+    """
+    max_attempts: int = 3
+    attempt_timeout: float = 300.0
+    deadline: float = 900.0
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    hedge_percentile: Optional[float] = None
+    hedge_min_samples: int = 5
+    retry_failed_predictions: bool = False
+    rng: random.Random = field(default_factory=random.Random, repr=False)
+
+    def backoff(self, retry: int) -> float:
+        """第 retry 次重试前的等待（全抖动）"""
+        return self.rng.uniform(0, min(self.max_delay, self.base_delay * (2 ** (retry - 1))))
+
+    def is_retryable(self, error: BaseException) -> bool:
+        if isinstance(error, (AttemptTimeout, PredictionTimeout)):
+            return True
+        if isinstance(error, PredictionFailed):
+            return self.retry_failed_predictions and error.prediction.get("status") == "failed"
+        return is_transient_error(error)
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def resolve_retry_policy() -> RetryPolicy:
+    """默认策略，按环境变量覆盖（未设置的项保持默认）"""
+    overrides = {}
+    for env, name, cast in (("REMOTE_MAX_ATTEMPTS", "max_attempts", int),
+                            ("REMOTE_ATTEMPT_TIMEOUT", "attempt_timeout", float),
+                            ("REMOTE_DEADLINE", "deadline", float),
+                            ("REMOTE_HEDGE_PERCENTILE", "hedge_percentile", float)):
+        value = os.getenv(env)
+        if value:
+            overrides[name] = cast(value)
+    return RetryPolicy(**overrides) if overrides else DEFAULT_RETRY_POLICY
+
+
+@dataclass
+class Admission:
+    """
+    请求开始前的排队入口：slot() 返回获准后持有的异步上下文（如 RemoteScheduler.slot），
+    congested() 为真时不发对冲请求
+    """
+    slot: Callable[[], AsyncContextManager[None]]
+    congested: Callable[[], bool] = lambda: False
+
+
+@dataclass
+class AttemptRecord:
+    """单个请求（主请求或对冲）：outcome 为 ok / error / timeout / cancelled；排队中被取消的不记录"""
+    operation: str
+    attempt: int
+    hedged: bool
+    elapsed: float
+    outcome: str
+    error: str = ""
+
+
+class CallMetrics:
+    """逐次尝试的记录与按操作的成功耗时（线程安全，可跨事件循环共用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: List[AttemptRecord] = []
+
+    def record(self, record: AttemptRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def latencies(self, operation: str) -> List[float]:
+        with self._lock:
+            return [r.elapsed for r in self.records if r.operation == operation and r.outcome == "ok"]
+
+    def hedge_delay(self, operation: str, policy: RetryPolicy) -> Optional[float]:
+        """对冲等待时间：历史成功耗时的 hedge_percentile 分位；关闭或样本不足时为 None"""
+        if policy.hedge_percentile is None:
+            return None
+        latencies = self.latencies(operation)
+        if len(latencies) < policy.hedge_min_samples:
+            return None
+        return percentile(latencies, policy.hedge_percentile)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            records = list(self.records)
+        result = {}
+        for operation in sorted({r.operation for r in records}):
+            ops = [r for r in records if r.operation == operation]
+            ok = [r.elapsed for r in ops if r.outcome == "ok"]
+            result[operation] = {
+                "attempts": len(ops),
+                "ok": len(ok),
+                "retries": sum(1 for r in ops if r.attempt > 1 and not r.hedged),
+                "hedges": sum(1 for r in ops if r.hedged),
+                "hedge_wins": sum(1 for r in ops if r.hedged and r.outcome == "ok"),
+                "timeouts": sum(1 for r in ops if r.outcome == "timeout"),
+                "p50": percentile(ok, 0.5),
+                "p95": percentile(ok, 0.95),
+            }
+        return result
+
+
+def format_call_metrics(metrics: "CallMetrics") -> List[str]:
+    """每个操作一行的统计摘要"""
+    return [
+        f"{op}: 尝试 {m['attempts']}, 成功 {m['ok']}, 重试 {m['retries']}, 对冲 {m['hedges']}（胜 {m['hedge_wins']}）, "
+        f"超时 {m['timeouts']}, p50 {m['p50']:.1f}s, p95 {m['p95']:.1f}s"
+        for op, m in metrics.summary().items()
+    ]
+
+
+_default_metrics = CallMetrics()
+
+
+def get_call_metrics() -> CallMetrics:
+    """进程内共享的调用指标"""
+    return _default_metrics
+
+
+class _Unlimited:
+    """未传 Admission 时的空排队入口"""
+
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+async def _timed(operation: str, attempt: int, hedged: bool, attempt_fn: Callable[[], Awaitable[T]],
+                 timeout: float, metrics: CallMetrics, admission: Optional[Admission],
+                 granted: Optional[asyncio.Event] = None) -> T:
+    """单个请求：先排队获准，再在 timeout 内执行 attempt_fn（计时从获准开始）"""
+    async with (admission.slot() if admission is not None else _Unlimited()):
+        if granted is not None:
+            granted.set()
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(attempt_fn(), timeout)
+        except asyncio.CancelledError:
+            metrics.record(AttemptRecord(operation, attempt, hedged, time.perf_counter() - start, "cancelled"))
+            raise
+        except asyncio.TimeoutError as e:
+            elapsed = time.perf_counter() - start
+            if elapsed < timeout:
+                # attempt_fn 自身抛出的超时（未到时限）
+                metrics.record(AttemptRecord(operation, attempt, hedged, elapsed, "error", repr(e)))
+                raise
+            metrics.record(AttemptRecord(operation, attempt, hedged, elapsed, "timeout"))
+            raise AttemptTimeout(f"{operation} 第 {attempt} 次尝试超过 {timeout:.1f}s") from None
+        except Exception as e:
+            metrics.record(AttemptRecord(operation, attempt, hedged, time.perf_counter() - start, "error", repr(e)))
+            raise
+        metrics.record(AttemptRecord(operation, attempt, hedged, time.perf_counter() - start, "ok"))
+        return result
+
+
+async def _attempt(operation: str, attempt: int, attempt_fn: Callable[[], Awaitable[T]],
+                   timeout: float, policy: RetryPolicy, metrics: CallMetrics,
+                   admission: Optional[Admission] = None) -> T:
+    """一次尝试（可能带一份对冲请求）；先成功者胜出，其余取消"""
+    hedge_delay = metrics.hedge_delay(operation, policy)
+    granted = asyncio.Event()
+    tasks = [asyncio.create_task(_timed(operation, attempt, False, attempt_fn, timeout, metrics,
+                                        admission, granted))]
+    try:
+        if hedge_delay is not None and hedge_delay < timeout:
+            # 对冲计时从主请求获准开始
+            grant_wait = asyncio.create_task(granted.wait())
+            await asyncio.wait([tasks[0], grant_wait], return_when=asyncio.FIRST_COMPLETED)
+            grant_wait.cancel()
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and not (admission is not None and admission.congested()):
+                tasks.append(asyncio.create_task(_timed(operation, attempt, True, attempt_fn, timeout, metrics,
+                                                        admission)))
+        pending, errors = set(tasks), []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+        raise errors[0]
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def call_with_policy(operation: str, attempt_fn: Callable[[], Awaitable[T]],
+                           policy: Optional[RetryPolicy] = None,
+                           metrics: Optional[CallMetrics] = None,
+                           admission: Optional[Admission] = None) -> T:
+    """
+    按策略执行 attempt_fn（每次尝试重新调用，须可重复执行）；admission 非空时每个请求先排队获准
+    不可重试的错误与最后一次尝试的错误原样抛出；整次调用（含排队）超时抛出 RemoteCallTimeout
+    """
+    policy = policy or resolve_retry_policy()
+    metrics = metrics or get_call_metrics()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + policy.deadline
+    last_error: Optional[BaseException] = None
+    for attempt in range(1, policy.max_attempts + 1):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            return await asyncio.wait_for(
+                _attempt(operation, attempt, attempt_fn, min(policy.attempt_timeout, remaining),
+                         policy, metrics, admission),
+                remaining,
+            )
+        except Exception as e:
+            # 排队加执行超过整体时限；attempt_fn 自身抛出的超时按普通错误处理
+            if isinstance(e, asyncio.TimeoutError) and loop.time() >= deadline:
+                raise RemoteCallTimeout(f"{operation} 超过整体时限 {policy.deadline:.0f}s") from None
+            last_error = e
+            if not policy.is_retryable(e) or attempt == policy.max_attempts:
+                raise
+            delay = policy.backoff(attempt)
+            if loop.time() + delay >= deadline:
+                break
+            print(f"{operation} 第 {attempt} 次尝试失败（{e}），{delay:.1f}s 后重试")
+            await asyncio.sleep(delay)
+    raise RemoteCallTimeout(f"{operation} 超过整体时限 {policy.deadline:.0f}s") from last_error
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+远程模型调用结果缓存（内容寻址）
+重跑会话、老客户用同一张照片重新下单时，去背景 / nano-banana 抠图对字节完全相同的输入重复付费调用。
+缓存键 = sha256(输入文件字节) + 模型版本 + 提示词 + 其余入参；结果文件按自身 sha256 存为 blob
+（相同输出只存一份），索引记录 键 -> blob 与最近访问时间，总大小超过上限时按 LRU 淘汰。
+命中时不需要网络与令牌，离线测试可直接使用。
+nano-banana 是生成式模型，同一输入重跑可能得到更好的结果：调用方传 refresh=True 时跳过查询并覆盖条目
+（invalidate 删除单个条目）。文件读写与索引落盘是阻塞 I/O，异步调用方经 asyncio.to_thread 调用。
+位置：环境变量 REMOTE_RESULT_CACHE_DIR（默认 <项目根>/cache/remote_results）；
+容量：REMOTE_RESULT_CACHE_MAX_BYTES（默认 1 GiB，0 表示关闭缓存）。
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 索引格式版本
+RESULT_CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(PROJECT_ROOT, "cache", "remote_results")
+DEFAULT_MAX_BYTES = 1 << 30
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def sha256_file(path: str) -> str:
+    """文件内容的 sha256 十六进制"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_result_key(input_sha256: str, model: str, prompt: Optional[str] = None,
+                     params: Optional[Dict[str, Any]] = None) -> str:
+    """缓存键：输入内容哈希 + 模型版本 + 提示词 + 其余入参"""
+    payload = json.dumps(
+        {"input": input_sha256, "model": model, "prompt": prompt, "params": params or {}},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RemoteResultCache:
+    """
+    内容寻址的结果 blob 仓库：blobs/<前两位>/<sha256>，index.json 记录键与 LRU 信息
+    线程安全；多进程共用同一目录时索引以最后写入为准（blob 本身不可变，不会损坏）
+    """
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # 键 -> {"blob": sha256, "size": 字节数, "atime": 最近访问}
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, "index.json")
+
+    def _blob_path(self, blob: str) -> str:
+        return os.path.join(self.root, "blobs", blob[:2], blob)
+
+    @property
+    def total_bytes(self) -> int:
+        """当前被索引引用的 blob 总大小（相同 blob 只计一次）"""
+        with self._lock:
+            return self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return sum({e["blob"]: e["size"] for e in self._entries.values()}.values())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._total_bytes()}
+
+    def _lookup(self, key: str) -> Optional[str]:
+        """命中时返回 blob 路径并更新访问时间（调用方持锁）"""
+        entry = self._entries.get(key)
+        if entry is None or not os.path.isfile(self._blob_path(entry["blob"])):
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        entry["atime"] = time.time()
+        self.hits += 1
+        return self._blob_path(entry["blob"])
+
+    def get(self, key: str, out_path: str) -> bool:
+        """命中时把结果复制到 out_path 并返回 True"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            blob_path = self._lookup(key)
+            if blob_path is None:
+                return False
+            # 持锁复制：避免与其他线程的淘汰交错
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+            tmp_path = f"{out_path}.{threading.get_ident()}.tmp"
+            shutil.copyfile(blob_path, tmp_path)
+            os.replace(tmp_path, out_path)
+        self._save()
+        return True
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """命中时返回结果字节（内存交接模式，不落盘）"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            blob_path = self._lookup(key)
+            if blob_path is None:
+                return None
+            with open(blob_path, "rb") as f:
+                data = f.read()
+        self._save()
+        return data
+
+    def put(self, key: str, result_path: str):
+        """登记结果文件（复制进 blob 仓库），超出容量时按最近访问时间淘汰"""
+        if not self.enabled:
+            return
+        with open(result_path, "rb") as f:
+            self.put_bytes(key, f.read())
+
+    def put_bytes(self, key: str, data: bytes):
+        """登记结果字节，超出容量时按最近访问时间淘汰"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        blob = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(blob)
+        try:
+            if not os.path.isfile(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, blob_path)
+        except OSError:
+            # 目录只读等情况：放弃缓存
+            return
+        with self._lock:
+            previous = self._entries.get(key)
+            self._entries[key] = {"blob": blob, "size": len(data), "atime": time.time()}
+            # 覆盖（refresh）时旧结果不再被引用则删除
+            if previous is not None and previous["blob"] != blob:
+                self._remove_unreferenced(previous["blob"])
+            self._evict()
+        self._save()
+
+    def invalidate(self, key: str) -> bool:
+        """删除单个条目（不再被引用的 blob 一并删除）；条目存在时返回 True"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self._remove_unreferenced(entry["blob"])
+        self._save()
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+        shutil.rmtree(os.path.join(self.root, "blobs"), ignore_errors=True)
+        self._save()
+
+    def _evict(self):
+        """按 atime 从旧到新淘汰，直到总大小不超过上限；不再被引用的 blob 一并删除"""
+        while self._entries and self._total_bytes() > self.max_bytes:
+            key = min(self._entries, key=lambda k: self._entries[k]["atime"])
+            blob = self._entries.pop(key)["blob"]
+            self.evictions += 1
+            self._remove_unreferenced(blob)
+
+    def _remove_unreferenced(self, blob: str):
+        """blob 不再被任何条目引用时删除文件（调用方持锁）"""
+        if all(e["blob"] != blob for e in self._entries.values()):
+            try:
+                os.remove(self._blob_path(blob))
+            except OSError:
+                pass
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == RESULT_CACHE_VERSION:
+                self._entries = dict(data.get("entries", {}))
+        except (OSError, ValueError, AttributeError):
+            self._entries = {}
+
+    def _save(self):
+        with self._lock:
+            snapshot = {"version": RESULT_CACHE_VERSION,
+                        "entries": {k: dict(v) for k, v in self._entries.items()}}
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_default_cache: Optional[RemoteResultCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> RemoteResultCache:
+    """进程内共享的结果缓存（位置与容量取自环境变量）"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = RemoteResultCache(
+                os.getenv("REMOTE_RESULT_CACHE_DIR") or DEFAULT_CACHE_DIR,
+                int(os.getenv("REMOTE_RESULT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+            )
+        return _default_cache
@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+远程预测的全局调度（令牌桶 + 按模型并发上限 + 优先级）
+多个会话并行时各自直接调用 Replicate，突发的创建请求会触发账户限流（429）。
+去背景与 nano-banana 的每个请求（上传 -> 预测 -> 下载，含重试与对冲）都先向进程内共享的 RemoteScheduler 申请
+（经 remote_policy.Admission，在尝试计时之外排队）：
+- 令牌桶：创建预测的速率 rate（个/秒），允许突发 burst 个；设置 state_path 时桶状态存放在文件中
+  （flock 加锁），同一台机器上的多个进程共用一个桶；不支持 flock 的平台退回进程内桶
+- 并发上限：按模型名片段限制同时进行的请求数（进程内）
+- 优先级：interactive（用户在等的编辑）先于 batch（批量任务）；进程内按优先级排队，
+  跨进程时 batch 须在桶中至少留下 batch_reserve 个令牌，给其他进程的 interactive 请求
+- 指标：各优先级的排队数、等待时间分位（最近 WAIT_SAMPLES 次），各模型的进行中数
+此外所有 API 请求（上传、创建、轮询、取消）经 throttle() 走进程内的第二个令牌桶（api_rate / api_burst，
+对应 Replicate 其余接口每分钟 3000 次的限制），不分优先级；下载走结果文件域名，不计入。
+文件桶的 open + flock + 读写在线程中执行，且不持调度器锁：同一时刻只有排在最前的一个请求去取令牌，
+锁竞争时不阻塞事件循环与其他线程。
+环境变量：REMOTE_RATE、REMOTE_BURST、REMOTE_MODEL_CONCURRENCY（如 "nano-banana=4,background-remover=8"）、
+REMOTE_API_RATE、REMOTE_API_BURST、REMOTE_SCHEDULER_STATE（跨进程桶文件）、
+REMOTE_PRIORITY（本进程默认优先级，默认 interactive）。
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import AsyncIterator, Deque, Dict, List, Optional, Union
+
+from metrics_utils import percentile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Replicate 默认限制为每分钟 600 次创建预测
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 10
+DEFAULT_CONCURRENCY = 8
+BATCH_RESERVE = 2.0
+# 其余 API 请求默认每分钟 3000 次
+DEFAULT_API_RATE = 50.0
+DEFAULT_API_BURST = 100
+# 每个优先级保留的等待时间样本数（长时间运行的进程不无限增长）
+WAIT_SAMPLES = 1024
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+def resolve_priority(priority: Union[Priority, str, None] = None) -> Priority:
+    """显式传入的优先级优先，其次环境变量 REMOTE_PRIORITY，默认 interactive"""
+    if isinstance(priority, Priority):
+        return priority
+    name = (priority or os.getenv("REMOTE_PRIORITY") or "interactive").upper()
+    if name not in Priority.__members__:
+        raise ValueError(f"未知的优先级: {name.lower()}（可选 interactive/batch）")
+    return Priority[name]
+
+
+def _default_model_concurrency() -> Dict[str, int]:
+    return {"nano-banana": 4, "background-remover": 8}
+
+
+@dataclass
+class SchedulerConfig:
+    """
+    rate / burst: 创建预测的令牌桶速率（个/秒）与容量；model_concurrency: 模型名片段 -> 并发上限（未匹配的用 default_concurrency）
+    api_rate / api_burst: 全部 API 请求的进程内令牌桶
+    """
+    rate: float = DEFAULT_RATE
+    burst: int = DEFAULT_BURST
+    model_concurrency: Dict[str, int] = field(default_factory=_default_model_concurrency)
+    default_concurrency: int = DEFAULT_CONCURRENCY
+    batch_reserve: float = BATCH_RESERVE
+    state_path: Optional[str] = None
+    api_rate: float = DEFAULT_API_RATE
+    api_burst: int = DEFAULT_API_BURST
+
+    @classmethod
+    def from_env(cls) -> "SchedulerConfig":
+        config = cls()
+        if os.getenv("REMOTE_RATE"):
+            config.rate = float(os.environ["REMOTE_RATE"])
+        if os.getenv("REMOTE_BURST"):
+            config.burst = int(os.environ["REMOTE_BURST"])
+        if os.getenv("REMOTE_MODEL_CONCURRENCY"):
+            for item in os.environ["REMOTE_MODEL_CONCURRENCY"].split(","):
+                key, _, value = item.partition("=")
+                config.model_concurrency[key.strip()] = int(value)
+        if os.getenv("REMOTE_API_RATE"):
+            config.api_rate = float(os.environ["REMOTE_API_RATE"])
+        if os.getenv("REMOTE_API_BURST"):
+            config.api_burst = int(os.environ["REMOTE_API_BURST"])
+        config.state_path = os.getenv("REMOTE_SCHEDULER_STATE") or None
+        return config
+
+
+class TokenBucket:
+    """进程内令牌桶（非线程安全，调用方保证同一时刻只有一个取令牌者）"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def take(self, reserve: float = 0.0) -> float:
+        """桶中令牌 >= 1 + reserve 时取走一个并返回 0，否则返回还需等待的秒数"""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1 + reserve:
+            self._tokens -= 1
+            return 0.0
+        return (1 + reserve - self._tokens) / self.rate
+
+
+class FileTokenBucket(TokenBucket):
+    """状态存放在 path 中的令牌桶；读改写在 flock 排他锁内完成，多个进程共用"""
+
+    def __init__(self, rate: float, burst: int, path: str):
+        super().__init__(rate, burst)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def take(self, reserve: float = 0.0) -> float:
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                try:
+                    state = json.loads(raw) if raw.strip() else {}
+                except ValueError:
+                    state = {}
+                now = time.time()
+                tokens = float(state.get("tokens", self.burst))
+                tokens = min(self.burst, tokens + max(0.0, now - float(state.get("updated", now))) * self.rate)
+                wait = 0.0
+                if tokens >= 1 + reserve:
+                    tokens -= 1
+                else:
+                    wait = (1 + reserve - tokens) / self.rate
+                f.seek(0)
+                f.truncate()
+                json.dump({"tokens": tokens, "updated": now}, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+@dataclass
+class _Waiter:
+    model: str
+    priority: Priority
+    seq: int
+    loop: asyncio.AbstractEventLoop
+    event: asyncio.Event
+    enqueued: float
+
+    def wake(self):
+        """线程安全：在等待者所在的事件循环上设置事件"""
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+
+class RemoteScheduler:
+    """
+    远程预测调度器（线程安全，可被多个线程各自的事件循环共用）：
+
+        async with get_scheduler().slot(model, Priority.BATCH):
+            output = await client.run(model, model_input)
+    """
+
+    def __init__(self, config: Optional[SchedulerConfig] = None):
+        self.config = config or SchedulerConfig()
+        if self.config.state_path and fcntl is not None:
+            self._bucket = FileTokenBucket(self.config.rate, self.config.burst, self.config.state_path)
+        else:
+            if self.config.state_path:
+                print("当前平台不支持 flock，远程调度退回进程内令牌桶")
+            self._bucket = TokenBucket(self.config.rate, self.config.burst)
+        self._api_bucket = TokenBucket(self.config.api_rate, self.config.api_burst)
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiters: List[_Waiter] = []
+        # 正在取令牌的等待者（同一时刻至多一个，取令牌时不持 _lock）
+        self._claimant: Optional[_Waiter] = None
+        self._active: Dict[str, int] = {}
+        self._waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=WAIT_SAMPLES) for p in Priority}
+        self._granted: Dict[Priority, int] = {p: 0 for p in Priority}
+        self._peak_queue = 0
+        self._api_requests = 0
+        self._api_throttled = 0
+        self._api_wait = 0.0
+
+    def _concurrency(self, model: str) -> int:
+        for key, limit in self.config.model_concurrency.items():
+            if key in model:
+                return limit
+        return self.config.default_concurrency
+
+    def _has_capacity(self, model: str) -> bool:
+        return self._active.get(model, 0) < self._concurrency(model)
+
+    def _eligible(self, waiter: _Waiter) -> bool:
+        """
+        调用方持锁。没有其他请求正在取令牌、模型有空位，且排在前面（优先级、先来后到）
+        并有空位的等待者中没有比它更早的，才可去取令牌
+        """
+        if self._claimant is not None or not self._has_capacity(waiter.model):
+            return False
+        return not any((other.priority, other.seq) < (waiter.priority, waiter.seq) and self._has_capacity(other.model)
+                       for other in self._waiters)
+
+    async def _take_token(self, priority: Priority) -> float:
+        """取一个创建令牌：授予返回 0，否则返回还需等待的秒数（不持 _lock 调用）"""
+        # 留给 interactive 的令牌不超过桶容量 - 1，否则 batch 永远取不到
+        reserve = min(self.config.batch_reserve, self.config.burst - 1) if priority == Priority.BATCH else 0.0
+        if isinstance(self._bucket, FileTokenBucket):
+            return await asyncio.to_thread(self._bucket.take, reserve)
+        return self._bucket.take(reserve)
+
+    def _grant(self, waiter: _Waiter):
+        """调用方持锁"""
+        self._waiters.remove(waiter)
+        self._active[waiter.model] = self._active.get(waiter.model, 0) + 1
+        self._waits[waiter.priority].append(time.monotonic() - waiter.enqueued)
+        self._granted[waiter.priority] += 1
+
+    def _wake_all(self, skip: Optional[_Waiter] = None):
+        for waiter in self._waiters:
+            if waiter is not skip:
+                waiter.wake()
+
+    async def acquire(self, model: str, priority: Union[Priority, str, None] = None):
+        """等到令牌与模型空位；被取消时退出队列"""
+        waiter = _Waiter(model, resolve_priority(priority), 0, asyncio.get_running_loop(),
+                         asyncio.Event(), time.monotonic())
+        with self._lock:
+            waiter.seq = next(self._seq)
+            self._waiters.append(waiter)
+            self._peak_queue = max(self._peak_queue, len(self._waiters))
+        try:
+            while True:
+                waiter.event.clear()
+                with self._lock:
+                    claimed = self._eligible(waiter)
+                    if claimed:
+                        self._claimant = waiter
+                wait = None
+                if claimed:
+                    try:
+                        wait = await self._take_token(waiter.priority)
+                    finally:
+                        with self._lock:
+                            self._claimant = None
+                            if wait == 0:
+                                self._grant(waiter)
+                            # 取令牌期间被挡住的请求重新判断（授予后排在后面的请求可能成为队首）
+                            self._wake_all(skip=waiter)
+                    if wait == 0:
+                        return
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._wake_all()
+            raise
+
+    async def throttle(self):
+        """单个 API 请求的速率限制（进程内令牌桶，不分优先级）"""
+        start = time.monotonic()
+        throttled = False
+        while True:
+            with self._lock:
+                wait = self._api_bucket.take()
+                if wait == 0:
+                    self._api_requests += 1
+                    if throttled:
+                        self._api_throttled += 1
+                        self._api_wait += time.monotonic() - start
+                    return
+            throttled = True
+            await asyncio.sleep(wait)
+
+    def has_waiters(self) -> bool:
+        """是否有请求在排队（供对冲判断拥塞）"""
+        with self._lock:
+            return bool(self._waiters)
+
+    def release(self, model: str):
+        with self._lock:
+            self._active[model] = max(0, self._active.get(model, 0) - 1)
+            self._wake_all()
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: Union[Priority, str, None] = None) -> AsyncIterator[None]:
+        await self.acquire(model, priority)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def snapshot(self) -> Dict[str, object]:
+        """当前排队数（按优先级）、进行中数（按模型）、排队峰值与各优先级等待时间"""
+        with self._lock:
+            queued = {p.name.lower(): sum(1 for w in self._waiters if w.priority == p) for p in Priority}
+            waits = {p: list(values) for p, values in self._waits.items()}
+            return {
+                "queued": queued,
+                "active": {model: count for model, count in self._active.items() if count},
+                "peak_queue": self._peak_queue,
+                "wait": {p.name.lower(): {"count": self._granted[p], "p50": percentile(values, 0.5),
+                                          "p95": percentile(values, 0.95), "max": max(values, default=0.0)}
+                         for p, values in waits.items()},
+                "api": {"requests": self._api_requests, "throttled": self._api_throttled,
+                        "wait": self._api_wait},
+            }
+
+
+def format_scheduler_stats(scheduler: "RemoteScheduler") -> List[str]:
+    """每个优先级一行的等待统计（分位取最近 WAIT_SAMPLES 次），API 请求被限速时再加一行"""
+    snapshot = scheduler.snapshot()
+    api = snapshot["api"]
+    return [
+        f"{name}: 授予 {w['count']}, 等待 p50 {w['p50']:.2f}s, p95 {w['p95']:.2f}s, 最长 {w['max']:.2f}s, "
+        f"排队中 {snapshot['queued'][name]}"
+        for name, w in snapshot["wait"].items() if w["count"] or snapshot["queued"][name]
+    ] + ([f"排队峰值 {snapshot['peak_queue']}"] if snapshot["peak_queue"] else []) + (
+        [f"API 请求 {api['requests']}, 被限速 {api['throttled']}, 累计等待 {api['wait']:.2f}s"]
+        if api["throttled"] else [])
+
+
+_default_scheduler: Optional[RemoteScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> RemoteScheduler:
+    """进程内共享的调度器（配置取自环境变量）"""
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RemoteScheduler(SchedulerConfig.from_env())
+        return _default_scheduler
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Replicate 异步客户端（asyncio + httpx）
+同步的 replicate.run + urlretrieve 每次调用独占一个线程；本模块直接调用 Replicate HTTP API：
+- 上传：POST /v1/files（传入 UploadRegistry 时相同内容在 URL 过期前复用，不重复上传；
+  run_with_upload 在复用的 URL 被拒绝时作废登记并重新上传）
+- 创建预测：版本号模型 POST /v1/predictions，官方模型 POST /v1/models/{owner}/{name}/predictions
+- 轮询：GET /v1/predictions/{id}，间隔指数退避；轮询是幂等读，429 / 5xx / 连接错误在轮询内退避重试，
+  不把整次调用交给上层重试（否则会重新创建一个付费预测）
+- 预测未以终态结束就退出（出错、超时、被取消）时尽力取消远程预测
+- 下载：streaming_download.StreamingDownloader，与 API 请求共用连接池，流式写盘或边下载边解码
+同一事件循环上可同时挂起几十个预测，上传、预测与下载在多只宠物、多个会话之间重叠。
+每个 API 请求（上传、创建、轮询、取消）先经全局调度器的 API 令牌桶限速（remote_scheduler.throttle）。
+API 地址可用环境变量 REPLICATE_API_BASE 覆盖（本地 mock 服务器、代理）。
+"""
+import asyncio
+import hashlib
+import os
+import random
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, Optional
+
+import httpx
+
+from PIL import Image
+
+from remote_scheduler import get_scheduler
+from replicate_utils import REPLICATE_API_TOKEN, ensure_token
+from streaming_download import DownloadError, DownloadMetrics, StreamingDownloader
+
+if TYPE_CHECKING:
+    from upload_registry import UploadRegistry
+
+REPLICATE_API_BASE = os.getenv("REPLICATE_API_BASE", "https://api.replicate.com")
+
+# 连接池与超时
+MAX_CONNECTIONS = 32
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+# 轮询退避：首次间隔、倍率、上限；整体等待上限
+POLL_INTERVAL = 0.5
+POLL_BACKOFF = 1.5
+POLL_MAX_INTERVAL = 5.0
+PREDICTION_TIMEOUT = 600.0
+CANCEL_TIMEOUT = 5.0
+# 轮询遇到暂时性错误时连续重试的次数上限（退避以 poll_interval 为基数翻倍、全抖动，上限 POLL_MAX_INTERVAL）
+POLL_MAX_RETRIES = 5
+# 暂时性的 HTTP 状态码（另含全部 5xx）
+TRANSIENT_STATUS = (408, 409, 429)
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+# 预测失败信息中表明拉取输入文件失败的片段（小写匹配）
+INPUT_FETCH_MARKERS = ("download", "fetch", "not found", "404", "403", "410")
+
+
+class ReplicateAPIError(Exception):
+    """Replicate HTTP 接口返回错误；status_code 为 HTTP 状态码（下载失败等无状态码时为 None）"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class PredictionFailed(ReplicateAPIError):
+    """预测以 failed / canceled 结束，或超过等待上限"""
+
+    def __init__(self, message: str, prediction: Optional[Dict[str, Any]] = None):
+        super().__init__(message)
+        self.prediction = prediction or {}
+
+
+class PredictionTimeout(PredictionFailed):
+    """预测超过等待上限仍未结束（已尽力取消）"""
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """连接 / 读超时、408 / 409 / 429 与 5xx、无状态码的 API 错误（下载中断等）视为暂时性错误"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, ReplicateAPIError) and not isinstance(error, PredictionFailed):
+        status = error.status_code
+        return status is None or status in TRANSIENT_STATUS or status >= 500
+    return False
+
+
+def is_stale_upload_error(error: BaseException) -> bool:
+    """
+    复用的上传 URL 可能已失效（文件被删除等）：创建预测返回 4xx（429 等暂时性状态除外），
+    或预测失败信息表明拉取输入失败
+    """
+    if isinstance(error, PredictionFailed):
+        message = str(error.prediction.get("error") or "").lower()
+        return any(marker in message for marker in INPUT_FETCH_MARKERS)
+    if isinstance(error, ReplicateAPIError) and error.status_code is not None:
+        return 400 <= error.status_code < 500 and error.status_code not in TRANSIENT_STATUS
+    return False
+
+
+@dataclass
+class UploadedFile:
+    """
+    已上传文件：url 为模型输入可用的地址，expires_at 为过期时间（未知时为 None）
+    reused 为 True 表示取自上传登记表（未重新上传），content_sha256 为登记表的键
+    """
+    id: str
+    url: str
+    expires_at: Optional[datetime] = None
+    reused: bool = False
+    content_sha256: str = ""
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def extract_output_url(output: Any) -> str:
+    """预测输出 -> 结果文件 URL（字符串、带 url 的对象、或列表取第一个）"""
+    if isinstance(output, list) and output:
+        output = output[0]
+    if isinstance(output, str):
+        return output
+    if isinstance(output, dict) and "url" in output:
+        return output["url"]
+    if hasattr(output, "url"):
+        return output.url
+    return str(output)
+
+
+class AsyncReplicateClient:
+    """
+    Replicate 异步客户端，用作 async 上下文管理器：
+
+        async with AsyncReplicateClient() as client:
+            output = await client.run(BG_REMOVER_VERSION, {"image": url})
+            await client.download(extract_output_url(output), out_path)
+    """
+
+    def __init__(self, token: Optional[str] = None, base_url: Optional[str] = None,
+                 max_connections: int = MAX_CONNECTIONS,
+                 poll_interval: float = POLL_INTERVAL,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 upload_registry: Optional["UploadRegistry"] = None):
+        if token is None:
+            ensure_token()
+            token = REPLICATE_API_TOKEN
+        self.base_url = (base_url or REPLICATE_API_BASE).rstrip("/")
+        self.poll_interval = poll_interval
+        self.upload_registry = upload_registry
+        # 令牌只随 API 请求发送，不发给结果文件所在的下载域名
+        self._auth_headers = {"Authorization": f"Bearer {token}"}
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_connections),
+            follow_redirects=True,
+            transport=transport,
+        )
+        self.downloader = StreamingDownloader(client=self._client)
+
+    @property
+    def download_metrics(self) -> DownloadMetrics:
+        return self.downloader.metrics
+
+    async def __aenter__(self) -> "AsyncReplicateClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        url = path if path.startswith("http") else f"{self.base_url}{path}"
+        await get_scheduler().throttle()
+        response = await self._client.request(method, url, headers=self._auth_headers, **kwargs)
+        if response.status_code >= 400:
+            raise ReplicateAPIError(f"{method} {url} 返回 {response.status_code}: {response.text[:500]}",
+                                    status_code=response.status_code)
+        return response.json()
+
+    async def upload_file(self, path: str, content_type: str = "application/octet-stream") -> UploadedFile:
+        """上传本地文件，返回可作为模型输入的 URL；登记表中同内容的 URL 仍有效时直接复用"""
+        with open(path, "rb") as f:
+            content = f.read()
+        return await self.upload_bytes(content, os.path.basename(path), content_type)
+
+    async def upload_bytes(self, content: bytes, filename: str = "input.png",
+                           content_type: str = "application/octet-stream") -> UploadedFile:
+        """上传内存中的文件内容（内存交接模式不落盘再读回）"""
+        content_sha256 = hashlib.sha256(content).hexdigest()
+        if self.upload_registry is not None:
+            reused = self.upload_registry.get(self.base_url, content_sha256)
+            if reused is not None:
+                return reused
+        data = await self._request(
+            "POST", "/v1/files",
+            files={"content": (filename, content, content_type)},
+        )
+        urls = data.get("urls") or {}
+        uploaded = UploadedFile(
+            id=data.get("id", ""),
+            url=urls.get("get") or str(urls),
+            expires_at=_parse_time(data.get("expires_at")),
+            content_sha256=content_sha256,
+        )
+        if self.upload_registry is not None:
+            # 登记表落盘是阻塞 I/O，放到线程中，不阻塞共用事件循环的其他宠物
+            await asyncio.to_thread(self.upload_registry.put, self.base_url, content_sha256, uploaded)
+        return uploaded
+
+    async def invalidate_upload(self, uploaded: UploadedFile):
+        """从登记表中移除失效的上传 URL（之后同内容重新上传）"""
+        if self.upload_registry is not None and uploaded.content_sha256:
+            await asyncio.to_thread(self.upload_registry.invalidate, self.base_url, uploaded.content_sha256)
+
+    async def run_with_upload(self, model: str, content: bytes, filename: str, content_type: str,
+                              build_input: Callable[[str], Dict[str, Any]]) -> Any:
+        """
+        上传（或复用登记表中的 URL）后以 build_input(url) 为入参运行预测；
+        复用的 URL 被拒绝（创建预测 4xx、拉取输入失败）时作废登记、重新上传再运行一次，
+        重试与重跑不会反复使用同一个失效的 URL
+        """
+        uploaded = await self.upload_bytes(content, filename, content_type)
+        try:
+            return await self.run(model, build_input(uploaded.url))
+        except Exception as e:
+            if not (uploaded.reused and is_stale_upload_error(e)):
+                raise
+            print(f"复用的上传 URL 已失效（{e}），重新上传")
+            await self.invalidate_upload(uploaded)
+        uploaded = await self.upload_bytes(content, filename, content_type)
+        return await self.run(model, build_input(uploaded.url))
+
+    async def create_prediction(self, model: str, model_input: Dict[str, Any]) -> Dict[str, Any]:
+        """创建预测：owner/name:version 按版本号创建，owner/name 按官方模型创建"""
+        if ":" in model:
+            version = model.split(":", 1)[1]
+            return await self._request("POST", "/v1/predictions",
+                                       json={"version": version, "input": model_input})
+        return await self._request("POST", f"/v1/models/{model}/predictions", json={"input": model_input})
+
+    async def wait_prediction(self, prediction: Dict[str, Any],
+                              timeout: float = PREDICTION_TIMEOUT) -> Dict[str, Any]:
+        """
+        轮询到终态（间隔从 poll_interval 按 POLL_BACKOFF 递增到 POLL_MAX_INTERVAL）
+        单次轮询遇到暂时性错误时退避重试，连续 POLL_MAX_RETRIES 次仍失败才抛出
+        失败 / 取消抛出 PredictionFailed，超时抛出 PredictionTimeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        interval = self.poll_interval
+        poll_url = (prediction.get("urls") or {}).get("get") or f"/v1/predictions/{prediction['id']}"
+        failures = 0
+        while prediction.get("status") not in TERMINAL_STATUSES:
+            if loop.time() + interval > deadline:
+                raise PredictionTimeout(f"预测 {prediction.get('id')} 等待超时（{timeout:.0f}s）", prediction)
+            await asyncio.sleep(interval)
+            interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            try:
+                prediction = await self._request("GET", poll_url)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if not is_transient_error(e) or failures > POLL_MAX_RETRIES:
+                    raise
+                # 退避等待计入下一次轮询间隔
+                interval = max(interval, random.uniform(0, min(POLL_MAX_INTERVAL, self.poll_interval * 2 ** failures)))
+        if prediction["status"] != "succeeded":
+            raise PredictionFailed(
+                f"预测 {prediction.get('id')} {prediction['status']}: {prediction.get('error')}", prediction
+            )
+        return prediction
+
+    async def cancel_prediction(self, prediction: Dict[str, Any]):
+        """尽力取消远程预测（对冲落败、超时放弃时不再为其计费）；失败忽略"""
+        cancel_url = (prediction.get("urls") or {}).get("cancel") or f"/v1/predictions/{prediction['id']}/cancel"
+        try:
+            await asyncio.wait_for(self._request("POST", cancel_url), CANCEL_TIMEOUT)
+        except Exception:
+            pass
+
+    async def run(self, model: str, model_input: Dict[str, Any]) -> Any:
+        """
+        创建预测并等待完成，返回 output；未以终态结束就退出（轮询出错、超时、被取消）时同时取消远程预测，
+        上层重试再创建预测时不会留下一个仍在计费的旧预测
+        """
+        prediction = await self.create_prediction(model, model_input)
+        try:
+            prediction = await self.wait_prediction(prediction)
+        except BaseException as e:
+            last = e.prediction if isinstance(e, PredictionFailed) and e.prediction else prediction
+            if last.get("status") not in TERMINAL_STATUSES:
+                await self.cancel_prediction(prediction)
+            raise
+        return prediction.get("output")
+
+    async def download(self, url: str, out_path: str) -> str:
+        """流式下载到 out_path（先写临时文件，完成后原子替换）"""
+        try:
+            await self.downloader.to_file(url, out_path)
+        except DownloadError as e:
+            raise ReplicateAPIError(str(e)) from e
+        return out_path
+
+    async def download_bytes(self, url: str) -> bytes:
+        """下载到内存"""
+        try:
+            return await self.downloader.to_bytes(url)
+        except DownloadError as e:
+            raise ReplicateAPIError(str(e)) from e
+
+    async def download_image(self, url: str, out_path: Optional[str] = None) -> Image.Image:
+        """边下载边解码为 PIL 图像（给出 out_path 时同时写盘），省去落盘后再 Image.open"""
+        try:
+            return await self.downloader.to_image(url, out_path)
+        except DownloadError as e:
+            raise ReplicateAPIError(str(e)) from e
+
+
+@asynccontextmanager
+async def client_scope(client: Optional[AsyncReplicateClient] = None) -> AsyncIterator[AsyncReplicateClient]:
+    """
+    传入的客户端原样使用（由调用方关闭）；未传入时临时创建并在结束时关闭
+    临时客户端使用共享的上传登记表，重试与重跑时复用仍有效的上传 URL
+    """
+    if client is not None:
+        yield client
+        return
+    from upload_registry import get_upload_registry
+    async with AsyncReplicateClient(upload_registry=get_upload_registry()) as owned:
+        yield owned
+
+
+async def download_url_async(url: str, out_path: str,
+                             client: Optional[AsyncReplicateClient] = None) -> str:
+    """流式下载结果文件（下载不需要令牌）"""
+    if client is not None:
+        return await client.download(url, out_path)
+    async with StreamingDownloader() as downloader:
+        await downloader.to_file(url, out_path)
+    return out_path
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 """Replicate 工具：上传文件、下载输出等"""
+import asyncio
 import os
-import urllib.request
 
 from dotenv import load_dotenv
 
@@ -9,6 +9,8 @@ load_dotenv()
 
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 BG_REMOVER_VERSION = "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc"
+# 上传前长边上限（像素）：去背景输出与输入同尺寸，2048 已远超 nano-banana 输出分辨率
+BG_REMOVER_MAX_SIDE = 2048
 
 
 def ensure_token():
@@ -17,7 +19,7 @@ def ensure_token():
 
 
 def download_url(url: str, out_path: str) -> str:
-    """从 URL 下载文件到本地"""
-    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
-    urllib.request.urlretrieve(url, out_path)
-    return out_path
+    """从 URL 下载文件到本地（replicate_async.download_url_async 的同步封装）"""
+    from replicate_async import download_url_async
+
+    return asyncio.run(download_url_async(url, out_path))
@@ -1,12 +1,24 @@
 # -*- coding: utf-8 -*-
 """
-背景去除：使用 851-labs/background-remover 去除原图背景。
-用法: python run_background_removal.py <原图路径> [--out 输出路径]
+背景去除：使用 851-labs/background-remover 去除原图背景（--backend local / fake 改用离线后端）。
+用法: python run_background_removal.py <原图路径> [--out 输出路径] [--backend replicate|local|fake] [--refresh-cache]
 """
 import argparse
+import asyncio
+import hashlib
 import os
+from typing import TYPE_CHECKING, Optional
 
-from replicate_utils import BG_REMOVER_VERSION, download_url, ensure_token
+from remote_policy import Admission, RetryPolicy, call_with_policy
+from remote_scheduler import Priority, get_scheduler
+from replicate_async import AsyncReplicateClient, client_scope, extract_output_url
+from remote_result_cache import RemoteResultCache, build_result_key, get_result_cache
+from replicate_utils import BG_REMOVER_MAX_SIDE, BG_REMOVER_VERSION
+from streaming_download import write_file_atomic
+from upload_prepare import prepare_upload, resolve_max_side
+
+if TYPE_CHECKING:
+    from matting_backend import MattingBackend
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -17,10 +29,65 @@ def _resolve(path: str) -> str:
     return os.path.join(PROJECT_ROOT, path)
 
 
-def run_background_removal(image_path: str, out_path: str = None) -> str:
-    import replicate
+async def remove_background_bytes(content: bytes, client: Optional[AsyncReplicateClient] = None,
+                                  result_cache: Optional[RemoteResultCache] = None,
+                                  filename: str = "input.png",
+                                  policy: Optional[RetryPolicy] = None,
+                                  priority: Optional[Priority] = None,
+                                  refresh: bool = False) -> bytes:
+    """
+    内存版去背景：输入文件字节 -> 上传前缩小（长边 BG_REMOVER_MAX_SIDE）-> 上传 -> 预测 -> 下载到内存，
+    返回结果 PNG 字节（尺寸与缩小后的上传图一致）
+    result_cache 为空时使用共享的结果缓存：相同输入字节直接取缓存结果，不访问网络；
+    refresh=True 时不读缓存、重新调用并覆盖条目
+    上传 -> 预测 -> 下载整体按 policy（默认 resolve_retry_policy()）限时、重试与对冲；
+    每个请求（上传 -> 预测 -> 下载）先经全局调度器（令牌桶、并发上限）按 priority（默认取 REMOTE_PRIORITY）排队，
+    排队时间不计入尝试时限；调度器有排队者时不对冲
+    """
+    max_side = resolve_max_side(BG_REMOVER_MAX_SIDE)
+    cache = result_cache or get_result_cache()
+    cache_key = build_result_key(hashlib.sha256(content).hexdigest(), BG_REMOVER_VERSION,
+                                 params={"background": "rgba", "max_side": max_side})
+    # 缓存文件读写是阻塞 I/O，放到线程中，不阻塞共用事件循环的其他宠物
+    cached = None if refresh else await asyncio.to_thread(cache.get_bytes, cache_key)
+    if cached is not None:
+        return cached
+
+    prepared = await asyncio.to_thread(prepare_upload, content, max_side)
+    if prepared.scale < 1.0:
+        print(f"上传前缩小: {prepared.original_size[0]}x{prepared.original_size[1]} -> "
+              f"{prepared.size[0]}x{prepared.size[1]}（{prepared.format}, {len(prepared.content) / 1024:.0f}KB）")
+
+    async def attempt() -> bytes:
+        async with client_scope(client) as replicate:
+            output = await replicate.run_with_upload(
+                BG_REMOVER_VERSION, prepared.content, prepared.filename(os.path.splitext(filename)[0]),
+                prepared.content_type,
+                lambda url: {
+                    "image": url,
+                    "background": "rgba",
+                },
+            )
+            return await replicate.download_bytes(extract_output_url(output))
+
+    # 每个请求（含重试、对冲）先经全局调度器排队，排队时间不计入尝试时限
+    scheduler = get_scheduler()
+    admission = Admission(lambda: scheduler.slot(BG_REMOVER_VERSION, priority), scheduler.has_waiters)
+    result = await call_with_policy("background_removal", attempt, policy, admission=admission)
+    await asyncio.to_thread(cache.put_bytes, cache_key, result)
+    return result
 
-    ensure_token()
+
+async def run_background_removal_async(image_path: str, out_path: str = None,
+                                       client: Optional[AsyncReplicateClient] = None,
+                                       result_cache: Optional[RemoteResultCache] = None,
+                                       backend: Optional["MattingBackend"] = None,
+                                       refresh: bool = False) -> str:
+    """
+    异步去背景：读入原图 -> backend.remove_background -> 写出 out_path
+    backend 为空时直接走 Replicate（remove_background_bytes），client 为空时临时创建；
+    refresh=True 时不读结果缓存，重新调用并覆盖条目
+    """
     image_path = _resolve(image_path)
     if not os.path.isfile(image_path):
         raise FileNotFoundError(f"原图不存在: {image_path}")
@@ -28,35 +95,40 @@ def run_background_removal(image_path: str, out_path: str = None) -> str:
     if out_path is None:
         out_path = os.path.join(PROJECT_ROOT, "output", "no_bg.png")
     out_path = _resolve(out_path)
-    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
 
     with open(image_path, "rb") as f:
-        output = replicate.run(
-            BG_REMOVER_VERSION,
-            input={
-                "image": f,
-                "background": "rgba",
-            },
-        )
-
-    if isinstance(output, str):
-        url = output
-    elif hasattr(output, "url"):
-        url = output.url
+        content = f.read()
+    if backend is not None:
+        result = await backend.remove_background(content, filename=os.path.basename(image_path))
     else:
-        url = str(output)
+        result = await remove_background_bytes(content, client=client, result_cache=result_cache,
+                                               filename=os.path.basename(image_path), refresh=refresh)
+    write_file_atomic(out_path, result)
 
-    download_url(url, out_path)
     print(f"已去除背景: {out_path}")
     return out_path
 
 
+def run_background_removal(image_path: str, out_path: str = None,
+                           backend: Optional["MattingBackend"] = None) -> str:
+    """run_background_removal_async 的同步封装（Replicate 后端未命中结果缓存时才需要令牌）"""
+    return asyncio.run(run_background_removal_async(image_path, out_path, backend=backend))
+
+
 def main():
     parser = argparse.ArgumentParser(description="去除图像背景（851-labs/background-remover）")
     parser.add_argument("image", help="原图路径")
     parser.add_argument("--out", "-o", default=None, help="输出路径")
+    parser.add_argument("--backend", choices=["replicate", "local", "fake"], default=None,
+                        help="抠图后端（默认取环境变量 MATTING_BACKEND，未设置为 replicate）")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="不读远程结果缓存，重新调用模型并覆盖缓存条目（对结果不满意时重跑）")
     args = parser.parse_args()
-    run_background_removal(args.image, args.out)
+    from matting_backend import create_backend, with_refresh
+
+    backend = create_backend(args.backend)
+    run_background_removal(args.image, args.out,
+                           backend=with_refresh(backend) if args.refresh_cache else backend)
 
 
 if __name__ == "__main__":
@@ -8,7 +8,7 @@ import argparse
 import os
 import sys
 from PIL import Image
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 # 统一使用 UTF-8，避免中文路径与打印乱码
 if hasattr(sys.stdout, "reconfigure"):
@@ -24,106 +24,114 @@ for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
         sys.path.insert(0, path)
 
 from state_manager import StateManager
-from utils.multi_pet_layout import create_multi_pet_layout, PetLayout
-from utils.visual_center import compute_visual_center
+from utils.multi_pet_layout import PetLayout
+from utils.layout_cache import get_layout_cache
 from utils.matting_validation import validate_all_pet_mattings
-from utils.multi_pet_enhancement import is_circular_template
+from utils.template_registry import get_template_descriptor
+from utils.compositor import PetPlacement, get_compositor
+from utils.pet_transform import compute_layout_transform
+from utils.pet_cutout import PetCutout, PetImageLike, as_cutout
+from utils.parallel import parallel_map
+from utils.processing_cache import ProcessingCache
 from skills.multi_pet_composition_enhancement import MultiPetCompositionEnhancementSkill
 
 
-def load_extracted_images(session_id: str, pet_ids: List[str]) -> List[Image.Image]:
-    """加载所有宠物的抠图结果"""
+# 布局缓存持久化文件（跨会话复用相同模板 + 相近宠物形状的布局）
+LAYOUT_CACHE_PATH = os.path.join("sessions", "layout_cache.json")
+
+
+def _load_extracted_image(image_path: str) -> Image.Image:
+    """解码单只宠物的抠图结果并统一为 RGBA"""
+    image = Image.open(image_path)
+    # 确保转换为RGBA模式（如果原图是RGB，添加完全不透明的alpha通道）
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    else:
+        image.load()
+    return image
+
+
+def load_extracted_images(session_id: str, pet_ids: List[str],
+                          max_workers: Optional[int] = None) -> List[Image.Image]:
+    """加载所有宠物的抠图结果（逐宠物并行解码，按 pet_ids 顺序返回）"""
     extracted_dir = os.path.join("sessions", session_id, "extracted")
-    images = []
+    image_paths = []
 
     for pet_id in pet_ids:
         image_path = os.path.join(extracted_dir, f"{pet_id}_extracted.png")
         if not os.path.exists(image_path):
             raise FileNotFoundError(f"找不到宠物 {pet_id} 的抠图结果: {image_path}")
+        image_paths.append(image_path)
 
-        image = Image.open(image_path)
-        # 确保转换为RGBA模式（如果原图是RGB，添加完全不透明的alpha通道）
-        if image.mode == 'RGB':
-            # RGB转RGBA：添加完全不透明的alpha通道
-            image = image.convert('RGBA')
-        elif image.mode != 'RGBA':
-            image = image.convert('RGBA')
-        
-        images.append(image)
+    images = parallel_map(_load_extracted_image, image_paths, max_workers=max_workers)
+    for pet_id, image in zip(pet_ids, images):
         print(f"加载宠物 {pet_id} 抠图结果: {image.size}, 模式: {image.mode}")
 
     return images
 
 
 def composite_multi_pets(template_path: str,
-                        pet_images: List[Image.Image],
+                        pet_images: List[PetImageLike],
                         layouts: List[PetLayout]) -> Image.Image:
     """
-    将多只宠物合成到模板中
+    将多只宠物合成到模板中（预乘 alpha 合成器：只在宠物 ROI 内混合，亚像素定位）
+    pet_images 可为 RGBA 或 PetCutout，统一裁剪到内容后只处理可见主体
     """
-    # 打开模板
-    template = Image.open(template_path).convert("RGBA")
-    template_width, template_height = template.size
+    # 模板缓冲由合成器按模板缓存复用（不再重复解码）
+    compositor = get_compositor(template_path)
+    template_width, template_height = compositor.size
 
-    print(f"模板尺寸: {template.size}")
+    print(f"模板尺寸: {compositor.size}")
 
-    # 创建结果图像
-    result = Image.new("RGBA", (template_width, template_height), (0, 0, 0, 0))
-    result.paste(template, (0, 0))
-
-    # 为每只宠物合成
+    placements = []
     for i, (pet_image, layout) in enumerate(zip(pet_images, layouts)):
         print(f"合成宠物 {layout.id}: 锚点{layout.anchor}, 缩放{layout.scale}")
 
-        # 确保图像是RGBA模式
-        if pet_image.mode != 'RGBA':
-            pet_image = pet_image.convert('RGBA')
-
-        # 缩放宠物图像
-        scaled_width = int(pet_image.width * layout.scale)
-        scaled_height = int(pet_image.height * layout.scale)
+        # 裁剪到内容（原帧尺寸与偏移保留在 PetCutout 中）
+        cutout = as_cutout(pet_image)
 
-        if scaled_width > 0 and scaled_height > 0:
-            scaled_pet = pet_image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS)
+        # 缩放后尺寸（小数，缩放在合成时一次完成）
+        scaled_width = cutout.width * layout.scale
+        scaled_height = cutout.height * layout.scale
 
-            # 计算缩放后的视觉中心（必须先缩放再计算）
-            cx_scaled, cy_scaled = compute_visual_center(scaled_pet)
+        if scaled_width >= 1 and scaled_height >= 1:
+            # 视觉中心（原帧坐标）在裁剪区域上计算后按 scale 映射（等价于缩放后再计算）
+            cx, cy = cutout.visual_center()
+            cx_scaled, cy_scaled = cx * layout.scale, cy * layout.scale
 
-            # 计算粘贴位置（以视觉中心对齐到锚点）
             # 锚点坐标是相对坐标(0-1)，需要转换为像素坐标
             anchor_x_px = layout.anchor[0] * template_width
             anchor_y_px = layout.anchor[1] * template_height
-            
-            # 粘贴位置 = 锚点位置 - 缩放后的视觉中心
-            paste_x = int(anchor_x_px - cx_scaled)
-            paste_y = int(anchor_y_px - cy_scaled)
-
-            # 确保粘贴位置在合理范围内（允许部分超出，但至少有一部分在画布内）
-            # 如果完全超出画布，调整到画布边缘
-            if paste_x + scaled_width < 0:
-                paste_x = -scaled_width + 10  # 至少露出10像素
-            if paste_x > template_width:
-                paste_x = template_width - 10
-            if paste_y + scaled_height < 0:
-                paste_y = -scaled_height + 10
-            if paste_y > template_height:
-                paste_y = template_height - 10
-
-            # 粘贴到结果图（使用alpha通道进行合成）
-            result.paste(scaled_pet, (paste_x, paste_y), scaled_pet)
-
-            print(f"  原始尺寸: {pet_image.size}, 缩放后尺寸: {scaled_pet.size}")
+
+            # 放置位置 = 锚点位置 - 缩放后的视觉中心（保留小数，允许部分超出画布）
+            transform = compute_layout_transform(
+                (cx, cy), cutout.size, layout.scale, layout.anchor, compositor.size
+            )
+            placements.append(PetPlacement(cutout.image, cutout.frame_transform().then(transform)))
+            offset = transform.offset
+
+            print(f"  原始尺寸: {cutout.size}, 裁剪后: {cutout.image.size}, 缩放后尺寸: ({scaled_width:.1f}, {scaled_height:.1f})")
             print(f"  视觉中心(缩放后): ({cx_scaled:.1f}, {cy_scaled:.1f})")
             print(f"  锚点像素位置: ({anchor_x_px:.1f}, {anchor_y_px:.1f})")
-            print(f"  粘贴位置: ({paste_x}, {paste_y})")
+            print(f"  放置位置: ({offset[0]:.2f}, {offset[1]:.2f})")
 
-    return result
+    return compositor.render(placements)
 
 
-def run_multi_pet_composition(session_id: str, use_state_layout: bool = False) -> str:
+def run_multi_pet_composition(session_id: str, use_state_layout: bool = False,
+                              optimize_budget_ms: Optional[float] = None,
+                              optimize_seed: int = 0,
+                              optimize_iterations: Optional[int] = None,
+                              max_workers: Optional[int] = None,
+                              extracted_images: Optional[List[Image.Image]] = None) -> str:
     """
     执行多宠物合成
     use_state_layout: 为 True 时从 state.pets 的 anchor/scale 构建布局（布局调整后重合成时使用）
+    optimize_budget_ms: 设置时自动布局交给布局优化器整体搜索（预算折算为迭代数，optimize_seed 与迭代数决定结果）
+    optimize_iterations: 布局优化器迭代数（None 时由 optimize_budget_ms 折算）
+    max_workers: 逐宠物解码 / 校验 / 边缘处理的线程数上限（None 按 CPU 数，1 为串行）
+    extracted_images: 内存交接模式下抠图步骤直接给出的 RGBA 结果（与 state.pets 顺序一致），
+        提供时不再从 extracted/ 重新解码
     返回合成结果路径
     """
     state_manager = StateManager()
@@ -137,31 +145,34 @@ def run_multi_pet_composition(session_id: str, use_state_layout: bool = False) -
 
     print(f"开始多宠物合成: {len(state.pets)} 只宠物")
 
-    # 加载宠物抠图结果
+    # 加载宠物抠图结果，并裁剪到内容（后续校验、边缘处理、布局、合成只处理可见主体）
     pet_ids = [pet.id for pet in state.pets]
-    pet_images = load_extracted_images(session_id, pet_ids)
+    if extracted_images is None:
+        extracted_images = load_extracted_images(session_id, pet_ids, max_workers=max_workers)
+    elif len(extracted_images) != len(pet_ids):
+        raise ValueError(f"抠图结果数量 {len(extracted_images)} 与宠物数量 {len(pet_ids)} 不一致")
+    pet_images = parallel_map(PetCutout.from_image, extracted_images, max_workers=max_workers)
+
+    # 模板描述（尺寸、是否圆形）只计算一次，后续合成复用
+    descriptor = get_template_descriptor(state.template)
+
+    # 校验 / 边缘处理结果按抠图内容哈希缓存在会话目录：只改布局、文字的重合成直接复用
+    processing_cache = ProcessingCache.for_session(session_id)
 
     # 抠图结果有效性校验（升级方案 模块一）：任一失败即中断，不继续合成
-    for_circle = is_circular_template(state.template)
+    for_circle = descriptor.is_circular
     all_valid, validation_results = validate_all_pet_mattings(
-        pet_images, pet_ids, for_circular_template=for_circle
+        pet_images, pet_ids, for_circular_template=for_circle, max_workers=max_workers,
+        cache=processing_cache
     )
     if not all_valid:
         failed = [r for r in validation_results if not r.valid]
         msg = "抠图结果校验失败，已中断多宠物合成。\n"
         for r in failed:
-            msg += f"  - {r.pet_id}: {r.reason}\n"
+            msg += f"  - {r.pet_id}: {r.reason}（{r.tier}）\n"
         msg += "请重新抠图或降级为单宠物流程。"
         raise ValueError(msg)
 
-    # 获取模板尺寸
-    template = Image.open(state.template)
-    template_size = template.size
-    template.close()
-
-    # 获取宠物图像尺寸
-    pet_sizes = [(img.width, img.height) for img in pet_images]
-
     # 布局：优先使用 state 中用户自定义的 anchor/scale（布局调整场景）
     if use_state_layout and state.pets:
         layouts = [
@@ -169,18 +180,15 @@ def run_multi_pet_composition(session_id: str, use_state_layout: bool = False) -
             for p in state.pets
         ]
         print("使用 state 中的布局参数:")
+        for layout in layouts:
+            print(f"  {layout.id}: 锚点{layout.anchor}, 缩放{layout.scale}")
     else:
-        layouts = create_multi_pet_layout(template_size, len(state.pets), pet_sizes)
-        # 将布局 id 对齐到 state.pets（pet_0->pet_a 等）
-        for layout, pet in zip(layouts, state.pets):
-            layout.id = pet.id
-        print("自动布局结果:")
-
-    for layout in layouts:
-        print(f"  {layout.id}: 锚点{layout.anchor}, 缩放{layout.scale}")
+        # 自动布局交给增强技能（alpha 占用网格防遮挡）；形状相近的订单直接命中布局缓存
+        layouts = None
 
     # 使用增强技能进行合成（按照文档要求的10步流程）
     print("\n应用多宠物合成增强...")
+    layout_cache = get_layout_cache(persist_path=LAYOUT_CACHE_PATH)
     enhancement_skill = MultiPetCompositionEnhancementSkill()
     result_image = enhancement_skill.enhance_composition(
         pet_images=pet_images,
@@ -191,9 +199,24 @@ def run_multi_pet_composition(session_id: str, use_state_layout: bool = False) -
         enable_stroke=False,  # 默认关闭，可根据需要开启
         enable_visual_normalization=not use_state_layout,
         enable_group_alignment=not use_state_layout,
-        use_state_layout=use_state_layout
+        use_state_layout=use_state_layout,
+        optimize_budget_ms=optimize_budget_ms,
+        optimize_seed=optimize_seed,
+        optimize_iterations=optimize_iterations,
+        layout_cache=layout_cache,
+        max_workers=max_workers,
+        processing_cache=processing_cache
     )
+
+    if layouts is None:
+        # 将布局 id 对齐到 state.pets（pet_0->pet_a 等）
+        for layout, pet in zip(enhancement_skill.last_layouts, state.pets):
+            layout.id = pet.id
+        print(f"自动布局结果（布局缓存 命中 {layout_cache.hits} / 未命中 {layout_cache.misses}）:")
+        for layout in enhancement_skill.last_layouts:
+            print(f"  {layout.id}: 锚点{layout.anchor}, 缩放{layout.scale}")
     
+    print(f"校验 / 边缘处理缓存: 命中 {processing_cache.hits} / 未命中 {processing_cache.misses}")
     print("增强合成完成")
 
     # 保存结果
@@ -210,10 +233,21 @@ def main():
     parser.add_argument("session_id", help="会话ID")
     parser.add_argument("--use-state-layout", action="store_true",
                         help="使用 state 中每只宠物的 anchor/scale 作为布局（布局调整后重合成时使用）")
+    parser.add_argument("--optimize-budget-ms", type=float, default=None,
+                        help="启用布局优化器并设置耗时预算（毫秒，折算为迭代数）")
+    parser.add_argument("--optimize-seed", type=int, default=0, help="布局优化器随机种子")
+    parser.add_argument("--optimize-iterations", type=int, default=None,
+                        help="布局优化器迭代数（默认由 --optimize-budget-ms 折算）")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="逐宠物解码 / 校验 / 边缘处理的线程数上限（默认按 CPU 数，1 为串行）")
     args = parser.parse_args()
 
     try:
-        output_path = run_multi_pet_composition(args.session_id, use_state_layout=args.use_state_layout)
+        output_path = run_multi_pet_composition(
+            args.session_id, use_state_layout=args.use_state_layout,
+            optimize_budget_ms=args.optimize_budget_ms, optimize_seed=args.optimize_seed,
+            optimize_iterations=args.optimize_iterations, max_workers=args.workers
+        )
         print(f"合成结果: {output_path}")
     except Exception as e:
         print(f"合成失败: {e}")
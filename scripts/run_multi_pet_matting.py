@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 """
 多宠物抠图：支持对多只宠物进行批量抠图
-用法: python run_multi_pet_matting.py <session_id>
+用法: python run_multi_pet_matting.py <session_id> [--in-memory] [--backend replicate|local|fake]
+      [--priority interactive|batch] [--refresh-cache]
 """
 import argparse
+import asyncio
+import io
 import os
+import shutil
 import sys
-from typing import List
+from typing import List, Optional, Tuple
 
 # 统一使用 UTF-8，避免中文路径与打印乱码
 if hasattr(sys.stdout, "reconfigure"):
@@ -22,11 +26,60 @@ for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
         sys.path.insert(0, path)
 
 from state_manager import StateManager
+from matting_backend import (MattingBackend, ReplicateMattingBackend, backend_scope, create_backend,
+                             resolve_backend_name, with_refresh)
+from remote_policy import format_call_metrics, get_call_metrics
+from remote_scheduler import format_scheduler_stats, get_scheduler, resolve_priority
 from run_background_removal import run_background_removal
-from run_pet_image_matting import run_matting
+from run_pet_image_matting import ensure_rgba, run_matting
 from PIL import Image
 import numpy as np
 from utils.visual_center import compute_visual_center
+from utils.pet_transform import compute_square_padding
+from utils.parallel import parallel_map, resolve_workers
+from utils.artifact_writer import ArtifactWriter
+from utils.edge_quality import assess_edge_quality
+
+# 同时进行抠图链的宠物数上限（每条链 3 次远程调用，受 Replicate 并发限制）
+MATTING_MAX_WORKERS = 4
+# 步骤3结果非透明像素占比低于该值视为几乎完全透明，以步骤2结果兜底
+MIN_OPAQUE_RATIO = 0.01
+
+
+def square_image_1to1(img: Image.Image) -> Optional[Image.Image]:
+    """
+    将 RGBA 图像调整为1:1比例（正方形）
+    使用视觉中心（而非边界框中心）来对齐，确保宠物头部在正方形中心
+    图像完全透明时返回 None
+    """
+    data = np.array(img)
+
+    # 找到非透明像素的边界框
+    alpha_channel = data[:, :, 3]
+    non_transparent = np.where(alpha_channel > 0)
+
+    if len(non_transparent[0]) == 0:
+        return None
+
+    min_y, max_y = non_transparent[0].min(), non_transparent[0].max()
+    min_x, max_x = non_transparent[1].min(), non_transparent[1].max()
+
+    # 计算视觉中心（基于alpha通道加权的质心，更能反映宠物头部的实际中心）
+    visual_center_x, visual_center_y = compute_visual_center(img)
+
+    # 正方形边长 = 非透明区域最大边；补边只是整数平移（不重采样），记录为变换链的第一段
+    square_size, padding = compute_square_padding(
+        img.size,
+        (int(min_x), int(min_y), int(max_x) + 1, int(max_y) + 1),
+        (visual_center_x, visual_center_y)
+    )
+    paste_x, paste_y = int(padding.tx), int(padding.ty)
+
+    # 创建正方形画布（透明背景），将原图原样拷贝到正方形画布上（视觉中心对齐画布中心）
+    # 画布全透明，直接拷贝即可；带 mask 粘贴会把半透明毛边的 alpha 平方、颜色变暗
+    square_img = Image.new('RGBA', (square_size, square_size), (0, 0, 0, 0))
+    square_img.paste(img, (paste_x, paste_y))
+    return square_img
 
 
 def make_square_1to1(image_path: str, out_path: str = None) -> str:
@@ -44,72 +97,257 @@ def make_square_1to1(image_path: str, out_path: str = None) -> str:
     img = Image.open(image_path)
     if img.mode != 'RGBA':
         img = img.convert('RGBA')
-    
-    data = np.array(img)
-    
-    # 找到非透明像素的边界框
-    alpha_channel = data[:, :, 3]
-    non_transparent = np.where(alpha_channel > 0)
-    
-    if len(non_transparent[0]) == 0:
+
+    square_img = square_image_1to1(img)
+    if square_img is None:
         # 如果没有非透明像素，直接返回原图
         print(f"  警告: 图像完全透明，跳过1:1调整")
         if out_path and out_path != image_path:
             img.save(out_path, "PNG")
             return out_path
         return image_path
-    
-    min_y, max_y = non_transparent[0].min(), non_transparent[0].max()
-    min_x, max_x = non_transparent[1].min(), non_transparent[1].max()
-    
-    # 计算边界框的宽度和高度
-    bbox_width = max_x - min_x + 1
-    bbox_height = max_y - min_y + 1
-    
-    # 使用最大边作为正方形的边长
-    square_size = max(bbox_width, bbox_height)
-    
-    # 计算视觉中心（基于alpha通道加权的质心，更能反映宠物头部的实际中心）
-    visual_center_x, visual_center_y = compute_visual_center(img)
-    
-    # 创建正方形画布（透明背景）
-    square_img = Image.new('RGBA', (square_size, square_size), (0, 0, 0, 0))
-    
-    # 计算在新画布中的粘贴位置（使视觉中心对齐到画布中心）
-    # 新画布中心位置
-    square_center_x = square_size / 2
-    square_center_y = square_size / 2
-    
-    # 计算粘贴位置：使视觉中心对齐到画布中心
-    paste_x = int(square_center_x - visual_center_x)
-    paste_y = int(square_center_y - visual_center_y)
-    
-    # 确保粘贴位置不会超出画布（允许部分超出，但至少有一部分在画布内）
-    if paste_x + img.width < 0:
-        paste_x = -img.width + 10
-    if paste_x > square_size:
-        paste_x = int(square_size - 10)
-    if paste_y + img.height < 0:
-        paste_y = -img.height + 10
-    if paste_y > square_size:
-        paste_y = int(square_size - 10)
-    
-    # 将原图粘贴到正方形画布上
-    square_img.paste(img, (paste_x, paste_y), img)
-    
+
     # 保存结果
     if out_path is None:
         out_path = image_path
     
     square_img.save(out_path, "PNG")
-    print(f"  步骤4完成: 已调整为1:1比例 ({square_size}x{square_size})，视觉中心对齐")
+    print(f"  步骤4完成: 已调整为1:1比例 ({square_img.width}x{square_img.height})，视觉中心对齐")
     return out_path
 
 
-def run_multi_pet_matting(session_id: str) -> List[str]:
+def opaque_ratio(image: Image.Image) -> float:
+    """RGBA 图像中非透明像素的占比"""
+    alpha = np.asarray(image.getchannel("A"))
+    return float(np.count_nonzero(alpha)) / alpha.size
+
+
+def should_skip_step3(pet_id: str, matting_image: Image.Image, log) -> bool:
+    """步骤2结果边缘已干净（无白边、无碎片、alpha 双峰）时跳过步骤3；检查出错时照常执行步骤3"""
+    try:
+        quality = assess_edge_quality(matting_image, pet_id)
+    except Exception as e:
+        log(f"  步骤3执行: 边缘质量检查出错（{e}）")
+        return False
+    if quality.clean:
+        log(f"  步骤3跳过: 步骤2边缘已干净（{quality.summary()}）")
+        return True
+    log(f"  步骤3执行: {quality.reason}（{quality.summary()}）")
+    return False
+
+
+def matting_pipeline_for_pet(pet, extracted_dir: str, adaptive_step3: bool = True,
+                             backend: Optional[MattingBackend] = None) -> str:
     """
-    对会话中的所有宠物进行抠图
-    返回抠图结果路径列表
+    单只宠物的抠图链（步骤顺序固定）：去背景 -> 抠出主体 -> 再次去背景 -> 1:1
+    步骤1、2失败直接抛出；步骤3失败或结果几乎完全透明时以步骤2结果兜底
+    adaptive_step3=True 时步骤2边缘已干净则跳过步骤3（省一次远程调用）
+    backend 为空时直接走 Replicate
+    返回抠图结果路径
+    """
+    # 多只宠物并行时输出交错，每行带宠物 ID
+    def log(message: str):
+        print(f"[{pet.id}] {message}")
+
+    log(f"处理宠物 {pet.id}: {pet.image}")
+
+    # 步骤1: 去除背景
+    no_bg_filename = f"{pet.id}_no_bg.png"
+    no_bg_path = os.path.join(extracted_dir, no_bg_filename)
+    log(f"  步骤1: 去除背景 -> {no_bg_path}")
+    try:
+        no_bg_path = run_background_removal(pet.image, no_bg_path, backend=backend)
+        log(f"  步骤1完成: 背景已去除")
+    except Exception as e:
+        log(f"  步骤1失败: {e}")
+        raise
+
+    # 步骤2: 抠出主体（使用去背景后的图）
+    matting_output_filename = f"{pet.id}_matting_temp.png"
+    matting_output_path = os.path.join(extracted_dir, matting_output_filename)
+    log(f"  步骤2: 抠出主体 -> {matting_output_path}")
+    try:
+        matting_result_path = run_matting(
+            image_path=no_bg_path,  # 使用去背景后的图
+            pet_type=pet.crop_mode,
+            out_path=matting_output_path,
+            backend=backend,
+        )
+        log(f"  步骤2完成: 主体已抠出")
+    except Exception as e:
+        log(f"  步骤2失败: {e}")
+        raise
+
+    # 步骤3: 再次去除背景（确保边缘干净，方便最终本地图层合并）
+    output_filename = f"{pet.id}_extracted.png"
+    output_path = os.path.join(extracted_dir, output_filename)
+    skip_step3 = False
+    if adaptive_step3:
+        # 句柄在检查后立即关闭：同一文件随后会被复制或覆盖
+        with Image.open(matting_result_path) as matting_image:
+            skip_step3 = should_skip_step3(pet.id, matting_image, log)
+    if skip_step3:
+        shutil.copy2(matting_result_path, output_path)
+        final_path = output_path
+    else:
+        log(f"  步骤3: 再次去除背景（确保边缘干净） -> {output_path}")
+        try:
+            final_path = run_background_removal(matting_result_path, output_path, backend=backend)
+
+            # 检查结果是否还有内容（防止完全透明）
+            with Image.open(final_path) as result_img:
+                non_transparent_ratio = opaque_ratio(result_img.convert('RGBA'))
+
+            if non_transparent_ratio < MIN_OPAQUE_RATIO:  # 如果非透明像素少于1%
+                log(f"  警告: 第三次去背景后图像几乎完全透明 ({non_transparent_ratio*100:.2f}%)，使用步骤2的结果作为兜底")
+                shutil.copy2(matting_result_path, output_path)
+                final_path = output_path
+            else:
+                log(f"  步骤3完成: 背景已再次去除，边缘已清理（非透明像素: {non_transparent_ratio*100:.2f}%）")
+        except Exception as e:
+            log(f"  步骤3失败: {e}")
+            # 如果第三次去背景失败，使用步骤2的结果作为兜底
+            log(f"  警告: 第三次去背景失败，使用步骤2的结果作为兜底")
+            shutil.copy2(matting_result_path, output_path)
+            final_path = output_path
+
+    # 步骤4: 调整为1:1比例（正方形）
+    log(f"  步骤4: 调整为1:1比例 -> {output_path}")
+    try:
+        final_path = make_square_1to1(final_path, output_path)
+        log(f"  步骤4完成: 已调整为1:1比例")
+    except Exception as e:
+        log(f"  步骤4失败: {e}，使用原图")
+        # 如果调整失败，继续使用原图
+
+    log(f"宠物 {pet.id} 处理完成")
+    return final_path
+
+
+def _pet_image_path(pet) -> str:
+    return pet.image if os.path.isabs(pet.image) else os.path.join(_PROJECT_ROOT, pet.image)
+
+
+def _decode_image(content: bytes) -> Image.Image:
+    """解码去背景结果为 RGBA（与文件模式的 convert('RGBA') 一致）"""
+    image = Image.open(io.BytesIO(content))
+    if image.mode != 'RGBA':
+        return image.convert('RGBA')
+    image.load()
+    return image
+
+
+def _decode_rgba(content: bytes) -> Tuple[Image.Image, bytes]:
+    """解码 nano-banana 结果并按 ensure_rgba 统一；返回 (图像, 对应的 PNG 字节)，本就是 RGBA 时不重新编码"""
+    image = Image.open(io.BytesIO(content))
+    if image.mode == 'RGBA':
+        image.load()
+        return image, content
+    image = ensure_rgba(image)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return image, buffer.getvalue()
+
+
+async def matting_pipeline_in_memory(pet, extracted_dir: str, backend: MattingBackend,
+                                     writer: ArtifactWriter, adaptive_step3: bool = True) -> Image.Image:
+    """
+    单只宠物抠图链的内存交接版本：步骤顺序与兜底规则同 matting_pipeline_for_pet，
+    步骤间直接传递字节 / 解码后的图像，不再写出后重新读入；
+    *_no_bg.png、*_matting_temp.png、*_extracted.png 交给 writer 在后台写出
+    返回 1:1 后的 RGBA 抠图结果
+    """
+    def log(message: str):
+        print(f"[{pet.id}] {message}")
+
+    log(f"处理宠物 {pet.id}: {pet.image}（内存交接）")
+    image_path = _pet_image_path(pet)
+    with open(image_path, "rb") as f:
+        source = f.read()
+
+    # 步骤1: 去除背景
+    no_bg_path = os.path.join(extracted_dir, f"{pet.id}_no_bg.png")
+    log(f"  步骤1: 去除背景 -> {no_bg_path}")
+    try:
+        no_bg = await backend.remove_background(source, filename=os.path.basename(image_path))
+        log(f"  步骤1完成: 背景已去除")
+    except Exception as e:
+        log(f"  步骤1失败: {e}")
+        raise
+    writer.write_bytes(no_bg_path, no_bg)
+
+    # 步骤2: 抠出主体（使用去背景后的图）
+    matting_output_path = os.path.join(extracted_dir, f"{pet.id}_matting_temp.png")
+    log(f"  步骤2: 抠出主体 -> {matting_output_path}")
+    try:
+        raw = await backend.extract_subject(no_bg, pet.crop_mode)
+        matting_image, matting_png = await asyncio.to_thread(_decode_rgba, raw)
+        log(f"  步骤2完成: 主体已抠出")
+    except Exception as e:
+        log(f"  步骤2失败: {e}")
+        raise
+    writer.write_bytes(matting_output_path, matting_png)
+
+    # 步骤3: 再次去除背景（确保边缘干净，方便最终本地图层合并）
+    output_path = os.path.join(extracted_dir, f"{pet.id}_extracted.png")
+    if adaptive_step3 and await asyncio.to_thread(should_skip_step3, pet.id, matting_image, log):
+        final_image = matting_image
+    else:
+        log(f"  步骤3: 再次去除背景（确保边缘干净） -> {output_path}")
+        try:
+            cleaned = await backend.remove_background(matting_png)
+            final_image = await asyncio.to_thread(_decode_image, cleaned)
+            non_transparent_ratio = opaque_ratio(final_image)
+            if non_transparent_ratio < MIN_OPAQUE_RATIO:
+                log(f"  警告: 第三次去背景后图像几乎完全透明 ({non_transparent_ratio*100:.2f}%)，使用步骤2的结果作为兜底")
+                final_image = matting_image
+            else:
+                log(f"  步骤3完成: 背景已再次去除，边缘已清理（非透明像素: {non_transparent_ratio*100:.2f}%）")
+        except Exception as e:
+            log(f"  步骤3失败: {e}")
+            log(f"  警告: 第三次去背景失败，使用步骤2的结果作为兜底")
+            final_image = matting_image
+
+    # 步骤4: 调整为1:1比例（正方形）
+    log(f"  步骤4: 调整为1:1比例 -> {output_path}")
+    try:
+        square_img = await asyncio.to_thread(square_image_1to1, final_image)
+        if square_img is None:
+            log(f"  警告: 图像完全透明，跳过1:1调整")
+        else:
+            final_image = square_img
+            log(f"  步骤4完成: 已调整为1:1比例 ({square_img.width}x{square_img.height})")
+    except Exception as e:
+        log(f"  步骤4失败: {e}，使用原图")
+    writer.write_image(output_path, final_image)
+
+    log(f"宠物 {pet.id} 处理完成")
+    return final_image
+
+
+async def _run_pets_in_memory(pets, extracted_dir: str, max_workers: Optional[int],
+                              adaptive_step3: bool = True,
+                              backend: Optional[MattingBackend] = None) -> List[Image.Image]:
+    """所有宠物的抠图链共用一个事件循环与一个后端（Replicate 后端共用一个客户端），同时进行的链数受 max_workers 限制"""
+    semaphore = asyncio.Semaphore(resolve_workers(len(pets), max_workers))
+    with ArtifactWriter() as writer:
+        async with backend_scope(backend) as active:
+            async def one(pet):
+                async with semaphore:
+                    return await matting_pipeline_in_memory(pet, extracted_dir, active, writer,
+                                                            adaptive_step3=adaptive_step3)
+            return list(await asyncio.gather(*(one(pet) for pet in pets)))
+
+
+def run_multi_pet_matting_in_memory(session_id: str,
+                                    max_workers: Optional[int] = MATTING_MAX_WORKERS,
+                                    adaptive_step3: bool = True,
+                                    backend: Optional[MattingBackend] = None) -> List[Image.Image]:
+    """
+    内存交接模式的多宠物抠图：返回 RGBA 抠图结果（与 state.pets 顺序一致），
+    可直接交给 run_multi_pet_composition(extracted_images=...)，省去各步骤间的 PNG 编解码往返
+    返回前等待后台写出完成，sessions/<id>/extracted/ 下的产物与文件模式一致
+    backend 为空时按环境变量 MATTING_BACKEND 选择（默认 Replicate）
     """
     state_manager = StateManager()
     state = state_manager.load_state(session_id)
@@ -117,7 +355,51 @@ def run_multi_pet_matting(session_id: str) -> List[str]:
     if not state.pets:
         raise ValueError(f"会话 {session_id} 中没有宠物配置")
 
-    output_paths = []
+    extracted_dir = os.path.join("sessions", session_id, "extracted")
+    os.makedirs(extracted_dir, exist_ok=True)
+
+    print(f"开始为 {len(state.pets)} 只宠物进行抠图（内存交接）...")
+    images = asyncio.run(_run_pets_in_memory(state.pets, extracted_dir, max_workers, adaptive_step3, backend))
+    print(f"所有宠物抠图完成，共 {len(images)} 张结果")
+    _print_call_metrics()
+    return images
+
+
+def _print_call_metrics():
+    """远程调用统计（进程内累计：尝试、重试、对冲、超时与成功耗时分位；调度排队等待）"""
+    for line in format_call_metrics(get_call_metrics()):
+        print(f"远程调用 {line}")
+    for line in format_scheduler_stats(get_scheduler()):
+        print(f"远程调度 {line}")
+
+
+def run_multi_pet_matting(session_id: str, max_workers: Optional[int] = MATTING_MAX_WORKERS,
+                          in_memory: bool = False, adaptive_step3: bool = True,
+                          backend: Optional[MattingBackend] = None,
+                          refresh_results: bool = False) -> List[str]:
+    """
+    对会话中的所有宠物进行抠图
+    每只宠物的抠图链在有界线程池中并行（远程调用等待网络，不占 CPU），链内步骤顺序不变；
+    max_workers=1 为逐只串行；in_memory=True 时改用内存交接模式（见 run_multi_pet_matting_in_memory）；
+    adaptive_step3=False 时无论步骤2边缘质量如何都执行步骤3；
+    backend 为空时按环境变量 MATTING_BACKEND 选择（默认 Replicate）；
+    refresh_results=True 时不读远程结果缓存，重新调用并覆盖条目（nano-banana 是生成式模型，重跑以得到不同结果）
+    返回抠图结果路径列表（与 state.pets 顺序一致）
+    """
+    if refresh_results:
+        backend = with_refresh(backend)
+    if in_memory:
+        state = StateManager().load_state(session_id)
+        run_multi_pet_matting_in_memory(session_id, max_workers=max_workers, adaptive_step3=adaptive_step3,
+                                        backend=backend)
+        extracted_dir = os.path.join("sessions", session_id, "extracted")
+        return [os.path.join(extracted_dir, f"{pet.id}_extracted.png") for pet in state.pets]
+
+    state_manager = StateManager()
+    state = state_manager.load_state(session_id)
+
+    if not state.pets:
+        raise ValueError(f"会话 {session_id} 中没有宠物配置")
 
     # 为每个宠物创建抠图输出目录
     session_dir = os.path.join("sessions", session_id)
@@ -126,101 +408,44 @@ def run_multi_pet_matting(session_id: str) -> List[str]:
 
     print(f"开始为 {len(state.pets)} 只宠物进行抠图...")
 
-    for pet in state.pets:
-        print(f"处理宠物 {pet.id}: {pet.image}")
-        
-        # 步骤1: 去除背景
-        no_bg_filename = f"{pet.id}_no_bg.png"
-        no_bg_path = os.path.join(extracted_dir, no_bg_filename)
-        print(f"  步骤1: 去除背景 -> {no_bg_path}")
-        try:
-            no_bg_path = run_background_removal(pet.image, no_bg_path)
-            print(f"  步骤1完成: 背景已去除")
-        except Exception as e:
-            print(f"  步骤1失败: {e}")
-            raise
-        
-        # 步骤2: 抠出主体（使用去背景后的图）
-        matting_output_filename = f"{pet.id}_matting_temp.png"
-        matting_output_path = os.path.join(extracted_dir, matting_output_filename)
-        print(f"  步骤2: 抠出主体 -> {matting_output_path}")
-        try:
-            matting_result_path = run_matting(
-                image_path=no_bg_path,  # 使用去背景后的图
-                pet_type=pet.crop_mode,
-                out_path=matting_output_path
-            )
-            print(f"  步骤2完成: 主体已抠出")
-        except Exception as e:
-            print(f"  步骤2失败: {e}")
-            raise
-        
-        # 步骤3: 再次去除背景（确保边缘干净，方便最终本地图层合并）
-        output_filename = f"{pet.id}_extracted.png"
-        output_path = os.path.join(extracted_dir, output_filename)
-        print(f"  步骤3: 再次去除背景（确保边缘干净） -> {output_path}")
-        try:
-            final_path = run_background_removal(matting_result_path, output_path)
-            
-            # 检查结果是否还有内容（防止完全透明）
-            result_img = Image.open(final_path)
-            if result_img.mode != 'RGBA':
-                result_img = result_img.convert('RGBA')
-            data = np.array(result_img)
-            non_transparent_pixels = np.sum(data[:, :, 3] > 0)
-            total_pixels = data.shape[0] * data.shape[1]
-            non_transparent_ratio = non_transparent_pixels / total_pixels
-            
-            if non_transparent_ratio < 0.01:  # 如果非透明像素少于1%
-                print(f"  警告: 第三次去背景后图像几乎完全透明 ({non_transparent_ratio*100:.2f}%)，使用步骤2的结果作为兜底")
-                import shutil
-                shutil.copy2(matting_result_path, output_path)
-                final_path = output_path
-            else:
-                print(f"  步骤3完成: 背景已再次去除，边缘已清理（非透明像素: {non_transparent_ratio*100:.2f}%）")
-            
-            # 步骤4: 调整为1:1比例（正方形）
-            print(f"  步骤4: 调整为1:1比例 -> {output_path}")
-            try:
-                final_path = make_square_1to1(final_path, output_path)
-                print(f"  步骤4完成: 已调整为1:1比例")
-            except Exception as e:
-                print(f"  步骤4失败: {e}，使用原图")
-                # 如果调整失败，继续使用原图
-            
-            output_paths.append(final_path)
-        except Exception as e:
-            print(f"  步骤3失败: {e}")
-            # 如果第三次去背景失败，使用步骤2的结果作为兜底
-            print(f"  警告: 第三次去背景失败，使用步骤2的结果作为兜底")
-            import shutil
-            shutil.copy2(matting_result_path, output_path)
-            final_path = output_path
-            
-            # 步骤4: 调整为1:1比例（正方形）
-            print(f"  步骤4: 调整为1:1比例 -> {output_path}")
-            try:
-                final_path = make_square_1to1(final_path, output_path)
-                print(f"  步骤4完成: 已调整为1:1比例")
-            except Exception as e:
-                print(f"  步骤4失败: {e}，使用原图")
-                # 如果调整失败，继续使用原图
-            
-            output_paths.append(final_path)
-        
-        print(f"宠物 {pet.id} 处理完成")
+    # 未指定客户端的 Replicate 后端每次调用临时建客户端，可在各线程各自的事件循环中使用
+    backend = backend or create_backend()
+    output_paths = parallel_map(
+        lambda pet: matting_pipeline_for_pet(pet, extracted_dir, adaptive_step3, backend), state.pets,
+        max_workers=max_workers
+    )
 
     print(f"所有宠物抠图完成，共 {len(output_paths)} 张结果")
+    _print_call_metrics()
     return output_paths
 
 
 def main():
     parser = argparse.ArgumentParser(description="多宠物抠图")
     parser.add_argument("session_id", help="会话ID")
+    parser.add_argument("--workers", type=int, default=MATTING_MAX_WORKERS,
+                        help=f"同时抠图的宠物数上限（默认 {MATTING_MAX_WORKERS}，1 为逐只串行）")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="内存交接模式：步骤间直接传递图像，产物在后台写出")
+    parser.add_argument("--always-step3", action="store_true",
+                        help="总是执行步骤3（默认步骤2边缘已干净时跳过）")
+    parser.add_argument("--backend", choices=["replicate", "local", "fake"], default=None,
+                        help="抠图后端（默认取环境变量 MATTING_BACKEND，未设置为 replicate；local / fake 不需要网络）")
+    parser.add_argument("--priority", choices=["interactive", "batch"], default=None,
+                        help="远程预测排队优先级（默认取环境变量 REMOTE_PRIORITY，未设置为 interactive）")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="不读远程结果缓存，重新调用模型并覆盖缓存条目（对抠图结果不满意时重跑）")
     args = parser.parse_args()
 
     try:
-        output_paths = run_multi_pet_matting(args.session_id)
+        backend_kwargs = {}
+        if args.priority and resolve_backend_name(args.backend) == ReplicateMattingBackend.name:
+            # 优先级随后端传给每次远程调用（本地 / fake 后端不经调度器）
+            backend_kwargs["priority"] = resolve_priority(args.priority)
+        backend = create_backend(args.backend, **backend_kwargs) if args.backend or backend_kwargs else None
+        output_paths = run_multi_pet_matting(args.session_id, max_workers=args.workers,
+                                             in_memory=args.in_memory, adaptive_step3=not args.always_step3,
+                                             backend=backend, refresh_results=args.refresh_cache)
         print(f"抠图结果: {output_paths}")
     except Exception as e:
         print(f"抠图失败: {e}")
@@ -19,7 +19,7 @@ for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
         sys.path.insert(0, path)
 
 from state_manager import StateManager
-from run_multi_pet_matting import run_multi_pet_matting
+from run_multi_pet_matting import run_multi_pet_matting_in_memory
 from run_multi_pet_composition import run_multi_pet_composition
 from run_text_style_adjustment import run_text_adjustment
 
@@ -155,11 +155,11 @@ class MultiPetOrchestrator:
         if template_path:
             self.state_manager.set_template(session_id, template_path)
 
-        # 执行抠图
-        extracted_paths = run_multi_pet_matting(session_id)
+        # 执行抠图（内存交接：抠图结果直接交给合成，不再从磁盘重新解码）
+        extracted_images = run_multi_pet_matting_in_memory(session_id)
 
         # 执行合成
-        design_path = run_multi_pet_composition(session_id)
+        design_path = run_multi_pet_composition(session_id, extracted_images=extracted_images)
 
         return design_path
 
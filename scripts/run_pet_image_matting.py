@@ -1,18 +1,32 @@
 # -*- coding: utf-8 -*-
 """
-宠物抠图：使用 google/nano-banana 从去背景图中抠出全身/半身/头部。
+宠物抠图：使用 google/nano-banana 从去背景图中抠出全身/半身/头部（--backend local / fake 改用离线后端）。
 用法: python run_pet_image_matting.py <去背景图路径> [--pet-type head|half_body|full_body] [--out 输出路径]
+      [--backend replicate|local|fake] [--refresh-cache]
 """
 import argparse
+import asyncio
+import hashlib
 import os
 import sys
-
-from replicate_utils import download_url, ensure_token
+from typing import TYPE_CHECKING, Optional
+
+from remote_policy import Admission, RetryPolicy, call_with_policy
+from remote_scheduler import Priority, get_scheduler
+from replicate_async import AsyncReplicateClient, ReplicateAPIError, client_scope, extract_output_url
+from remote_result_cache import RemoteResultCache, build_result_key, get_result_cache
+from streaming_download import write_file_atomic
+from upload_prepare import prepare_upload, resolve_max_side
 import numpy as np
 from PIL import Image
 
+if TYPE_CHECKING:
+    from matting_backend import MattingBackend
+
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 NANO_BANANA = "google/nano-banana"
+# 上传前长边上限（像素）：不低于 nano-banana 的输出分辨率，抠图结果尺寸不受影响
+NANO_BANANA_MAX_SIDE = 1536
 
 PROMPTS = {
     "head": "Remove everything except the pet's head—ensure no neck, no body, and no bottom shadow. The pet's head should be completely isolated, with absolutely no part of the neck or body visible in the image. The neck must be fully removed, leaving only the head. Preserve all facial features, texture, coloration, and expression exactly; highest priority: do not alter the pet in any way. Ensure the edges of the head are crisp and clear—avoid over-feathering, halos, or soft transitions. Completely remove any shadow beneath the head, ensuring a flat, seamless base. Set the background to transparent.",
@@ -27,11 +41,91 @@ def _resolve(path: str) -> str:
     return os.path.join(PROJECT_ROOT, path)
 
 
-def run_matting(image_path: str, pet_type: str = "head", out_path: str = None) -> str:
-    import replicate
-    from replicate.exceptions import ModelError
-
-    ensure_token()
+def ensure_rgba(image: Image.Image) -> Image.Image:
+    """统一为 RGBA（nano-banana 可能返回 RGB：接近白色的像素设为透明）"""
+    if image.mode == 'RGBA':
+        return image
+    if image.mode == 'RGB':
+        image = image.convert('RGBA')
+        # 将接近白色的像素设为透明
+        data = np.array(image)
+        # 白色阈值（接近255,255,255的像素）
+        white_threshold = 240
+        mask = np.all(data[:, :, :3] > white_threshold, axis=2)
+        data[mask, 3] = 0  # 设置alpha为0（透明）
+        return Image.fromarray(data)
+    return image.convert('RGBA')
+
+
+def _ensure_rgba_output(out_path: str):
+    """确保输出是RGBA格式（nano-banana可能返回RGB）"""
+    downloaded_img = Image.open(out_path)
+    if downloaded_img.mode != 'RGBA':
+        ensure_rgba(downloaded_img).save(out_path, "PNG")
+
+
+async def matting_bytes(content: bytes, pet_type: str = "head",
+                        client: Optional[AsyncReplicateClient] = None,
+                        result_cache: Optional[RemoteResultCache] = None,
+                        filename: str = "input.png",
+                        policy: Optional[RetryPolicy] = None,
+                        priority: Optional[Priority] = None,
+                        refresh: bool = False) -> bytes:
+    """
+    内存版抠图：输入文件字节 -> 上传前缩小（长边 NANO_BANANA_MAX_SIDE）-> 上传 -> nano-banana 预测 -> 下载到内存，返回模型原始输出字节
+    （可能是 RGB，调用方用 ensure_rgba 统一）；result_cache 为空时使用共享的结果缓存，
+    refresh=True 时不读缓存、重新调用并覆盖条目（生成式模型重跑以得到不同结果）
+    上传 -> 预测 -> 下载整体按 policy（默认 resolve_retry_policy()）限时、重试与对冲；
+    每个请求（上传 -> 预测 -> 下载）先经全局调度器（令牌桶、并发上限）按 priority（默认取 REMOTE_PRIORITY）排队，
+    排队时间不计入尝试时限；调度器有排队者时不对冲
+    """
+    if pet_type not in PROMPTS:
+        raise ValueError(f"pet_type 须为 head/half_body/full_body，当前: {pet_type}")
+    prompt = PROMPTS[pet_type]
+
+    max_side = resolve_max_side(NANO_BANANA_MAX_SIDE)
+    cache = result_cache or get_result_cache()
+    cache_key = build_result_key(hashlib.sha256(content).hexdigest(), NANO_BANANA, prompt,
+                                 params={"max_side": max_side})
+    # 缓存文件读写是阻塞 I/O，放到线程中，不阻塞共用事件循环的其他宠物
+    cached = None if refresh else await asyncio.to_thread(cache.get_bytes, cache_key)
+    if cached is not None:
+        return cached
+
+    # 上传前按长边上限缩小（带透明通道的输入保持 PNG）
+    prepared = await asyncio.to_thread(prepare_upload, content, max_side)
+
+    async def attempt() -> bytes:
+        async with client_scope(client) as replicate:
+            output = await replicate.run_with_upload(
+                NANO_BANANA, prepared.content, prepared.filename(os.path.splitext(filename)[0]),
+                prepared.content_type,
+                lambda url: {
+                    "image_input": [url],
+                    "prompt": prompt,
+                },
+            )
+            return await replicate.download_bytes(extract_output_url(output))
+
+    # 每个请求（含重试、对冲）先经全局调度器排队，排队时间不计入尝试时限
+    scheduler = get_scheduler()
+    admission = Admission(lambda: scheduler.slot(NANO_BANANA, priority), scheduler.has_waiters)
+    result = await call_with_policy("nano_banana", attempt, policy, admission=admission)
+    # 缓存模型原始输出，RGBA 转换每次重做
+    await asyncio.to_thread(cache.put_bytes, cache_key, result)
+    return result
+
+
+async def run_matting_async(image_path: str, pet_type: str = "head", out_path: str = None,
+                            client: Optional[AsyncReplicateClient] = None,
+                            result_cache: Optional[RemoteResultCache] = None,
+                            backend: Optional["MattingBackend"] = None,
+                            refresh: bool = False) -> str:
+    """
+    异步抠图：读入去背景图 -> backend.extract_subject -> 写出 out_path 并统一为 RGBA
+    backend 为空时直接走 Replicate（matting_bytes），client 为空时临时创建；
+    相同输入字节 + 提示词命中结果缓存时不访问网络（refresh=True 时重新调用并覆盖缓存）
+    """
     image_path = _resolve(image_path)
     if not os.path.isfile(image_path):
         raise FileNotFoundError(f"输入图不存在: {image_path}")
@@ -42,68 +136,46 @@ def run_matting(image_path: str, pet_type: str = "head", out_path: str = None) -
     if out_path is None:
         out_path = os.path.join(PROJECT_ROOT, "output", f"extracted_{pet_type}.png")
     out_path = _resolve(out_path)
-    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
 
     try:
-        prompt = PROMPTS[pet_type]
-        image_path_abs = os.path.abspath(image_path)
-        if not os.path.isfile(image_path_abs):
-            raise FileNotFoundError(f"抠图输入图不存在: {image_path_abs}")
-
-        uploaded = replicate.files.create(image_path_abs)
-        image_uri = uploaded.urls.get("get") or str(uploaded.urls)
-        output = replicate.run(
-            NANO_BANANA,
-            input={
-                "image_input": [image_uri],
-                "prompt": prompt,
-            },
-        )
-
-        if isinstance(output, str):
-            url = output
-        elif hasattr(output, "url"):
-            url = output.url
-        elif isinstance(output, list) and output:
-            url = output[0] if isinstance(output[0], str) else getattr(output[0], "url", str(output[0]))
+        with open(image_path, "rb") as f:
+            content = f.read()
+        if backend is not None:
+            result = await backend.extract_subject(content, pet_type, filename=os.path.basename(image_path))
         else:
-            url = str(output)
-
-        download_url(url, out_path)
-        
-        # 确保输出是RGBA格式（nano-banana可能返回RGB）
-        downloaded_img = Image.open(out_path)
-        if downloaded_img.mode != 'RGBA':
-            # 如果是RGB，尝试转换为RGBA
-            # 如果背景是白色，将白色像素设为透明
-            if downloaded_img.mode == 'RGB':
-                downloaded_img = downloaded_img.convert('RGBA')
-                # 将接近白色的像素设为透明
-                data = np.array(downloaded_img)
-                # 白色阈值（接近255,255,255的像素）
-                white_threshold = 240
-                mask = np.all(data[:, :, :3] > white_threshold, axis=2)
-                data[mask, 3] = 0  # 设置alpha为0（透明）
-                downloaded_img = Image.fromarray(data)
-            else:
-                downloaded_img = downloaded_img.convert('RGBA')
-            downloaded_img.save(out_path, "PNG")
-        
+            result = await matting_bytes(content, pet_type, client=client, result_cache=result_cache,
+                                         filename=os.path.basename(image_path), refresh=refresh)
+        write_file_atomic(out_path, result)
+        _ensure_rgba_output(out_path)
+
         print(f"已抠图 ({pet_type}): {out_path}")
         return out_path
 
-    except ModelError as e:
+    except ReplicateAPIError as e:
         print(f"Replicate API 报错: {e}")
         raise
 
 
+def run_matting(image_path: str, pet_type: str = "head", out_path: str = None,
+                backend: Optional["MattingBackend"] = None) -> str:
+    """run_matting_async 的同步封装（Replicate 后端未命中结果缓存时才需要令牌）"""
+    return asyncio.run(run_matting_async(image_path, pet_type, out_path, backend=backend))
+
+
 def main():
     parser = argparse.ArgumentParser(description="宠物抠图（google/nano-banana）")
     parser.add_argument("image", help="去背景后的图片路径")
     parser.add_argument("--pet-type", "-t", choices=["head", "half_body", "full_body"], default="head")
     parser.add_argument("--out", "-o", default=None)
+    parser.add_argument("--backend", choices=["replicate", "local", "fake"], default=None,
+                        help="抠图后端（默认取环境变量 MATTING_BACKEND，未设置为 replicate）")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="不读远程结果缓存，重新调用模型并覆盖缓存条目（对结果不满意时重跑）")
     args = parser.parse_args()
-    run_matting(args.image, args.pet_type, args.out)
+    from matting_backend import create_backend, with_refresh
+
+    backend = create_backend(args.backend)
+    run_matting(args.image, args.pet_type, args.out, backend=with_refresh(backend) if args.refresh_cache else backend)
 
 
 if __name__ == "__main__":
@@ -6,7 +6,7 @@
 import json
 import os
 from typing import Dict, Any, List, Optional
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
 from datetime import datetime
 
 
@@ -81,8 +81,10 @@ class StateManager:
 
         # 转换为MultiPetState
         pets = []
+        known_fields = {f.name for f in fields(PetConfig)}
         for pet_data in data.get("pets", []):
-            pet = PetConfig(**pet_data)
+            # 忽略已废弃的字段（如早期写入的 input_scale）
+            pet = PetConfig(**{k: v for k, v in pet_data.items() if k in known_fields})
             # 确保anchor是tuple
             if isinstance(pet.anchor, list):
                 pet.anchor = tuple(pet.anchor)
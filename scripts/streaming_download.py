@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+流式下载器（httpx 连接池）
+替代 urlretrieve：每个文件新建连接、无超时、无完整性校验，调用方还要再用 Image.open 从磁盘读回。
+- 连接池 + keep-alive：同一下载器的请求复用连接
+- 超时：连接 / 读取超时，外加单个文件的总时限
+- 分块流式写入磁盘（临时文件 + 原子替换）或内存缓冲
+- 可边下载边解码为 PIL 图像（ImageFile.Parser），省去落盘后再读
+- 完整性：Content-Length 与实际字节数核对，可选 sha256 校验
+- 指标：每次下载的字节数、首字节延迟与总耗时，DownloadMetrics 汇总
+"""
+import asyncio
+import hashlib
+import io
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import httpx
+from PIL import Image, ImageFile
+
+from metrics_utils import percentile
+
+MAX_CONNECTIONS = 32
+MAX_KEEPALIVE_CONNECTIONS = 16
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 60.0
+# 单个文件从发出请求到写完的总时限
+TOTAL_TIMEOUT = 300.0
+CHUNK_SIZE = 256 * 1024
+
+
+class DownloadError(Exception):
+    """下载失败：HTTP 错误码、连接 / 超时错误、字节数或哈希不符、图像数据不完整"""
+
+
+@dataclass
+class DownloadRecord:
+    """单次下载的记录"""
+    url: str
+    bytes: int
+    ttfb: float  # 发出请求到收到响应头
+    elapsed: float  # 发出请求到数据全部收完
+
+    @property
+    def throughput(self) -> float:
+        """字节 / 秒"""
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class DownloadMetrics:
+    """下载指标汇总（线程安全，可被多个下载器共用）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records: List[DownloadRecord] = []
+        self.errors = 0
+
+    def record(self, record: DownloadRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            records = list(self.records)
+            errors = self.errors
+        elapsed = [r.elapsed for r in records]
+        return {
+            "count": len(records),
+            "errors": errors,
+            "bytes": sum(r.bytes for r in records),
+            "ttfb_p50": percentile([r.ttfb for r in records], 0.5),
+            "elapsed_p50": percentile(elapsed, 0.5),
+            "elapsed_p95": percentile(elapsed, 0.95),
+        }
+
+
+class StreamingDownloader:
+    """
+    流式下载器，用作 async 上下文管理器：
+
+        async with StreamingDownloader() as downloader:
+            await downloader.to_file(url, out_path)
+            image = await downloader.to_image(url)
+
+    传入 client 时共用其连接池（由调用方关闭），否则自建并在 aclose 时关闭
+    """
+
+    def __init__(self, client: Optional[httpx.AsyncClient] = None,
+                 max_connections: int = MAX_CONNECTIONS,
+                 total_timeout: float = TOTAL_TIMEOUT,
+                 chunk_size: int = CHUNK_SIZE,
+                 metrics: Optional[DownloadMetrics] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._owns_client = client is None
+        self._client = client or httpx.AsyncClient(
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+            follow_redirects=True,
+            transport=transport,
+        )
+        self.total_timeout = total_timeout
+        self.chunk_size = chunk_size
+        self.metrics = metrics or DownloadMetrics()
+
+    async def __aenter__(self) -> "StreamingDownloader":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        if self._owns_client:
+            await self._client.aclose()
+
+    async def _stream(self, url: str, sink: Callable[[bytes], None],
+                      expected_sha256: Optional[str] = None) -> DownloadRecord:
+        """把响应体逐块交给 sink，校验长度 / 哈希并记录指标"""
+        try:
+            return await asyncio.wait_for(self._stream_body(url, sink, expected_sha256), self.total_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.record_error()
+            raise DownloadError(f"下载 {url} 超过总时限 {self.total_timeout:.0f}s") from None
+        except DownloadError:
+            self.metrics.record_error()
+            raise
+        except httpx.HTTPError as e:
+            self.metrics.record_error()
+            raise DownloadError(f"下载 {url} 失败: {e!r}") from e
+
+    async def _stream_body(self, url: str, sink: Callable[[bytes], None],
+                           expected_sha256: Optional[str]) -> DownloadRecord:
+        start = time.perf_counter()
+        digest = hashlib.sha256() if expected_sha256 else None
+        received = 0
+        async with self._client.stream("GET", url) as response:
+            ttfb = time.perf_counter() - start
+            if response.status_code >= 400:
+                raise DownloadError(f"下载 {url} 返回 {response.status_code}")
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                received += len(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                sink(chunk)
+            # Content-Length 对应传输字节（可能经过压缩）；响应体已在内存中时（如 mock）传输计数为 0，按解码字节核对
+            declared = response.headers.get("Content-Length")
+            transferred = response.num_bytes_downloaded or received
+            if declared is not None and int(declared) != transferred:
+                raise DownloadError(f"下载 {url} 不完整: 声明 {declared} 字节，收到 {transferred}")
+        if digest is not None and digest.hexdigest() != expected_sha256:
+            raise DownloadError(f"下载 {url} sha256 不符")
+        record = DownloadRecord(url=url, bytes=received, ttfb=ttfb, elapsed=time.perf_counter() - start)
+        self.metrics.record(record)
+        return record
+
+    async def to_file(self, url: str, out_path: str, expected_sha256: Optional[str] = None) -> DownloadRecord:
+        """流式写入 out_path（先写 .part 临时文件，校验通过后原子替换）"""
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        tmp_path = f"{out_path}.part"
+        try:
+            with open(tmp_path, "wb") as f:
+                record = await self._stream(url, f.write, expected_sha256)
+            os.replace(tmp_path, out_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return record
+
+    async def to_bytes(self, url: str, expected_sha256: Optional[str] = None) -> bytes:
+        """下载到内存"""
+        buffer = io.BytesIO()
+        await self._stream(url, buffer.write, expected_sha256)
+        return buffer.getvalue()
+
+    async def to_image(self, url: str, out_path: Optional[str] = None) -> Image.Image:
+        """
+        边下载边解码为 PIL 图像；给出 out_path 时同一份字节同时写盘（解码成功后原子替换）
+        数据不完整或无法解码时抛出 DownloadError
+        """
+        parser = ImageFile.Parser()
+
+        def feed(chunk: bytes):
+            try:
+                parser.feed(chunk)
+            except (OSError, SyntaxError) as e:
+                raise DownloadError(f"下载 {url} 的图像数据无法解码: {e}") from e
+
+        if out_path is None:
+            await self._stream(url, feed)
+            return _close_parser(url, parser)
+
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        tmp_path = f"{out_path}.part"
+        try:
+            with open(tmp_path, "wb") as f:
+                def tee(chunk: bytes):
+                    f.write(chunk)
+                    feed(chunk)
+                await self._stream(url, tee)
+            image = _close_parser(url, parser)
+            os.replace(tmp_path, out_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return image
+
+
+def _close_parser(url: str, parser: ImageFile.Parser) -> Image.Image:
+    try:
+        image = parser.close()
+        image.load()
+    except (OSError, SyntaxError) as e:
+        raise DownloadError(f"下载 {url} 的图像数据不完整或无法解码: {e}") from e
+    return image
+
+
+def write_file_atomic(path: str, data: bytes) -> str:
+    """整块写入 path（先写 .part 临时文件再原子替换，读者不会看到半个文件）"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+测试预乘 alpha 合成器
+验证与 Pillow alpha_composite 结果一致、跨渲染模板缓冲恢复、亚像素偏移，
+以及合成输入的裁剪表示（PetCutout）与逐宠物并行处理
+（抠图校验与边缘质量见 test_matting_validation.py）
+用法: python test_compositor.py
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+from PIL import Image, ImageDraw
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from utils.compositor import PetPlacement, get_compositor
+from utils.pet_transform import PetTransform, compute_layout_transform, compute_square_padding
+from utils.visual_center import compute_visual_center
+from utils.pet_cutout import PetCutout
+from utils.multi_pet_enhancement import process_pet_image_for_display, compute_visual_area
+from utils.matting_validation import validate_all_pet_mattings, validate_pet_matting
+from utils.parallel import parallel_map
+
+
+def _make_pet(size: int = 60, color=(250, 10, 10, 200)) -> Image.Image:
+    pet = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    ImageDraw.Draw(pet).ellipse([5, 5, size - 5, size - 5], fill=color)
+    return pet
+
+
+def _make_template(path: str) -> Image.Image:
+    template = Image.new("RGBA", (300, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(template).ellipse([0, 0, 300, 200], fill=(0, 100, 200, 255))
+    template.save(path)
+    return template
+
+
+def test_matches_alpha_composite():
+    """整数偏移、scale=1 时应与 Pillow alpha_composite 一致（含部分超出画布）"""
+    print("\n=== 测试合成结果一致性 ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "template.png")
+        template = _make_template(template_path)
+        pet = _make_pet()
+
+        compositor = get_compositor(template_path)
+        result = compositor.render([
+            PetPlacement(pet, PetTransform.translation(20, 30)),
+            PetPlacement(pet, PetTransform.translation(-30, 150)),
+        ])
+
+        expected = template.copy()
+        expected.alpha_composite(pet, (20, 30))
+        layer = Image.new("RGBA", template.size, (0, 0, 0, 0))
+        layer.paste(pet, (-30, 150))
+        expected = Image.alpha_composite(expected, layer)
+
+        diff = np.abs(np.array(result, dtype=np.int16) - np.array(expected, dtype=np.int16)).max()
+        print(f"最大像素差: {diff}")
+        assert diff <= 1
+
+        # 下一次渲染前只恢复脏区域，空渲染应还原为模板
+        empty = compositor.render([])
+        assert np.array_equal(np.array(empty), np.array(template))
+    print("合成结果一致性测试通过")
+
+
+def test_subpixel_offset():
+    """亚像素偏移应平滑移动质心，而不是截断到整数像素"""
+    print("\n=== 测试亚像素定位 ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "white.png")
+        Image.new("RGBA", (120, 120), (255, 255, 255, 255)).save(template_path)
+        pet = _make_pet(40, (0, 0, 0, 255))
+        compositor = get_compositor(template_path)
+
+        centers = []
+        for dx in (0.0, 0.25, 0.5):
+            out = np.array(compositor.render([PetPlacement(pet, PetTransform(0.5, 40 + dx, 40))]))
+            darkness = 255.0 - out[:, :, 0].astype(np.float64)
+            xs = np.arange(out.shape[1])
+            centers.append(float((darkness.sum(axis=0) * xs).sum() / darkness.sum()))
+        print(f"质心 x: {centers}")
+        assert abs((centers[1] - centers[0]) - 0.25) < 0.05
+        assert abs((centers[2] - centers[0]) - 0.5) < 0.05
+    print("亚像素定位测试通过")
+
+
+def test_transform_chain_single_resample():
+    """原图 -> 补正方形 -> 缩放/锚点 的累计变换，直接合成原图应与先补边再合成一致"""
+    print("\n=== 测试累计变换链 ===")
+    chain = PetTransform.translation(7, -3).then(PetTransform(0.5, 10.25, 20.5))
+    assert chain.map_point((2, 4)) == (0.5 * 9 + 10.25, 0.5 * 1 + 20.5)
+    round_trip = chain.inverse().map_point(chain.map_point((13.0, 5.0)))
+    assert abs(round_trip[0] - 13.0) < 1e-9 and abs(round_trip[1] - 5.0) < 1e-9
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "white.png")
+        Image.new("RGBA", (200, 200), (255, 255, 255, 255)).save(template_path)
+        raw = Image.new("RGBA", (90, 50), (0, 0, 0, 0))
+        ImageDraw.Draw(raw).ellipse([20, 5, 80, 45], fill=(30, 160, 60, 230))
+
+        bbox = raw.getchannel("A").getbbox()
+        square_size, padding = compute_square_padding(raw.size, bbox, compute_visual_center(raw))
+        square = Image.new("RGBA", (square_size, square_size), (0, 0, 0, 0))
+        square.paste(raw, (int(padding.tx), int(padding.ty)))
+
+        layout = compute_layout_transform(
+            compute_visual_center(square), square.size, 0.8, (0.5, 0.5), (200, 200)
+        )
+        compositor = get_compositor(template_path)
+        via_square = np.array(compositor.render([PetPlacement(square, layout)]), dtype=np.int16)
+        via_raw = np.array(compositor.render([PetPlacement(raw, padding.then(layout))]), dtype=np.int16)
+        diff = np.abs(via_square - via_raw).max()
+        print(f"补边后合成 vs 原图直接合成 最大像素差: {diff}")
+        assert diff <= 1
+    print("累计变换链测试通过")
+
+
+def test_cutout_matches_full_frame():
+    """裁剪到内容后的边缘处理、视觉中心、面积、校验结果应与整帧处理一致"""
+    print("\n=== 测试裁剪表示 PetCutout ===")
+    frame = Image.new("RGBA", (160, 160), (0, 0, 0, 0))
+    ImageDraw.Draw(frame).ellipse([50, 40, 110, 100], fill=(200, 120, 40, 255))
+    cutout = PetCutout.from_image(frame)
+    print(f"原帧: {frame.size}, 裁剪后: {cutout.image.size}, 偏移: {cutout.offset}")
+    assert cutout.image.width * cutout.image.height < frame.width * frame.height / 4
+    assert cutout.size == frame.size
+
+    full = process_pet_image_for_display(frame, enable_stroke=True)
+    cropped = process_pet_image_for_display(cutout, enable_stroke=True)
+    assert isinstance(cropped, PetCutout)
+    assert np.array_equal(np.array(full), np.array(cropped.to_image()))
+
+    full_center = compute_visual_center(full)
+    assert abs(full_center[0] - cropped.visual_center()[0]) < 1e-6
+    assert abs(full_center[1] - cropped.visual_center()[1]) < 1e-6
+    assert compute_visual_area(full) == compute_visual_area(cropped)
+
+    full_result = validate_pet_matting(frame, "pet_a")
+    cropped_result = validate_pet_matting(cutout, "pet_a")
+    assert full_result == cropped_result, f"{full_result} != {cropped_result}"
+    print("裁剪表示测试通过")
+
+
+def test_parallel_per_pet():
+    """逐宠物并行：结果按输入顺序，与串行一致；失败后不再启动排队中的任务；校验结果截断到第一个失败"""
+    print("\n=== 测试逐宠物并行 ===")
+    import time
+    assert parallel_map(lambda x: (time.sleep(0.01 * (5 - x)), x)[1], range(5), max_workers=4) == list(range(5))
+    try:
+        parallel_map(lambda x: 1 // (x - 2) if x > 1 else x, range(5), max_workers=4)
+        assert False, "应抛出异常"
+    except ZeroDivisionError:
+        pass
+
+    # 第一个失败后排队中的任务不再启动
+    started = []
+
+    def slow_or_fail(x):
+        started.append(x)
+        if x == 0:
+            raise ValueError("第一只失败")
+        time.sleep(0.05)
+        return x
+    try:
+        parallel_map(slow_or_fail, range(10), max_workers=2)
+        assert False, "应抛出异常"
+    except ValueError:
+        pass
+    assert len(started) < 5, started
+
+    good = Image.new("RGBA", (600, 600), (0, 0, 0, 0))
+    ImageDraw.Draw(good).ellipse([100, 80, 500, 540], fill=(200, 120, 40, 255))
+    empty = Image.new("RGBA", (600, 600), (0, 0, 0, 0))
+    pets, ids = [good, good, empty, good], ["pet_a", "pet_b", "pet_c", "pet_d"]
+    serial = validate_all_pet_mattings(pets, ids, max_workers=1)
+    parallel = validate_all_pet_mattings(pets, ids, max_workers=4)
+    assert serial == parallel
+    assert not parallel[0] and [r.pet_id for r in parallel[1]] == ["pet_a", "pet_b", "pet_c"]
+    print("逐宠物并行测试通过")
+
+
+def main():
+    try:
+        test_matches_alpha_composite()
+        test_subpixel_offset()
+        test_transform_chain_single_resample()
+        test_cutout_matches_full_frame()
+        test_parallel_per_pet()
+    except Exception as e:
+        print(f"\n测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
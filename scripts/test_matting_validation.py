@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+测试抠图结果校验与边缘质量
+验证 alpha 连通域统计、抠图有效性规则、分级（下采样）校验与边缘质量（是否需要步骤3）
+用法: python test_matting_validation.py
+"""
+import os
+import sys
+import numpy as np
+from PIL import Image, ImageDraw
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from utils.edge_quality import HALO_SCORE_MAX, assess_edge_quality
+from utils.matting_validation import compute_alpha_stats, validate_pet_matting
+from utils.pet_cutout import PetCutout
+
+
+def test_alpha_stats():
+    """连通域统计：面积、边界框、质心与最大连通域占比"""
+    print("\n=== 测试 alpha 连通域统计 ===")
+    mask = np.zeros((100, 120), dtype=np.uint8)
+    mask[10:40, 10:50] = 1    # 1200
+    mask[60:70, 80:110] = 1   # 300
+    mask[40, 50] = 1          # 仅与第一块对角相邻，4 邻域下单独成块
+    stats = compute_alpha_stats(mask)
+    print(f"面积: {stats.areas.tolist()}, 占比: {stats.largest_component_ratio:.3f}")
+    assert sorted(stats.areas.tolist()) == [1, 300, 1200]
+    assert stats.foreground == 1501
+    largest = stats.largest_index
+    assert stats.bboxes[largest].tolist() == [10, 10, 40, 30]
+    assert np.allclose(stats.centroids[largest], (29.5, 24.5))
+    assert abs(stats.largest_component_ratio - 1200 / 1501) < 1e-9
+    assert compute_alpha_stats(np.zeros((8, 8), np.uint8)).largest_component_ratio == 0.0
+
+    # 1024² 碎裂抠图应被连通域规则拒绝
+    frame = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(frame)
+    for i in range(6):
+        draw.ellipse([40 + i * 160, 300, 160 + i * 160, 700], fill=(200, 120, 40, 255))
+    result = validate_pet_matting(frame, "pet_a")
+    assert not result.valid and result.largest_component_ratio < 0.2, result
+    print("alpha 连通域统计测试通过")
+
+
+def test_tiered_validation():
+    """分级校验：明显的结果在下采样层提前返回，阈值附近升级到全分辨率，结论与全分辨率一致"""
+    print("\n=== 测试分级抠图校验 ===")
+    good = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    ImageDraw.Draw(good).ellipse([200, 150, 820, 880], fill=(200, 120, 40, 255))
+    empty = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    # 两块之间只有 2px 缝：下采样会接上，必须升级到全分辨率才能判定碎裂
+    split = Image.new("RGBA", (1024, 1024), (0, 0, 0, 0))
+    ImageDraw.Draw(split).rectangle([200, 200, 509, 800], fill=(200, 120, 40, 255))
+    ImageDraw.Draw(split).rectangle([512, 200, 820, 800], fill=(200, 120, 40, 255))
+
+    for image, tier, valid in [(good, "reduced", True), (empty, "coarse", False), (split, "full", False)]:
+        result = validate_pet_matting(image, "pet_a")
+        full = validate_pet_matting(image, "pet_a", tiered=False)
+        print(f"tier={result.tier}, valid={result.valid}, alpha={result.alpha_ratio:.4f}")
+        assert (result.tier, result.valid) == (tier, valid), result
+        assert full.tier == "full" and full.valid == valid
+        assert abs(result.alpha_ratio - full.alpha_ratio) < 1e-3
+        # 裁剪表示结论一致（裁剪区域过小时直接全分辨率）
+        assert validate_pet_matting(PetCutout.from_image(image), "pet_a").valid == valid
+    print("分级抠图校验测试通过")
+
+
+def test_edge_quality():
+    """边缘质量：干净抠图可跳过步骤3；白边、残留碎片、大片半透明需要步骤3；白色宠物不误判为白边"""
+    print("\n=== 测试抠图边缘质量 ===")
+    def pet(fill, ring=None, speck=False, alpha=255):
+        image = Image.new("RGBA", (512, 512), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        if ring is not None:
+            draw.ellipse([96, 76, 416, 436], fill=ring + (255,))
+        draw.ellipse([100, 80, 412, 432], fill=fill + (alpha,))
+        if speck:
+            draw.rectangle([20, 20, 60, 300], fill=fill + (255,))
+        return image
+
+    cases = [
+        ("clean", pet((200, 120, 40)), True),
+        ("white_pet", pet((250, 250, 250)), True),
+        ("halo", pet((200, 120, 40), ring=(245, 245, 245)), False),
+        ("fragment", pet((200, 120, 40), speck=True), False),
+        ("translucent", pet((200, 120, 40), alpha=128), False),
+    ]
+    for name, image, clean in cases:
+        quality = assess_edge_quality(image, name)
+        print(f"{name}: clean={quality.clean}, {quality.summary()} {quality.reason}")
+        assert quality.clean == clean, name
+    assert assess_edge_quality(cases[2][1]).halo_score > HALO_SCORE_MAX
+    print("抠图边缘质量测试通过")
+
+
+def main():
+    try:
+        test_alpha_stats()
+        test_tiered_validation()
+        test_edge_quality()
+    except Exception as e:
+        print(f"\n测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
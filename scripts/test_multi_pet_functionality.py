@@ -20,7 +20,7 @@ for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
 from state_manager import StateManager
 from run_multi_pet_matting import run_multi_pet_matting
 from run_multi_pet_composition import run_multi_pet_composition
-from utils.multi_pet_layout import create_multi_pet_layout
+from utils.multi_pet_layout import create_multi_pet_layout, MultiPetLayoutEngine, PetLayout, MAX_PRESET_PETS
 
 
 def create_test_images():
@@ -123,6 +123,374 @@ def test_layout_engine():
     print("布局引擎测试通过")
 
 
+def test_layout_mask_collision():
+    """测试 alpha 占用网格碰撞检测：圆形宠物矩形相交但 alpha 不重叠时不应被拉开"""
+    print("\n=== 测试占用网格碰撞检测 ===")
+    import numpy as np
+
+    pet = Image.new("RGBA", (200, 200), (0, 0, 0, 0))
+    ImageDraw.Draw(pet).ellipse([0, 0, 199, 199], fill=(200, 120, 40, 255))
+
+    engine = MultiPetLayoutEngine(1000, 500, collision_mode="mask")
+    engine.set_pet_images([pet, pet])
+    # 两个圆沿对角方向放置：外接矩形相交，圆本身不相交
+    layouts = [PetLayout("pet_0", (0.40, 0.40), 1.0), PetLayout("pet_1", (0.575, 0.75), 1.0)]
+    for i, layout in enumerate(layouts):
+        layout.rect = engine.calculate_occupancy_rect(layout, pet.size)
+    assert engine.check_overlap(layouts[0].rect, layouts[1].rect)
+    assert engine.compute_mask_overlap(layouts, 0, 1) == 0
+
+    # 完全重合时重叠面积约为圆面积
+    same = [PetLayout("pet_0", (0.5, 0.5), 1.0), PetLayout("pet_1", (0.5, 0.5), 1.0)]
+    area = engine.compute_mask_overlap(same, 0, 1)
+    print(f"重合重叠面积: {area:.0f}, 圆面积: {np.pi * 100 ** 2:.0f}")
+    assert abs(area - np.pi * 100 ** 2) / (np.pi * 100 ** 2) < 0.15
+
+    # 批量候选评估：与逐个计算一致
+    xs = np.linspace(0.2, 0.8, 40)
+    candidates = np.stack([xs, np.full_like(xs, 0.5)], axis=1)
+    areas = engine.evaluate_candidate_anchors(same, 1, candidates)
+    for anchor, batch_area in zip(candidates[::7], areas[::7]):
+        single = [same[0], PetLayout("pet_1", tuple(anchor), 1.0)]
+        assert batch_area == engine.compute_mask_overlap(single, 0, 1)
+    assert areas[0] == 0 and areas.argmax() in (19, 20)
+
+    rect_layouts = create_multi_pet_layout((400, 300), 2, [pet.size, pet.size])
+    mask_layouts = create_multi_pet_layout(
+        (400, 300), 2, [pet.size, pet.size], pet_images=[pet, pet], collision_mode="mask"
+    )
+    print(f"rect 模式: {[l.anchor for l in rect_layouts]}, mask 模式: {[l.anchor for l in mask_layouts]}")
+    print("占用网格碰撞检测测试通过")
+
+
+def test_layout_many_pets():
+    """测试 5 只以上宠物的打包布局：六边形网格 / 同心环 / 行打包，外接圆互不重叠"""
+    print("\n=== 测试多宠物打包布局 ===")
+    import math
+    import time
+
+    cases = [
+        ((1500, 1000), 7, [(800, 800)] * 7, False, "hex_grid"),
+        ((1500, 1000), 30, [(800, 800)] * 30, False, "hex_grid"),
+        ((1000, 1000), 19, [(600, 600)] * 19, True, "concentric_rings"),
+        ((1500, 1000), 6, [(300, 300), (900, 600), (500, 500), (1200, 800), (400, 400), (600, 900)],
+         False, "row_packing"),
+    ]
+    for template_size, count, sizes, circular, strategy in cases:
+        engine = MultiPetLayoutEngine(*template_size, circular=circular)
+        assert engine.select_layout_strategy(count, sizes) == strategy
+
+        start = time.perf_counter()
+        layouts = create_multi_pet_layout(template_size, count, sizes, circular=circular)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print(f"{strategy} x{count}: {elapsed_ms:.2f}ms, scale={min(l.scale for l in layouts):.3f}")
+        assert len(layouts) == count
+
+        width, height = template_size
+        for i in range(count):
+            ax, ay = layouts[i].anchor
+            assert 0 < ax < 1 and 0 < ay < 1
+            for j in range(i + 1, count):
+                bx, by = layouts[j].anchor
+                distance = math.hypot((ax - bx) * width, (ay - by) * height)
+                if strategy == "row_packing":
+                    # 行打包按显示宽度相邻，检查同行不重叠
+                    if abs(ay - by) < 1e-9:
+                        wi = sizes[i][0] * layouts[i].scale
+                        wj = sizes[j][0] * layouts[j].scale
+                        assert abs(ax - bx) * width >= (wi + wj) / 2 - 1e-6
+                    continue
+                radii = (max(sizes[i]) * layouts[i].scale + max(sizes[j]) * layouts[j].scale) / 2
+                assert distance >= radii - 1e-6
+
+    # 空间哈希找出的相交矩形对与两两比较一致
+    import random
+    rng = random.Random(0)
+    rects = []
+    for _ in range(200):
+        x, y, w, h = rng.random(), rng.random(), rng.uniform(0.01, 0.08), rng.uniform(0.01, 0.08)
+        rects.append((x, y, x + w, y + h))
+    engine = MultiPetLayoutEngine(1000, 1000)
+    brute = [(i, j) for i in range(len(rects)) for j in range(i + 1, len(rects))
+             if engine.check_overlap(rects[i], rects[j])]
+    assert engine.find_overlapping_pairs(rects) == brute
+    print("多宠物打包布局测试通过")
+
+
+def test_layout_circle_constraints():
+    """测试圆形模板极坐标约束：宠物外接圆落在文字环以内"""
+    print("\n=== 测试圆形模板极坐标约束 ===")
+    import numpy as np
+    from utils.polar_constraints import compute_bounding_radius, polar_overshoot
+
+    pet = Image.new("RGBA", (600, 600), (0, 0, 0, 0))
+    ImageDraw.Draw(pet).ellipse([50, 50, 550, 550], fill=(200, 120, 40, 255))
+    radius = compute_bounding_radius(pet)
+    assert 250 <= radius <= 252, radius
+
+    center, limit = (500.0, 500.0), 350.0
+    for count in (2, 3, 7):
+        layouts = create_multi_pet_layout(
+            (1000, 1000), count, [pet.size] * count, pet_images=[pet] * count,
+            collision_mode="mask", circular=True, circle_region=(center, limit)
+        )
+        points = np.array([(l.anchor[0] * 1000, l.anchor[1] * 1000) for l in layouts])
+        radii = np.array([radius * l.scale for l in layouts])
+        overshoot = polar_overshoot(points, radii, center, limit)
+        print(f"{count} 只: 最大超出 {overshoot.max():.3f}px, scale={[round(l.scale, 3) for l in layouts]}")
+        assert overshoot.max() < 1.0
+
+    # 径向内移不引入新的重叠对（与不加圆盘约束的同一布局比较）
+    def overlapping_pairs(engine, layouts, sizes):
+        rects = [engine.calculate_occupancy_rect(l, size) for l, size in zip(layouts, sizes)]
+        return {(i, j) for i, j in engine.find_overlapping_pairs(rects)
+                if engine._layouts_overlap(layouts, sizes, i, j, len(layouts) > MAX_PRESET_PETS)}
+
+    for count in (2, 3, 4, 6):
+        sizes = [(500, 500)] * count
+        free = MultiPetLayoutEngine(1000, 1000)
+        baseline = overlapping_pairs(free, free.generate_layout(count, sizes), sizes)
+        engine = MultiPetLayoutEngine(1000, 1000, circle_region=((500, 500), 420))
+        layouts = engine.generate_layout(count, sizes)
+        pairs = overlapping_pairs(engine, layouts, sizes)
+        print(f"{count} 只 500×500: 重叠对 {sorted(pairs)}（无圆盘约束 {sorted(baseline)}）")
+        assert pairs <= baseline, (pairs, baseline)
+        assert engine.check_circle_constraints(layouts, sizes).max() < 1.0
+    print("圆形模板极坐标约束测试通过")
+
+
+def test_layout_optimizer():
+    """测试布局优化器：消除重叠、相同种子可复现（含按预算折算迭代数的默认调用）、墙钟应急上限"""
+    print("\n=== 测试布局优化器 ===")
+    from utils.layout_optimizer import build_layout_objective, optimize_layouts
+
+    big = Image.new("RGBA", (800, 800), (0, 0, 0, 0))
+    ImageDraw.Draw(big).ellipse([100, 100, 700, 700], fill=(200, 120, 40, 255))
+    small = Image.new("RGBA", (800, 800), (0, 0, 0, 0))
+    ImageDraw.Draw(small).ellipse([250, 250, 550, 550], fill=(40, 120, 200, 255))
+    pets = [big, small, big]
+
+    # 起点故意重叠
+    layouts = [PetLayout(f"pet_{i}", (0.45 + 0.05 * i, 0.5), 0.6) for i in range(3)]
+    objective = build_layout_objective(
+        pets, layouts, (1500, 1000),
+        anchor_x_limits=(0.2, 0.8), anchor_y_limits=(0.25, 0.75), scale_limits=(0.3, 1.0)
+    )
+    first = optimize_layouts(objective, layouts, budget_ms=10000, seed=7, max_iterations=300)
+    second = optimize_layouts(objective, layouts, budget_ms=10000, seed=7, max_iterations=300)
+    print(f"得分: {first.initial_score:.4f} -> {first.score:.4f}, 迭代 {first.iterations}, "
+          f"{first.elapsed_ms:.1f}ms, {first.terms}")
+    assert first.iterations == 300
+    assert [(l.anchor, l.scale) for l in first.layouts] == [(l.anchor, l.scale) for l in second.layouts]
+    assert first.score < first.initial_score
+    assert first.terms["overlap"] < 1e-4 and first.terms["limits"] == 0
+    # 输入布局不被修改
+    assert layouts[0].anchor == (0.45, 0.5)
+
+    # 与技能的调用方式一致（默认预算、只给种子）：迭代数固定，多次运行布局相同
+    runs = [optimize_layouts(objective, layouts, seed=1) for _ in range(5)]
+    print(f"默认预算: 迭代 {[r.iterations for r in runs]}, 耗时 {[round(r.elapsed_ms, 1) for r in runs]}ms")
+    assert len({r.iterations for r in runs}) == 1 and not any(r.truncated for r in runs)
+    assert len({tuple((l.anchor, l.scale) for l in r.layouts) for r in runs}) == 1
+
+    # 墙钟只作应急上限：触发时提前停止并标记
+    capped = optimize_layouts(objective, layouts, budget_ms=1, seed=7, max_iterations=100000)
+    print(f"应急上限: 迭代 {capped.iterations}, 耗时 {capped.elapsed_ms:.1f}ms")
+    assert capped.truncated and capped.elapsed_ms < 50
+    print("布局优化器测试通过")
+
+
+def test_layout_cache():
+    """测试布局缓存：形状相近的订单命中缓存，布局一致，可从磁盘恢复"""
+    print("\n=== 测试布局缓存 ===")
+    from utils.layout_cache import LayoutCache, build_layout_cache_key
+    from utils.template_registry import get_template_descriptor
+    from skills.multi_pet_composition_enhancement import MultiPetCompositionEnhancementSkill
+
+    def make_pet(size, color):
+        pet = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        margin = size // 8
+        ImageDraw.Draw(pet).ellipse([margin, margin, size - margin, size - margin], fill=color)
+        return pet
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "template.png")
+        Image.new("RGBA", (900, 600), (250, 250, 250, 255)).save(template_path)
+        cache_path = os.path.join(tmp_dir, "layout_cache.json")
+        cache = LayoutCache(persist_path=cache_path)
+        skill = MultiPetCompositionEnhancementSkill()
+
+        first_order = [make_pet(400, (200, 120, 40, 255)), make_pet(400, (40, 120, 200, 255))]
+        # 颜色不同、尺寸略有差异但形状相同的第二个订单
+        second_order = [make_pet(404, (90, 90, 90, 255)), make_pet(404, (10, 200, 10, 255))]
+
+        skill.enhance_composition(first_order, template_path, None, layout_cache=cache)
+        first_layouts = [(l.anchor, l.scale) for l in skill.last_layouts]
+        assert (cache.hits, cache.misses) == (0, 1)
+
+        skill.enhance_composition(second_order, template_path, None, layout_cache=cache)
+        assert (cache.hits, cache.misses) == (1, 1)
+        for (anchor1, scale1), layout in zip(first_layouts, skill.last_layouts):
+            assert anchor1 == layout.anchor
+            assert abs(scale1 * 400 - layout.scale * 404) < 1e-6
+
+        # 形状明显不同则不命中
+        descriptor = get_template_descriptor(template_path)
+        wide = Image.new("RGBA", (400, 400), (0, 0, 0, 0))
+        ImageDraw.Draw(wide).rectangle([0, 150, 399, 250], fill=(1, 2, 3, 255))
+        assert build_layout_cache_key(descriptor, first_order) != build_layout_cache_key(descriptor, [wide, wide])
+
+        reloaded = LayoutCache(persist_path=cache_path)
+        assert len(reloaded) == 1
+        skill.enhance_composition(second_order, template_path, None, layout_cache=reloaded)
+        assert reloaded.hits == 1
+    print("布局缓存测试通过")
+
+
+
+
+def test_processing_cache():
+    """测试校验 / 边缘处理缓存：第二次重合成全部命中，结果与不用缓存一致"""
+    print("\n=== 测试校验与边缘处理缓存 ===")
+    import numpy as np
+    from utils.matting_validation import validate_all_pet_mattings
+    from utils.pet_cutout import PetCutout
+    from utils.processing_cache import ProcessingCache
+    from skills.multi_pet_composition_enhancement import MultiPetCompositionEnhancementSkill
+
+    def make_pet(color):
+        pet = Image.new("RGBA", (400, 400), (0, 0, 0, 0))
+        ImageDraw.Draw(pet).ellipse([60, 50, 340, 360], fill=color)
+        return PetCutout.from_image(pet)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "template.png")
+        Image.new("RGBA", (900, 600), (250, 250, 250, 255)).save(template_path)
+        layouts = [PetLayout("pet_a", (0.35, 0.5), 0.8), PetLayout("pet_b", (0.65, 0.5), 0.8)]
+        skill = MultiPetCompositionEnhancementSkill()
+        expected = np.array(skill.enhance_composition(
+            [make_pet((200, 120, 40, 255)), make_pet((40, 120, 200, 255))], template_path, layouts
+        ))
+
+        cache_dir = os.path.join(tmp_dir, "processing_cache")
+        for run in range(2):
+            # 每次重新解码得到新对象，只靠内容哈希命中
+            cache = ProcessingCache(cache_dir)
+            pets = [make_pet((200, 120, 40, 255)), make_pet((40, 120, 200, 255))]
+            all_valid, results = validate_all_pet_mattings(pets, ["pet_a", "pet_b"], cache=cache)
+            assert all_valid and [r.pet_id for r in results] == ["pet_a", "pet_b"]
+            image = skill.enhance_composition(pets, template_path, layouts, processing_cache=cache)
+            print(f"第 {run + 1} 次: 命中 {cache.hits} / 未命中 {cache.misses}")
+            assert (cache.hits, cache.misses) == ((0, 4) if run == 0 else (4, 0))
+            assert np.array_equal(np.array(image), expected)
+
+        # 处理参数不同则不命中
+        cache = ProcessingCache(cache_dir)
+        skill.enhance_composition(pets, template_path, layouts, enable_stroke=True, processing_cache=cache)
+        assert cache.misses == 2
+    print("校验与边缘处理缓存测试通过")
+
+
+def test_parallel_matting():
+    """测试多宠物并行抠图：链内步骤有序、输出顺序与 state 一致、步骤3失败以步骤2兜底"""
+    print("\n=== 测试多宠物并行抠图 ===")
+    import shutil
+    import threading
+    import time
+    import run_multi_pet_matting as matting
+
+    session_id = "test_parallel_matting"
+    state_manager = StateManager()
+    for path in create_test_images():
+        state_manager.add_pet(session_id, path)
+    state_manager.add_pet(session_id, "test_images/pet_1.jpg")
+    pet_ids = [pet.id for pet in state_manager.load_state(session_id).pets]
+
+    calls = []
+    lock = threading.Lock()
+    steps = {"_no_bg.png": 1, "_matting_temp.png": 2, "_extracted.png": 3}
+
+    def fake_remote(image_path, out_path, pet_type="head", backend=None):
+        """模拟远程调用：耗时 100ms，按输出文件名记录步骤；pet_b 的步骤3失败"""
+        time.sleep(0.1)
+        name = os.path.basename(out_path)
+        suffix = next(s for s in steps if name.endswith(s))
+        pet_id, step = name[:-len(suffix)], steps[suffix]
+        with lock:
+            calls.append((pet_id, step))
+        if (pet_id, step) == ("pet_b", 3):
+            raise RuntimeError("模拟远程失败")
+        Image.open(image_path).convert("RGBA").save(out_path, "PNG")
+        return out_path
+
+    originals = (matting.run_background_removal, matting.run_matting)
+    matting.run_background_removal = fake_remote
+    matting.run_matting = fake_remote
+    try:
+        start = time.perf_counter()
+        paths = matting.run_multi_pet_matting(session_id, max_workers=3)
+        elapsed = time.perf_counter() - start
+    finally:
+        matting.run_background_removal, matting.run_matting = originals
+
+    print(f"3 只宠物 x 3 次远程调用: {elapsed * 1000:.0f}ms")
+    assert [os.path.basename(p) for p in paths] == [f"{pid}_extracted.png" for pid in pet_ids]
+    assert all(os.path.isfile(p) for p in paths)
+    for pid in pet_ids:
+        assert [step for p, step in calls if p == pid] == [1, 2, 3]
+    # 串行需 0.9s
+    assert elapsed < 0.6
+    shutil.rmtree(os.path.join("sessions", session_id), ignore_errors=True)
+    print("多宠物并行抠图测试通过")
+
+
+def test_offline_backends():
+    """离线后端跑通整条抠图链：假后端两种模式调用次数一致、结果为 1:1 RGBA；本地 GrabCut 抠出的前景接近真实圆形"""
+    print("\n=== 测试离线抠图后端 ===")
+    import shutil
+    import time
+    import numpy as np
+    from matting_backend import FakeMattingBackend, LocalMattingBackend, MattingBackend
+
+    # 缺少方法的后端在创建时即报错，而不是在抠图链中途
+    class Incomplete(MattingBackend):
+        async def remove_background(self, content, filename="input.png"):
+            return content
+    try:
+        Incomplete()
+        assert False, "未实现 extract_subject 的后端不应能创建"
+    except TypeError:
+        pass
+
+    session_id = "test_offline_backends"
+    state_manager = StateManager()
+    for path in create_test_images():
+        state_manager.add_pet(session_id, path)
+    pet_count = len(state_manager.load_state(session_id).pets)
+
+    try:
+        calls = []
+        for in_memory in (False, True):
+            backend = FakeMattingBackend(latency=0.05)
+            start = time.perf_counter()
+            paths = run_multi_pet_matting(session_id, in_memory=in_memory, backend=backend)
+            print(f"假后端（in_memory={in_memory}）: {(time.perf_counter() - start) * 1000:.0f}ms, {backend.calls}")
+            assert backend.calls["extract_subject"] == pet_count
+            calls.append(backend.calls)
+            for path in paths:
+                image = Image.open(path)
+                assert image.mode == "RGBA" and image.width == image.height
+        assert calls[0] == calls[1]
+
+        paths = run_multi_pet_matting(session_id, in_memory=True, backend=LocalMattingBackend())
+        no_bg = np.array(Image.open(os.path.join("sessions", session_id, "extracted", "pet_a_no_bg.png")))
+        coverage = float((no_bg[:, :, 3] > 128).mean())
+        # 200x200 白底上直径 100 的圆（JPEG 有噪点）
+        assert abs(coverage - np.pi * 50 ** 2 / 200 ** 2) < 0.02, coverage
+        assert all(os.path.isfile(p) for p in paths)
+    finally:
+        shutil.rmtree(os.path.join("sessions", session_id), ignore_errors=True)
+    print("离线抠图后端测试通过")
 
 
 def test_multi_pet_workflow():
@@ -169,6 +537,14 @@ def main():
         # 基础功能测试
         test_state_management()
         test_layout_engine()
+        test_layout_mask_collision()
+        test_layout_many_pets()
+        test_layout_circle_constraints()
+        test_layout_optimizer()
+        test_layout_cache()
+        test_processing_cache()
+        test_parallel_matting()
+        test_offline_backends()
 
         # 完整工作流测试
         test_multi_pet_workflow()
@@ -0,0 +1,771 @@
+# -*- coding: utf-8 -*-
+"""
+测试 Replicate 异步客户端
+用 httpx.MockTransport 模拟上传、预测（starting -> processing -> succeeded）与结果下载，不访问网络
+用法: python test_replicate_client.py
+"""
+import asyncio
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from PIL import Image, ImageDraw
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from matting_backend import ReplicateMattingBackend
+from remote_result_cache import RemoteResultCache
+from remote_policy import AttemptRecord, AttemptTimeout, CallMetrics, RetryPolicy, call_with_policy
+from replicate_async import (POLL_MAX_RETRIES, AsyncReplicateClient, PredictionFailed, ReplicateAPIError,
+                             UploadedFile, extract_output_url)
+from run_background_removal import remove_background_bytes, run_background_removal_async
+from run_pet_image_matting import run_matting_async
+from streaming_download import DownloadError, StreamingDownloader
+from run_multi_pet_matting import make_square_1to1, matting_pipeline_in_memory
+from utils.artifact_writer import ArtifactWriter
+from upload_prepare import prepare_upload
+from upload_registry import UploadRegistry
+
+API_BASE = "https://replicate.test"
+DELIVERY = "https://delivery.test"
+
+
+def _png_bytes(mode: str = "RGBA") -> bytes:
+    image = Image.new(mode, (64, 64), (255, 255, 255, 0) if mode == "RGBA" else (255, 255, 255))
+    ImageDraw.Draw(image).ellipse([8, 8, 56, 56], fill=(200, 120, 40, 255) if mode == "RGBA" else (200, 120, 40))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class FakeReplicate:
+    """最小的 Replicate API 模拟：每个预测轮询两次后成功（入参含 "FAIL" 时失败）"""
+
+    def __init__(self, latency: float = 0.0, output_mode: str = "RGBA",
+                 create_errors=(), hang_predictions: int = 0, poll_errors=(), rejected_urls=()):
+        self.latency = latency
+        self.output = _png_bytes(output_mode)
+        # 依次让创建预测 / 轮询返回这些状态码；前 hang_predictions 个预测一直停在 processing
+        self.create_errors = list(create_errors)
+        self.poll_errors = list(poll_errors)
+        self.hang_predictions = hang_predictions
+        # 入参含这些 URL 的预测创建返回 422（模拟已被删除的上传文件）
+        self.rejected_urls = list(rejected_urls)
+        self.cancelled = []
+        self.predictions = {}
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return self._route(request)
+        finally:
+            self.in_flight -= 1
+
+    def _route(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if url.startswith(DELIVERY):
+            return httpx.Response(200, content=self.output)
+        assert request.headers.get("Authorization") == "Bearer test-token"
+        path = request.url.path
+        if path == "/v1/files":
+            return httpx.Response(201, json={
+                "id": f"file_{len(self.requests)}", "urls": {"get": f"{API_BASE}/v1/files/f{len(self.requests)}"},
+                "expires_at": "2030-01-01T00:00:00Z",
+            })
+        if request.method == "POST" and path.endswith("/cancel"):
+            self.cancelled.append(path.split("/")[-2])
+            return httpx.Response(200, json={"status": "canceled"})
+        if request.method == "POST" and path.endswith("/predictions"):
+            if self.create_errors:
+                return httpx.Response(self.create_errors.pop(0), text="injected")
+            body = request.read().decode("utf-8")
+            if any(url in body for url in self.rejected_urls):
+                return httpx.Response(422, text="input file not found")
+            prediction_id = f"p{len(self.predictions)}"
+            self.predictions[prediction_id] = {"polls": 0, "fail": "FAIL" in body,
+                                               "hang": len(self.predictions) < self.hang_predictions}
+            return httpx.Response(201, json={
+                "id": prediction_id, "status": "starting",
+                "urls": {"get": f"{API_BASE}/v1/predictions/{prediction_id}"},
+            })
+        if request.method == "GET" and path.startswith("/v1/predictions/"):
+            if self.poll_errors:
+                return httpx.Response(self.poll_errors.pop(0), text="injected")
+            prediction_id = path.rsplit("/", 1)[1]
+            state = self.predictions[prediction_id]
+            state["polls"] += 1
+            status = "processing" if state["polls"] < 2 or state["hang"] else ("failed" if state["fail"] else "succeeded")
+            return httpx.Response(200, json={
+                "id": prediction_id, "status": status, "error": "boom" if status == "failed" else None,
+                "output": [f"{DELIVERY}/{prediction_id}.png"] if status == "succeeded" else None,
+            })
+        return httpx.Response(404, text="not found")
+
+
+def _client(fake: FakeReplicate, upload_registry: UploadRegistry = None) -> AsyncReplicateClient:
+    return AsyncReplicateClient(
+        token="test-token", base_url=API_BASE, poll_interval=0.01,
+        transport=httpx.MockTransport(fake.handler), upload_registry=upload_registry,
+    )
+
+
+def test_async_client_pipeline():
+    """上传 -> 预测轮询 -> 流式下载；下载请求不带令牌；nano-banana RGB 输出转为 RGBA"""
+    print("\n=== 测试 Replicate 异步客户端 ===")
+
+    async def scenario(tmp_dir):
+        source = os.path.join(tmp_dir, "pet.png")
+        with open(source, "wb") as f:
+            f.write(_png_bytes("RGB"))
+        fake = FakeReplicate(output_mode="RGB")
+        async with _client(fake) as client:
+            no_cache = RemoteResultCache(max_bytes=0)
+            no_bg = await run_background_removal_async(source, os.path.join(tmp_dir, "no_bg.png"),
+                                                       client=client, result_cache=no_cache)
+            extracted = await run_matting_async(no_bg, "head", os.path.join(tmp_dir, "out.png"),
+                                                client=client, result_cache=no_cache)
+            try:
+                await client.run("google/nano-banana", {"prompt": "FAIL"})
+                assert False, "失败的预测应抛出 PredictionFailed"
+            except PredictionFailed as e:
+                assert e.prediction["status"] == "failed"
+
+        assert Image.open(extracted).mode == "RGBA"
+        paths = [(r.method, r.url.path) for r in fake.requests]
+        assert ("POST", "/v1/predictions") in paths, "版本号模型按 version 创建"
+        assert ("POST", "/v1/models/google/nano-banana/predictions") in paths, "官方模型按模型路径创建"
+        downloads = [r for r in fake.requests if str(r.url).startswith(DELIVERY)]
+        assert len(downloads) == 2 and all("Authorization" not in r.headers for r in downloads)
+        assert not [name for name in os.listdir(tmp_dir) if name.endswith(".part")]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        asyncio.run(scenario(tmp_dir))
+    print("Replicate 异步客户端测试通过")
+
+
+def test_many_predictions_in_flight():
+    """同一事件循环上同时挂起多个预测：总耗时接近单个预测"""
+    print("\n=== 测试并发预测 ===")
+
+    async def scenario(tmp_dir):
+        fake = FakeReplicate(latency=0.05)
+        async with _client(fake) as client:
+            async def one(i):
+                output = await client.run("google/nano-banana", {"prompt": str(i)})
+                return await client.download(output[0], os.path.join(tmp_dir, f"{i}.png"))
+            start = time.perf_counter()
+            paths = await asyncio.gather(*(one(i) for i in range(24)))
+            return paths, time.perf_counter() - start, fake.max_in_flight
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths, elapsed, max_in_flight = asyncio.run(scenario(tmp_dir))
+        print(f"24 个预测: {elapsed * 1000:.0f}ms, 最大同时请求 {max_in_flight}")
+        assert len(set(paths)) == 24 and all(os.path.isfile(p) for p in paths)
+        # 每个预测 4 次请求 x 50ms，串行需 4.8s
+        assert max_in_flight >= 12 and elapsed < 1.5
+    print("并发预测测试通过")
+
+
+def test_remote_result_cache():
+    """结果缓存：相同输入字节离线命中；提示词不同不命中；refresh 重新调用并覆盖；超出容量按 LRU 淘汰"""
+    print("\n=== 测试远程结果缓存 ===")
+
+    def offline(request):
+        raise AssertionError(f"命中缓存时不应访问网络: {request.url}")
+
+    async def scenario(tmp_dir, cache):
+        source = os.path.join(tmp_dir, "pet.png")
+        with open(source, "wb") as f:
+            f.write(_png_bytes())
+        fake = FakeReplicate()
+        async with _client(fake) as client:
+            await run_matting_async(source, "head", os.path.join(tmp_dir, "a.png"), client=client, result_cache=cache)
+            await run_matting_async(source, "full_body", os.path.join(tmp_dir, "b.png"),
+                                    client=client, result_cache=cache)
+        assert cache.stats()["misses"] == 2
+        # 复制出的同字节输入、离线客户端
+        copy = os.path.join(tmp_dir, "copy.png")
+        with open(source, "rb") as f, open(copy, "wb") as g:
+            g.write(f.read())
+        async with AsyncReplicateClient(token="x", base_url=API_BASE,
+                                        transport=httpx.MockTransport(offline)) as client:
+            await run_matting_async(copy, "head", os.path.join(tmp_dir, "c.png"), client=client, result_cache=cache)
+        with open(os.path.join(tmp_dir, "a.png"), "rb") as f, open(os.path.join(tmp_dir, "c.png"), "rb") as g:
+            assert f.read() == g.read()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = RemoteResultCache(os.path.join(tmp_dir, "cache"))
+        asyncio.run(scenario(tmp_dir, cache))
+        stats = cache.stats()
+        print(f"统计: {stats}")
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+        # 两个键输出相同，blob 只存一份
+        assert stats["bytes"] == os.path.getsize(os.path.join(tmp_dir, "a.png"))
+
+        # refresh：不读缓存，重新调用并覆盖条目；之后离线命中的是新结果
+        async def refresh_scenario():
+            source = os.path.join(tmp_dir, "pet.png")
+            fake = FakeReplicate(output_mode="RGB")
+            async with _client(fake) as client:
+                await run_matting_async(source, "head", os.path.join(tmp_dir, "r.png"), client=client,
+                                        result_cache=cache, refresh=True)
+            assert fake.predictions, "refresh 应重新调用模型"
+            async with AsyncReplicateClient(token="x", base_url=API_BASE,
+                                            transport=httpx.MockTransport(offline)) as client:
+                await run_matting_async(source, "head", os.path.join(tmp_dir, "d.png"), client=client,
+                                        result_cache=cache)
+        asyncio.run(refresh_scenario())
+        with open(os.path.join(tmp_dir, "r.png"), "rb") as f, open(os.path.join(tmp_dir, "d.png"), "rb") as g:
+            assert f.read() == g.read()
+        assert cache.stats()["entries"] == 2
+        head_key = next(k for k, e in cache._entries.items()
+                        if cache.get_bytes(k) != _png_bytes())
+        assert cache.invalidate(head_key) and not cache.invalidate(head_key)
+        assert cache.get_bytes(head_key) is None and cache.stats()["entries"] == 1
+
+        # 重新打开读取索引；容量只够两个 blob 时淘汰最久未访问的键
+        reopened = RemoteResultCache(os.path.join(tmp_dir, "cache"), max_bytes=250)
+        for i in range(3):
+            blob = os.path.join(tmp_dir, f"blob{i}.bin")
+            with open(blob, "wb") as f:
+                f.write(bytes([i]) * 100)
+            reopened.put(f"key{i}", blob)
+            time.sleep(0.01)
+        assert reopened.get("key1", os.path.join(tmp_dir, "k1.bin"))
+        assert not reopened.get("key0", os.path.join(tmp_dir, "k0.bin"))
+        assert reopened.total_bytes <= 250 and reopened.evictions >= 1
+    print("远程结果缓存测试通过")
+
+
+def test_upload_registry():
+    """上传登记表：同内容只上传一次；重新打开后复用；临近过期的 URL 重新上传"""
+    print("\n=== 测试上传 URL 复用 ===")
+
+    async def scenario(tmp_dir, registry):
+        source = os.path.join(tmp_dir, "pet.png")
+        with open(source, "wb") as f:
+            f.write(_png_bytes())
+        fake = FakeReplicate()
+        no_cache = RemoteResultCache(max_bytes=0)
+        async with _client(fake, registry) as client:
+            for pet_type in ("head", "full_body", "head"):
+                await run_matting_async(source, pet_type, os.path.join(tmp_dir, f"{pet_type}.png"),
+                                        client=client, result_cache=no_cache)
+        return [r for r in fake.requests if r.url.path == "/v1/files"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "uploads.json")
+        registry = UploadRegistry(path)
+        uploads = asyncio.run(scenario(tmp_dir, registry))
+        assert len(uploads) == 1 and registry.reused == 2, f"同内容应只上传一次: {len(uploads)}"
+
+        # 新进程（重跑）读取持久化的登记表
+        assert not asyncio.run(scenario(tmp_dir, UploadRegistry(path)))
+
+        # 剩余有效期不足 margin（mock 的过期时间为 2030 年）时每次都重新上传
+        stale = UploadRegistry(path, margin=timedelta(days=365 * 100))
+        assert len(asyncio.run(scenario(tmp_dir, stale))) == 3 and stale.reused == 0
+
+    # 复用的 URL 已失效（服务端拒绝）：作废登记、重新上传一次，新 URL 写回登记表
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "uploads.json")
+        content = _png_bytes()
+        content_sha256 = hashlib.sha256(content).hexdigest()
+        dead = f"{API_BASE}/v1/files/deleted"
+        UploadRegistry(path).put(API_BASE, content_sha256,
+                                 UploadedFile("gone", dead, datetime(2030, 1, 1, tzinfo=timezone.utc)))
+        fake = FakeReplicate(rejected_urls=[dead])
+
+        async def rerun():
+            async with _client(fake, UploadRegistry(path)) as client:
+                return await client.run_with_upload("owner/model:version", content, "input.png", "image/png",
+                                                    lambda url: {"image": url})
+        assert asyncio.run(rerun())
+        uploads = [r for r in fake.requests if r.url.path == "/v1/files"]
+        renewed = UploadRegistry(path).get(API_BASE, content_sha256)
+        assert len(uploads) == 1 and renewed is not None and renewed.url != dead, renewed
+    print("上传 URL 复用测试通过")
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """本地 HTTP 替身：/image.png 正常返回，/truncated 声明长度后提前断开，其余 404"""
+    protocol_version = "HTTP/1.1"
+    body = b""
+    connections = 0
+
+    def setup(self):
+        type(self).connections += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/image.png":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+        elif self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body[: len(self.body) // 2])
+            self.close_connection = True
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+def test_streaming_downloader():
+    """本地 HTTP 服务上验证：keep-alive 复用连接、写盘 / 内存 / 边下载边解码、截断与哈希校验、指标"""
+    print("\n=== 测试流式下载器 ===")
+    import hashlib
+
+    body = _png_bytes()
+    _StandInHandler.body = body
+    _StandInHandler.connections = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def scenario(tmp_dir):
+        async with StreamingDownloader(total_timeout=5.0) as downloader:
+            out_path = os.path.join(tmp_dir, "a.png")
+            record = await downloader.to_file(f"{base}/image.png", out_path,
+                                              expected_sha256=hashlib.sha256(body).hexdigest())
+            assert record.bytes == len(body) and record.elapsed >= record.ttfb > 0
+            with open(out_path, "rb") as f:
+                assert f.read() == body
+            assert await downloader.to_bytes(f"{base}/image.png") == body
+            image = await downloader.to_image(f"{base}/image.png", os.path.join(tmp_dir, "b.png"))
+            assert image.mode == "RGBA" and image.size == (64, 64)
+            assert os.path.isfile(os.path.join(tmp_dir, "b.png"))
+            for url, kwargs in [(f"{base}/truncated", {}), (f"{base}/missing", {}),
+                                (f"{base}/image.png", {"expected_sha256": "0" * 64})]:
+                try:
+                    await downloader.to_file(url, os.path.join(tmp_dir, "bad.png"), **kwargs)
+                    assert False, f"{url} 应抛出 DownloadError"
+                except DownloadError:
+                    pass
+            assert not os.path.exists(os.path.join(tmp_dir, "bad.png"))
+            return downloader.metrics.summary()
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            summary = asyncio.run(scenario(tmp_dir))
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"指标: {summary}, 连接数 {_StandInHandler.connections}")
+    assert summary["count"] == 3 and summary["errors"] == 3
+    assert summary["bytes"] == 3 * len(body)
+    # 6 个请求：前 3 个成功请求共用一条 keep-alive 连接，截断响应后连接关闭需要新建
+    assert _StandInHandler.connections < 6
+    print("流式下载器测试通过")
+
+
+def test_in_memory_matting_chain():
+    """内存交接抠图链：结果与文件模式一致；三个产物由后台写出；每步只上传一次；边缘干净时跳过步骤3"""
+    print("\n=== 测试内存交接抠图链 ===")
+    import numpy as np
+
+    async def scenario(tmp_dir):
+        source = os.path.join(tmp_dir, "pet.jpg")
+        Image.open(io.BytesIO(_png_bytes("RGB"))).save(source, "JPEG")
+        pet = SimpleNamespace(id="pet_a", image=source, crop_mode="head")
+        no_cache = RemoteResultCache(max_bytes=0)
+
+        fake = FakeReplicate(output_mode="RGB")
+        with ArtifactWriter() as writer:
+            async with _client(fake) as client:
+                image = await matting_pipeline_in_memory(pet, tmp_dir, ReplicateMattingBackend(client, no_cache),
+                                                         writer, adaptive_step3=False)
+        uploads = [r for r in fake.requests if r.url.path == "/v1/files"]
+
+        # 自适应：mock 的步骤2结果边缘干净（纯色椭圆、无白边），跳过步骤3
+        adaptive_fake = FakeReplicate(output_mode="RGB")
+        with ArtifactWriter() as writer:
+            async with _client(adaptive_fake) as client:
+                await matting_pipeline_in_memory(pet, os.path.join(tmp_dir, "adaptive"),
+                                                 ReplicateMattingBackend(client, no_cache), writer)
+        assert len([r for r in adaptive_fake.requests if r.url.path == "/v1/files"]) == 2
+
+        # 文件模式：逐步写出再读回
+        file_dir = os.path.join(tmp_dir, "file_mode")
+        async with _client(FakeReplicate(output_mode="RGB")) as client:
+            no_bg = await run_background_removal_async(source, os.path.join(file_dir, "no_bg.png"),
+                                                       client=client, result_cache=no_cache)
+            temp = await run_matting_async(no_bg, "head", os.path.join(file_dir, "temp.png"),
+                                           client=client, result_cache=no_cache)
+            final = await run_background_removal_async(temp, os.path.join(file_dir, "final.png"),
+                                                       client=client, result_cache=no_cache)
+        return image, uploads, make_square_1to1(final)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image, uploads, file_result = asyncio.run(scenario(tmp_dir))
+        assert len(uploads) == 3, f"三次远程调用各上传一次: {len(uploads)}"
+        assert image.mode == "RGBA" and image.width == image.height
+        assert np.array_equal(np.array(image), np.array(Image.open(file_result)))
+        for name in ("pet_a_no_bg.png", "pet_a_matting_temp.png", "pet_a_extracted.png"):
+            assert os.path.isfile(os.path.join(tmp_dir, name)), f"缺少产物 {name}"
+        assert np.array_equal(np.array(image), np.array(Image.open(os.path.join(tmp_dir, "pet_a_extracted.png"))))
+        assert not [name for name in os.listdir(tmp_dir) if name.endswith(".tmp")]
+    print("内存交接抠图链测试通过")
+
+
+def test_upload_prepare():
+    """上传前缩小：不透明大图转 JPEG 并记录比例；透明图保持 PNG；上限内的 JPEG 与 16 位灰度图原样上传"""
+    print("\n=== 测试上传前缩小 ===")
+    import numpy as np
+
+    def encode(image, fmt):
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, **({"compress_level": 1} if fmt == "PNG" else {}))
+        return buffer.getvalue()
+
+    rng = np.random.default_rng(0)
+    # 低分辨率噪声放大：有照片般的渐变纹理
+    photo = Image.fromarray(rng.integers(0, 255, (120, 160, 3), dtype=np.uint8)).resize((2560, 1920), Image.BICUBIC)
+    photo_png = encode(photo, "PNG")
+    prepared = prepare_upload(photo_png, 2048)
+    assert prepared.format == "JPEG" and prepared.size == (2048, 1536)
+    assert prepared.scale == 0.8 and len(prepared.content) < len(photo_png)
+    assert Image.open(io.BytesIO(prepared.content)).size == (2048, 1536)
+
+    cutout = Image.new("RGBA", (2400, 1800), (0, 0, 0, 0))
+    ImageDraw.Draw(cutout).ellipse([200, 200, 2200, 1600], fill=(200, 120, 40, 255))
+    prepared = prepare_upload(encode(cutout, "PNG"), 1200)
+    assert prepared.format == "PNG" and prepared.size == (1200, 900) and prepared.scale == 0.5
+    assert Image.open(io.BytesIO(prepared.content)).getchannel("A").getextrema() == (0, 255)
+
+    small_jpeg = encode(photo.resize((800, 600)), "JPEG")
+    prepared = prepare_upload(small_jpeg, 2048)
+    assert prepared.content is small_jpeg and prepared.scale == 1.0
+
+    # 16 位灰度 PNG：转 RGB 会截断成全白，超过上限也原样上传
+    gray16 = Image.fromarray((np.linspace(0, 65535, 2560 * 16).reshape(16, 2560)).astype(np.uint16))
+    gray16_png = encode(gray16, "PNG")
+    assert Image.open(io.BytesIO(gray16_png)).mode.startswith("I")
+    prepared = prepare_upload(gray16_png, 2048)
+    assert prepared.content is gray16_png and prepared.format == "PNG" and prepared.scale == 1.0
+
+    async def scenario():
+        fake = FakeReplicate()
+        async with _client(fake) as client:
+            await remove_background_bytes(photo_png, client=client, result_cache=RemoteResultCache(max_bytes=0),
+                                          filename="photo.png")
+        upload = next(r for r in fake.requests if r.url.path == "/v1/files")
+        return upload.read()
+
+    body = asyncio.run(scenario())
+    assert b'filename="photo.jpg"' in body and len(body) < len(photo_png) / 2
+    print("上传前缩小测试通过")
+
+
+def test_retry_policy():
+    """
+    重试 / 对冲 / 时限：503 退避重试；422 与模型 failed 不重试；轮询 503 / 429 在轮询内重试、不重建预测，
+    轮询持续出错时先取消预测再重试；慢预测被对冲请求超越并取消；持续卡住按时限放弃
+    """
+    print("\n=== 测试远程调用策略 ===")
+    import random
+
+    def policy(**kwargs):
+        defaults = dict(base_delay=0.01, max_delay=0.05, attempt_timeout=5.0, deadline=10.0, rng=random.Random(0))
+        defaults.update(kwargs)
+        return RetryPolicy(**defaults)
+
+    async def call(fake, retry_policy, metrics, prompt="ok"):
+        async with _client(fake) as client:
+            async def attempt() -> bytes:
+                uploaded = await client.upload_bytes(_png_bytes(), "input.png", "image/png")
+                output = await client.run("owner/model:version", {"image": uploaded.url, "prompt": prompt})
+                return await client.download_bytes(extract_output_url(output))
+            return await call_with_policy("background_removal", attempt, retry_policy, metrics)
+
+    metrics = CallMetrics()
+    assert asyncio.run(call(FakeReplicate(create_errors=[503]), policy(), metrics))
+    stats = metrics.summary()["background_removal"]
+    assert (stats["attempts"], stats["ok"], stats["retries"]) == (2, 1, 1), stats
+
+    metrics = CallMetrics()
+    try:
+        asyncio.run(call(FakeReplicate(create_errors=[422]), policy(), metrics))
+        assert False, "422 不应重试"
+    except ReplicateAPIError as e:
+        assert e.status_code == 422
+    assert metrics.summary()["background_removal"]["attempts"] == 1
+
+    # 模型返回 failed：默认不重试（每次都计费）
+    metrics = CallMetrics()
+    fake = FakeReplicate()
+    try:
+        asyncio.run(call(fake, policy(), metrics, prompt="FAIL"))
+        assert False, "failed 的预测应抛出"
+    except PredictionFailed:
+        pass
+    assert len(fake.predictions) == 1 and metrics.summary()["background_removal"]["attempts"] == 1
+
+    # 轮询偶发 503 / 429：在轮询内重试，只创建一个预测
+    metrics = CallMetrics()
+    fake = FakeReplicate(poll_errors=[503, 429])
+    assert asyncio.run(call(fake, policy(), metrics))
+    assert len(fake.predictions) == 1 and not fake.cancelled
+    assert metrics.summary()["background_removal"]["attempts"] == 1
+
+    # 轮询持续出错：放弃前取消远程预测，重试创建的新预测成功
+    metrics = CallMetrics()
+    fake = FakeReplicate(poll_errors=[503] * (POLL_MAX_RETRIES + 1))
+    assert asyncio.run(call(fake, policy(), metrics))
+    print(f"轮询持续出错: 预测 {list(fake.predictions)}, 取消 {fake.cancelled}")
+    assert len(fake.predictions) == 2 and fake.cancelled == ["p0"]
+
+    # 历史成功耗时 ~50ms；首个预测卡住，超过 p50 后发出对冲请求
+    metrics = CallMetrics()
+    for _ in range(3):
+        metrics.record(AttemptRecord("background_removal", 1, False, 0.05, "ok"))
+    fake = FakeReplicate(hang_predictions=1)
+    start = time.perf_counter()
+    assert asyncio.run(call(fake, policy(hedge_percentile=0.5, hedge_min_samples=3), metrics))
+    stats = metrics.summary()["background_removal"]
+    print(f"对冲: {time.perf_counter() - start:.2f}s, {stats}")
+    assert (stats["hedges"], stats["hedge_wins"], stats["retries"]) == (1, 1, 0)
+    assert fake.cancelled == ["p0"], "落败的预测应被取消"
+
+    metrics = CallMetrics()
+    try:
+        asyncio.run(call(FakeReplicate(hang_predictions=10), policy(attempt_timeout=0.2, max_attempts=2), metrics))
+        assert False, "卡住的预测应超时"
+    except AttemptTimeout:
+        pass
+    stats = metrics.summary()["background_removal"]
+    assert (stats["attempts"], stats["timeouts"], stats["ok"]) == (2, 2, 0), stats
+
+    # 经调度器排队：排队 0.3s 不计入 0.2s 的尝试时限与成功耗时
+    from remote_policy import Admission
+    from remote_scheduler import RemoteScheduler, SchedulerConfig
+    scheduler = RemoteScheduler(SchedulerConfig(rate=1000, burst=100, model_concurrency={"owner/model": 1}))
+
+    async def queued_call(fake, retry_policy, metrics, congested=None):
+        async def occupy():
+            async with scheduler.slot("owner/model:version"):
+                await asyncio.sleep(0.3)
+        holder = asyncio.create_task(occupy())
+        await asyncio.sleep(0)
+        admission = Admission(lambda: scheduler.slot("owner/model:version"), congested or scheduler.has_waiters)
+        async with _client(fake) as client:
+            async def attempt() -> bytes:
+                uploaded = await client.upload_bytes(_png_bytes(), "input.png", "image/png")
+                output = await client.run("owner/model:version", {"image": uploaded.url})
+                return await client.download_bytes(extract_output_url(output))
+            result = await call_with_policy("background_removal", attempt, retry_policy, metrics, admission)
+        await holder
+        return result
+
+    metrics = CallMetrics()
+    assert asyncio.run(queued_call(FakeReplicate(), policy(attempt_timeout=0.2, max_attempts=1), metrics))
+    stats = metrics.summary()["background_removal"]
+    assert (stats["attempts"], stats["ok"], stats["timeouts"]) == (1, 1, 0), stats
+    assert metrics.latencies("background_removal")[0] < 0.2, metrics.latencies("background_removal")
+
+    # 调度器拥塞时不对冲：卡住的预测超时后重试，而不是再发一份对冲请求
+    metrics = CallMetrics()
+    for _ in range(3):
+        metrics.record(AttemptRecord("background_removal", 1, False, 0.05, "ok"))
+    fake = FakeReplicate(hang_predictions=1)
+    assert asyncio.run(queued_call(fake, policy(attempt_timeout=0.3, hedge_percentile=0.5, hedge_min_samples=3),
+                                   metrics, congested=lambda: True))
+    stats = metrics.summary()["background_removal"]
+    assert (stats["hedges"], stats["retries"], stats["timeouts"]) == (0, 1, 1), stats
+    print("远程调用策略测试通过")
+
+
+def test_mock_replicate_server():
+    """本地模拟服务器：并发上限返回 429、取消；压测脚本驱动两个会话子进程全部完成"""
+    print("\n=== 测试本地模拟 Replicate 服务器 ===")
+    from load_test_matting import run_load_test
+    from mock_replicate_server import Latency, MockConfig, MockReplicateServer
+
+    fast = dict(upload_latency=Latency(0.01), download_latency=Latency(0.01),
+                model_latency={"background-remover": Latency(0.1), "nano-banana": Latency(0.2, 0.3)}, seed=0)
+
+    async def scenario(base_url):
+        async with AsyncReplicateClient(token="mock", base_url=base_url, poll_interval=0.02) as client:
+            uploaded = await client.upload_bytes(_png_bytes("RGB"), "pet.png", "image/png")
+            first = await client.create_prediction("google/nano-banana", {"image_input": [uploaded.url]})
+            try:
+                await client.create_prediction("google/nano-banana", {"image_input": [uploaded.url]})
+                assert False, "超出并发上限应返回 429"
+            except ReplicateAPIError as e:
+                assert e.status_code == 429
+            await client.cancel_prediction(first)
+            output = await client.run("google/nano-banana", {"image_input": [uploaded.url]})
+            return await client.download_image(extract_output_url(output))
+
+    with MockReplicateServer(MockConfig(max_active_predictions=1, **fast)) as server:
+        image = asyncio.run(scenario(server.base_url))
+        stats = server.stats.summary()
+    assert image.mode == "RGBA" and image.size == (64, 64), "输出缩放到输入尺寸"
+    assert stats["cancelled"] == 1 and stats["injected"] == {"concurrency_429": 1}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result = run_load_test(sessions=2, pets=1, in_memory=True, work_dir=tmp_dir,
+                               config=MockConfig(failure_rate=0.2, **fast))
+        for line in result.summary_lines():
+            print(line)
+        assert not result.failed, [open(run.log_path, encoding="utf-8").read() for run in result.failed]
+        assert result.server_stats["predictions"] >= 4
+    print("本地模拟服务器测试通过")
+
+
+def test_remote_scheduler():
+    """全局调度：interactive 插到排队的 batch 前面；跨线程 / 事件循环的并发上限；令牌桶限速；文件桶跨实例共享"""
+    print("\n=== 测试远程预测调度 ===")
+    import threading
+    from remote_scheduler import Priority, RemoteScheduler, SchedulerConfig
+
+    # 桶容量 1：第一个 batch 立即授予，其余按优先级排队
+    scheduler = RemoteScheduler(SchedulerConfig(rate=50, burst=1, batch_reserve=0))
+    order = []
+
+    async def request(name, priority, delay=0.0):
+        await asyncio.sleep(delay)
+        async with scheduler.slot("owner/model", priority):
+            order.append(name)
+
+    async def priorities():
+        await asyncio.gather(*[request(f"batch{i}", Priority.BATCH) for i in range(3)],
+                             request("interactive", Priority.INTERACTIVE, delay=0.005))
+    asyncio.run(priorities())
+    assert order[:2] == ["batch0", "interactive"], order
+    snapshot = scheduler.snapshot()
+    assert snapshot["wait"]["batch"]["count"] == 3 and snapshot["peak_queue"] >= 3
+    assert not any(snapshot["queued"].values()) and not snapshot["active"]
+
+    # 两个线程各自的事件循环共用调度器：nano-banana 同时最多 2 个
+    scheduler = RemoteScheduler(SchedulerConfig(rate=1000, burst=100, model_concurrency={"nano-banana": 2}))
+    active, peak, lock = [0], [0], threading.Lock()
+
+    async def hold():
+        async with scheduler.slot("google/nano-banana"):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.03)
+            with lock:
+                active[0] -= 1
+
+    async def batch_of_three():
+        await asyncio.gather(*(hold() for _ in range(3)))
+    threads = [threading.Thread(target=asyncio.run, args=(batch_of_three(),)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2, peak
+
+    # 两个实例（模拟两个进程）共用文件桶：容量 2、10 个/秒，6 次授予至少 0.4s
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = dict(rate=10, burst=2, state_path=os.path.join(tmp_dir, "bucket.json"))
+        schedulers = [RemoteScheduler(SchedulerConfig(**config)) for _ in range(2)]
+
+        async def take_all():
+            async def one(s):
+                async with s.slot("owner/model", Priority.INTERACTIVE):
+                    pass
+            await asyncio.gather(*(one(s) for s in schedulers * 3))
+        start = time.perf_counter()
+        asyncio.run(take_all())
+        elapsed = time.perf_counter() - start
+    print(f"共享令牌桶: 6 次授予 {elapsed:.2f}s")
+    assert elapsed >= 0.35, elapsed
+
+    # 文件桶的锁被其他进程长时间持有：取令牌在线程中等待，事件循环照常运行
+    import fcntl
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        state_path = os.path.join(tmp_dir, "bucket.json")
+        scheduler = RemoteScheduler(SchedulerConfig(rate=100, burst=5, state_path=state_path))
+        ticks = []
+
+        async def ticker():
+            for _ in range(10):
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def blocked_take():
+            async with scheduler.slot("owner/model"):
+                pass
+        with open(state_path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            threading.Timer(0.15, fcntl.flock, args=(lock_file, fcntl.LOCK_UN)).start()
+
+            async def both():
+                await asyncio.gather(ticker(), blocked_take())
+            asyncio.run(both())
+        assert ticks[-1] - ticks[0] < 0.14, ticks
+
+    # 等待样本有上限，授予计数仍准确；API 请求单独限速
+    from remote_scheduler import WAIT_SAMPLES
+    scheduler = RemoteScheduler(SchedulerConfig(rate=1e6, burst=10 ** 6, api_rate=20, api_burst=2))
+
+    async def many_grants():
+        for _ in range(WAIT_SAMPLES + 10):
+            async with scheduler.slot("owner/model"):
+                pass
+        start = time.perf_counter()
+        await asyncio.gather(*(scheduler.throttle() for _ in range(4)))
+        return time.perf_counter() - start
+    api_elapsed = asyncio.run(many_grants())
+    snapshot = scheduler.snapshot()
+    assert snapshot["wait"]["interactive"]["count"] == WAIT_SAMPLES + 10
+    assert len(scheduler._waits[Priority.INTERACTIVE]) == WAIT_SAMPLES
+    assert snapshot["api"]["requests"] == 4 and snapshot["api"]["throttled"] == 2, snapshot["api"]
+    assert api_elapsed >= 0.09, api_elapsed
+    print("远程预测调度测试通过")
+
+
+def main():
+    try:
+        test_async_client_pipeline()
+        test_many_predictions_in_flight()
+        test_remote_result_cache()
+        test_upload_registry()
+        test_streaming_downloader()
+        test_in_memory_matting_chain()
+        test_upload_prepare()
+        test_retry_policy()
+        test_mock_replicate_server()
+        test_remote_scheduler()
+    except Exception as e:
+        print(f"\n测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
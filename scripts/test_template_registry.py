@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+测试模板描述缓存
+验证圆形检测、内存缓存命中、sidecar 持久化与 mtime 失效
+用法: python test_template_registry.py
+"""
+import os
+import sys
+import tempfile
+from PIL import Image, ImageDraw
+
+_SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+_PROJECT_ROOT = os.path.dirname(_SCRIPT_DIR)
+
+for path in [_SCRIPT_DIR, _PROJECT_ROOT]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from utils.template_registry import TemplateRegistry
+
+
+def _make_circle_template(path: str, size: int = 200):
+    """透明底 + 中心不透明圆"""
+    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([10, 10, size - 10, size - 10], fill=(250, 220, 230, 255))
+    img.save(path)
+
+
+def test_descriptor_and_sidecar():
+    """测试描述计算与 sidecar 复用"""
+    print("\n=== 测试模板描述缓存 ===")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template_path = os.path.join(tmp_dir, "plain_bg.png")
+        _make_circle_template(template_path)
+
+        registry = TemplateRegistry()
+        descriptor = registry.get(template_path)
+        print(f"描述: {descriptor}")
+        assert descriptor.size == (200, 200)
+        assert descriptor.is_circular, "透明边缘 + 不透明中心应判定为圆形模板"
+        assert abs(descriptor.visual_center[0] - 100) < 1.0
+        # 圆形几何：圆盘 [10, 190]，文字环在圆内
+        assert abs(descriptor.circle_center[0] - 100) < 1.0 and abs(descriptor.circle_radius - 90) < 1.5
+        inner, outer = descriptor.text_annulus
+        assert inner < outer <= descriptor.circle_radius + 1e-6
+        assert descriptor.pet_area_radius == inner
+        assert registry.get(template_path) is descriptor, "同一 mtime 应命中内存缓存"
+        assert os.path.isfile(registry.sidecar_path(os.path.abspath(template_path)))
+
+        # 新注册表（模拟新会话）从 sidecar 读取，不解码像素
+        warm = TemplateRegistry().get(template_path)
+        assert warm.rgba is None, "sidecar 命中时不应解码 RGBA"
+        assert warm.is_circular == descriptor.is_circular
+        assert warm.pet_circle_region == descriptor.pet_circle_region
+        assert warm.get_rgba().shape == (200, 200, 4)
+
+        # 模板被改写（mtime 变化）后描述失效
+        Image.new("RGBA", (300, 100), (255, 255, 255, 255)).save(template_path)
+        os.utime(template_path, ns=(descriptor.mtime_ns + 10**9, descriptor.mtime_ns + 10**9))
+        updated = registry.get(template_path)
+        assert updated.size == (300, 100)
+        assert not updated.is_circular
+        assert updated.pet_circle_region is None
+
+    print("模板描述缓存测试通过")
+
+
+def main():
+    try:
+        test_descriptor_and_sidecar()
+    except Exception as e:
+        print(f"\n测试失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+上传前缩小与重新编码
+input/ 中的手机照片常在 1200 万像素以上，原样上传给去背景与 nano-banana 只会拉长上传与远程处理时间。
+按模型设定的长边上限缩小（JPEG 先用 draft 按 1/2、1/4、1/8 解码），再按内容选择编码：
+- 不透明：JPEG（质量 UPLOAD_JPEG_QUALITY，保留 EXIF 方向信息）或 WebP
+- 有透明通道：PNG（无损，保留抠图边缘）
+已在上限内且编码合适（JPEG / WebP、带透明通道的 PNG）的输入原样上传，不重新编码。
+16 位灰度、32 位整数 / 浮点等高位深模式（I;16、I、F）转 RGB 会截断成全白，同样原样上传。
+环境变量 UPLOAD_MAX_SIDE 统一覆盖各模型的长边上限（0 表示关闭缩小）。
+"""
+import io
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from PIL import Image
+
+UPLOAD_JPEG_QUALITY = 92
+UPLOAD_WEBP_QUALITY = 90
+# 缩小时的 reducing_gap：先整数倍缩小再 LANCZOS，速度接近 draft、质量接近直接 LANCZOS
+REDUCING_GAP = 3.0
+
+_CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+# 无法无损转为 8 位 RGB 的模式：不缩小、不重新编码
+_PASSTHROUGH_MODES = {"I", "I;16", "I;16L", "I;16B", "I;16N", "F"}
+
+
+@dataclass
+class PreparedUpload:
+    """上传内容；scale 为上传图相对原图的缩放比例（未缩小为 1.0）"""
+    content: bytes
+    format: str
+    original_size: Tuple[int, int]
+    size: Tuple[int, int]
+    scale: float = 1.0
+
+    @property
+    def content_type(self) -> str:
+        return _CONTENT_TYPES.get(self.format, "application/octet-stream")
+
+    def filename(self, stem: str = "input") -> str:
+        return f"{stem}{_EXTENSIONS.get(self.format, '')}"
+
+
+def resolve_max_side(default: Optional[int]) -> Optional[int]:
+    """模型默认长边上限，环境变量 UPLOAD_MAX_SIDE 优先；0 / None 表示不缩小"""
+    override = os.getenv("UPLOAD_MAX_SIDE")
+    value = int(override) if override else default
+    return value if value and value > 0 else None
+
+
+def _has_alpha_mode(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+
+def prepare_upload(content: bytes, max_side: Optional[int], opaque_format: str = "JPEG") -> PreparedUpload:
+    """
+    按长边上限缩小并重新编码；无需处理时原样返回
+    opaque_format: 不透明图的编码（JPEG / WEBP）
+    """
+    image = Image.open(io.BytesIO(content))
+    source_format = image.format
+    original_size = image.size
+    scale = min(1.0, max_side / max(original_size)) if max_side else 1.0
+
+    if image.mode in _PASSTHROUGH_MODES or (
+            scale >= 1.0 and (source_format in ("JPEG", "WEBP") or (source_format == "PNG" and _has_alpha_mode(image)))):
+        return PreparedUpload(content, source_format, original_size, original_size)
+
+    exif = image.info.get("exif")
+    target = (max(1, round(original_size[0] * scale)), max(1, round(original_size[1] * scale)))
+    if scale < 1.0:
+        # JPEG：解码时直接按 1/2^k 缩小（不小于目标尺寸），省去大部分解码开销
+        image.draft("RGB", target)
+        image = image.resize(target, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+    if _has_alpha_mode(image):
+        image = image.convert("RGBA")
+        transparent = image.getchannel("A").getextrema()[0] < 255
+    else:
+        transparent = False
+
+    buffer = io.BytesIO()
+    if transparent:
+        output_format = "PNG"
+        image.save(buffer, "PNG")
+    else:
+        output_format = opaque_format.upper()
+        image = image.convert("RGB")
+        quality = UPLOAD_WEBP_QUALITY if output_format == "WEBP" else UPLOAD_JPEG_QUALITY
+        kwargs = {"exif": exif} if exif else {}
+        image.save(buffer, output_format, quality=quality, **kwargs)
+
+    size = image.size
+    return PreparedUpload(buffer.getvalue(), output_format, original_size, size,
+                          scale=size[0] / original_size[0])
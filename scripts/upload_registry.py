@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件 URL 登记表
+run_matting 每次调用 replicate.files.create 重新上传整张图，重试与重跑 run_multi_pet_matting 时
+同一文件几分钟前刚上传过。登记表按「API 地址 + 文件内容 sha256」记录上传返回的 URL 与过期时间，
+距过期还有 UPLOAD_EXPIRY_MARGIN 以上时直接复用，不再上传；复用的 URL 被服务端拒绝时
+由 AsyncReplicateClient.run_with_upload 调用 invalidate 移除记录并重新上传。
+put / invalidate 会重写 JSON 文件，异步调用方经 asyncio.to_thread 调用。
+持久化到 JSON（默认 <项目根>/cache/upload_registry.json，环境变量 UPLOAD_REGISTRY_PATH 覆盖），跨进程复用。
+"""
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from replicate_async import UploadedFile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_REGISTRY_PATH = os.path.join(PROJECT_ROOT, "cache", "upload_registry.json")
+
+# 预测排队 + 模型拉取输入需要时间：剩余有效期不足该值的 URL 不再复用
+UPLOAD_EXPIRY_MARGIN = timedelta(minutes=10)
+# 上传结果未给出过期时间时按该有效期处理
+DEFAULT_UPLOAD_TTL = timedelta(hours=1)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class UploadRegistry:
+    """内容哈希 -> 已上传 URL（带过期时间）；path 为 None 时只在内存中"""
+
+    def __init__(self, path: Optional[str] = None, margin: timedelta = UPLOAD_EXPIRY_MARGIN):
+        self.path = path
+        self.margin = margin
+        self.reused = 0
+        self._lock = threading.Lock()
+        # "api地址|sha256" -> {"id", "url", "expires_at"(ISO)}
+        self._entries: Dict[str, Dict[str, str]] = {}
+        if path:
+            self._load()
+
+    @staticmethod
+    def _key(base_url: str, content_sha256: str) -> str:
+        return f"{base_url}|{content_sha256}"
+
+    def get(self, base_url: str, content_sha256: str) -> Optional[UploadedFile]:
+        """仍有效（距过期 > margin）的上传记录"""
+        with self._lock:
+            entry = self._entries.get(self._key(base_url, content_sha256))
+            if entry is None:
+                return None
+            expires_at = datetime.fromisoformat(entry["expires_at"])
+            if expires_at - self.margin <= _now():
+                return None
+            self.reused += 1
+            return UploadedFile(id=entry["id"], url=entry["url"], expires_at=expires_at,
+                                reused=True, content_sha256=content_sha256)
+
+    def put(self, base_url: str, content_sha256: str, uploaded: UploadedFile):
+        expires_at = uploaded.expires_at or (_now() + DEFAULT_UPLOAD_TTL)
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        with self._lock:
+            self._entries[self._key(base_url, content_sha256)] = {
+                "id": uploaded.id, "url": uploaded.url, "expires_at": expires_at.isoformat(),
+            }
+        self._save()
+
+    def invalidate(self, base_url: str, content_sha256: str):
+        """URL 已失效（如被删除）时移除记录"""
+        with self._lock:
+            self._entries.pop(self._key(base_url, content_sha256), None)
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = dict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            self._entries = {}
+
+    def _save(self):
+        if not self.path:
+            return
+        now = _now()
+        with self._lock:
+            # 顺带清理已过期的记录
+            self._entries = {
+                k: v for k, v in self._entries.items() if datetime.fromisoformat(v["expires_at"]) > now
+            }
+            snapshot = dict(self._entries)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_default_registry: Optional[UploadRegistry] = None
+_default_registry_lock = threading.Lock()
+
+
+def get_upload_registry() -> UploadRegistry:
+    """进程内共享的上传登记表（持久化路径取自 UPLOAD_REGISTRY_PATH）"""
+    global _default_registry
+    with _default_registry_lock:
+        if _default_registry is None:
+            _default_registry = UploadRegistry(os.getenv("UPLOAD_REGISTRY_PATH") or DEFAULT_REGISTRY_PATH)
+        return _default_registry
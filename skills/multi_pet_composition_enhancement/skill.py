@@ -21,20 +21,23 @@ from utils.multi_pet_enhancement import (
     normalize_visual_areas,
     align_group_to_template_center,
     clamp_layout_anchors,
-    is_circular_template,
-    apply_circular_template_scaling,
     CIRCLE_FACTOR_CLAMP_MIN,
     CIRCLE_FACTOR_CLAMP_MAX,
     SCALE_CLAMP_MIN,
     SCALE_CLAMP_MAX,
     ANCHOR_X_LIMITS,
     ANCHOR_Y_LIMITS,
-    CIRCLE_ANCHOR_X_LIMITS,
-    CIRCLE_ANCHOR_Y_LIMITS,
     CIRCLE_VISUAL_CENTER,
 )
-from utils.multi_pet_layout import PetLayout
-from utils.visual_center import compute_visual_center
+from utils.multi_pet_layout import PetLayout, MultiPetLayoutEngine, MAX_PRESET_PETS, create_multi_pet_layout
+from utils.template_registry import TemplateDescriptor, get_template_descriptor
+from utils.compositor import PetPlacement, get_compositor
+from utils.pet_transform import compute_layout_transform
+from utils.pet_cutout import PetImageLike, as_cutout
+from utils.layout_optimizer import build_layout_objective, optimize_layouts
+from utils.layout_cache import CachedLayout, LayoutCache, build_layout_cache_key
+from utils.parallel import parallel_map
+from utils.processing_cache import ProcessingCache
 
 
 class MultiPetCompositionEnhancementSkill:
@@ -43,68 +46,167 @@ class MultiPetCompositionEnhancementSkill:
     
     将多宠物合成从"简单叠图"升级为"规则驱动的视觉排版引擎"
     """
+
+    def __init__(self):
+        # 最近一次合成实际使用的布局（自动布局 / 缓存命中时供调用方记录）
+        self.last_layouts: List[PetLayout] = []
     
     def enhance_composition(
         self,
-        pet_images: List[Image.Image],
+        pet_images: List[PetImageLike],
         template_path: str,
-        layouts: List[PetLayout],
+        layouts: Optional[List[PetLayout]],
         enable_edge_cleaning: bool = True,
         enable_feather: bool = True,
         enable_stroke: bool = False,
         enable_visual_normalization: bool = True,
         enable_group_alignment: bool = True,
-        use_state_layout: bool = False
+        use_state_layout: bool = False,
+        optimize_budget_ms: Optional[float] = None,
+        optimize_seed: int = 0,
+        optimize_iterations: Optional[int] = None,
+        layout_cache: Optional[LayoutCache] = None,
+        max_workers: Optional[int] = None,
+        processing_cache: Optional[ProcessingCache] = None
     ) -> Image.Image:
         """
         增强多宠物合成
 
         Args:
-            pet_images: 宠物抠图结果列表（RGBA）
+            pet_images: 宠物抠图结果列表（RGBA 或 PetCutout；RGBA 会先裁剪到内容，后续只处理可见主体）
             template_path: 模板路径
-            layouts: 布局配置列表
+            layouts: 布局配置列表；为 None 时按模板与宠物自动布局（alpha 占用网格防遮挡）
             enable_edge_cleaning: 是否启用边缘净化
             enable_feather: 是否启用轻度羽化
             enable_stroke: 是否启用内描边
             enable_visual_normalization: 是否启用视觉面积归一化
             enable_group_alignment: 是否启用组合中心对齐
             use_state_layout: 为 True 时使用 state 自定义布局，跳过归一化与组合对齐，仅做边缘处理、anchor 硬约束与圆形缩放
+            optimize_budget_ms: 设置时用布局优化器（utils.layout_optimizer）整体搜索，
+                替代归一化 / 组合对齐 / 圆形缩放的串联启发式；预算按固定比例折算为迭代数
+            optimize_seed: 优化器随机种子（相同种子与迭代数结果可复现）
+            optimize_iterations: 优化器迭代数（None 时由 optimize_budget_ms 折算）
+            layout_cache: 布局缓存（utils.layout_cache）；仅对自动布局（layouts=None）生效，
+                模板几何与宠物形状相近时直接复用最终布局，跳过布局计算
+            max_workers: 逐宠物边缘处理的线程数上限（None 按 CPU 数，1 为串行）
+            processing_cache: 边缘处理结果缓存（utils.processing_cache）；抠图内容与处理参数相同时
+                直接读取会话目录中的处理结果，跳过边缘处理
 
         Returns:
             增强后的合成图像
         """
+        # 模板描述（尺寸、是否圆形、RGBA 缓冲）只计算一次
+        descriptor = get_template_descriptor(template_path)
+
         # 圆形双宠专用：内描边默认开启（升级方案 规范七）
-        is_circle = is_circular_template(template_path)
+        is_circle = descriptor.is_circular
         use_stroke = enable_stroke or is_circle
 
-        # 1. 抠图后边缘展示级处理
-        processed_images = []
-        for pet_image in pet_images:
+        cutouts = parallel_map(as_cutout, pet_images, max_workers=max_workers)
+
+        # 自动布局时先查布局缓存：命中则跳过布局生成、归一化与组合对齐
+        cache_key = None
+        cached = None
+        if layouts is None and layout_cache is not None:
+            cache_key = build_layout_cache_key(descriptor, cutouts, {
+                "edge_cleaning": enable_edge_cleaning,
+                "feather": enable_feather,
+                "stroke": use_stroke,
+                "visual_normalization": enable_visual_normalization,
+                "group_alignment": enable_group_alignment,
+                "optimize_budget_ms": optimize_budget_ms,
+                "optimize_seed": optimize_seed,
+                "optimize_iterations": optimize_iterations,
+            })
+            cached = layout_cache.get(cache_key)
+
+        # 1. 抠图后边缘展示级处理（在裁剪到内容的 PetCutout 上进行，逐宠物并行、按输入顺序返回）
+        edge_params = {"edge_cleaning": enable_edge_cleaning, "feather": enable_feather, "stroke": use_stroke}
+
+        def process(cutout):
+            if processing_cache is not None:
+                cached_image = processing_cache.get_processed(cutout, edge_params)
+                if cached_image is not None:
+                    return cached_image
             processed = process_pet_image_for_display(
-                pet_image,
+                cutout,
                 enable_edge_cleaning=enable_edge_cleaning,
                 enable_feather=enable_feather,
                 enable_stroke=use_stroke
             )
-            processed_images.append(processed)
+            if processing_cache is not None:
+                processing_cache.put_processed(cutout, edge_params, processed)
+            return processed
 
-        # 使用 state 自定义布局时：不归一化、不对齐，只做 anchor 硬约束与圆形缩放
-        if use_state_layout:
-            if is_circle:
-                layouts = clamp_layout_anchors(
-                    layouts,
-                    anchor_x_limits=CIRCLE_ANCHOR_X_LIMITS,
-                    anchor_y_limits=CIRCLE_ANCHOR_Y_LIMITS
+        processed_images = parallel_map(process, cutouts, max_workers=max_workers)
+
+        if cached is not None:
+            layouts = cached.to_layouts(processed_images, descriptor.size)
+        else:
+            if layouts is None:
+                layouts = create_multi_pet_layout(
+                    descriptor.size, len(cutouts), [cutout.size for cutout in cutouts],
+                    pet_images=cutouts, collision_mode="mask", circular=is_circle,
+                    circle_region=descriptor.pet_circle_region
                 )
-            else:
+            layouts = self._resolve_layouts(
+                processed_images, layouts, descriptor,
+                enable_visual_normalization=enable_visual_normalization,
+                enable_group_alignment=enable_group_alignment,
+                use_state_layout=use_state_layout,
+                optimize_budget_ms=optimize_budget_ms,
+                optimize_seed=optimize_seed,
+                optimize_iterations=optimize_iterations
+            )
+            if cache_key is not None:
+                layout_cache.put(cache_key, CachedLayout.from_layouts(
+                    layouts, processed_images, descriptor.size
+                ))
+        self.last_layouts = layouts
+
+        # 10. 合成输出
+        result = self._composite_pets(
+            template_path,
+            processed_images,
+            layouts
+        )
+        
+        return result
+
+    def _resolve_layouts(
+        self,
+        processed_images: List[PetImageLike],
+        layouts: List[PetLayout],
+        descriptor: TemplateDescriptor,
+        enable_visual_normalization: bool,
+        enable_group_alignment: bool,
+        use_state_layout: bool,
+        optimize_budget_ms: Optional[float],
+        optimize_seed: int,
+        optimize_iterations: Optional[int] = None
+    ) -> List[PetLayout]:
+        """步骤 2–9：由初始布局得到最终 anchor / scale"""
+        is_circle = descriptor.is_circular
+
+        # 5 只以上为打包布局（六边形网格 / 行打包 / 同心环）：格子已决定 scale 与位置，
+        # 双宠规范中的 scale 下限与 anchor 范围会破坏打包，不再套用（圆形仍做极坐标约束）
+        packed = len(layouts) > MAX_PRESET_PETS
+
+        # 使用 state 自定义布局时：不归一化、不对齐，只做 anchor 硬约束（圆形为极坐标约束）
+        if use_state_layout:
+            if not packed and not is_circle:
                 layouts = clamp_layout_anchors(
                     layouts,
                     anchor_x_limits=ANCHOR_X_LIMITS,
                     anchor_y_limits=ANCHOR_Y_LIMITS
                 )
-            if is_circle:
-                layouts = apply_circular_template_scaling(layouts, scale_reduction=0.15)
-        else:
+        # 整体优化：重叠、面积均衡、组合中心、anchor 范围一起评分，避免各步互相抵消
+        elif optimize_budget_ms is not None:
+            layouts = self._optimize_layouts(
+                processed_images, layouts, descriptor, optimize_budget_ms, optimize_seed,
+                optimize_iterations
+            )
+        elif not packed:
             # 2–4. 视觉面积归一化 + clamp（圆形用更严 factor 与 scale 上限 1.0）
             if enable_visual_normalization:
                 base_scales = [layout.scale for layout in layouts]
@@ -119,86 +221,102 @@ class MultiPetCompositionEnhancementSkill:
                 for layout, new_scale in zip(layouts, normalized_scales):
                     layout.scale = new_scale
 
-            # 8. 组合视觉中心对齐 + anchor 硬约束（圆形用 circle_visual_center 与专用 anchor 范围）
+            # 8. 组合视觉中心对齐 + anchor 硬约束（圆形对齐 circle_visual_center，范围交给极坐标约束）
             if enable_group_alignment:
-                template = Image.open(template_path)
-                template_size = template.size
-                template.close()
+                template_size = descriptor.size
                 if is_circle:
                     layouts = align_group_to_template_center(
                         processed_images, layouts, template_size,
                         target_center=CIRCLE_VISUAL_CENTER,
-                        anchor_x_limits=CIRCLE_ANCHOR_X_LIMITS,
-                        anchor_y_limits=CIRCLE_ANCHOR_Y_LIMITS
+                        anchor_x_limits=(0.0, 1.0),
+                        anchor_y_limits=(0.0, 1.0)
                     )
                 else:
                     layouts = align_group_to_template_center(
                         processed_images, layouts, template_size
                     )
 
-            # 9. 圆形模板整体缩放兜底（global_scale_multiplier = 0.85）
-            if is_circle:
-                layouts = apply_circular_template_scaling(layouts, scale_reduction=0.15)
-        
-        # 10. 合成输出
-        result = self._composite_pets(
-            template_path,
-            processed_images,
-            layouts
-        )
-        
-        return result
+        # 9. 圆形模板：每只宠物的外接圆约束在圆形内、文字环以内（取代矩形 anchor 范围与 0.85 整体缩放）
+        if is_circle:
+            layouts = self._constrain_to_circle(processed_images, layouts, descriptor)
+
+        return layouts
     
+    def _optimize_layouts(
+        self,
+        pet_images: List[PetImageLike],
+        layouts: List[PetLayout],
+        descriptor: TemplateDescriptor,
+        budget_ms: float,
+        seed: int,
+        max_iterations: Optional[int] = None
+    ) -> List[PetLayout]:
+        """按模板类型设置目标中心、anchor 范围与 scale 范围后运行布局优化器"""
+        if len(layouts) > MAX_PRESET_PETS:
+            # 打包布局：只约束在画布内，保持格子 scale 附近
+            objective = build_layout_objective(
+                pet_images, layouts, descriptor.size, scale_limits=(0.05, SCALE_CLAMP_MAX)
+            )
+        elif descriptor.is_circular:
+            # 圆形：视觉重心略低，外接圆在极坐标下约束进可用圆盘
+            objective = build_layout_objective(
+                pet_images, layouts, descriptor.size,
+                target_center=CIRCLE_VISUAL_CENTER,
+                scale_limits=(0.3, SCALE_CLAMP_MAX),
+                circle_region=descriptor.pet_circle_region
+            )
+        else:
+            objective = build_layout_objective(
+                pet_images, layouts, descriptor.size,
+                anchor_x_limits=ANCHOR_X_LIMITS,
+                anchor_y_limits=ANCHOR_Y_LIMITS,
+                scale_limits=(0.3, SCALE_CLAMP_MAX)
+            )
+        result = optimize_layouts(objective, layouts, budget_ms=budget_ms, seed=seed,
+                                  max_iterations=max_iterations)
+        return result.layouts
+
+    def _constrain_to_circle(
+        self,
+        pet_images: List[PetImageLike],
+        layouts: List[PetLayout],
+        descriptor: TemplateDescriptor
+    ) -> List[PetLayout]:
+        """
+        按模板圆心 / 可用半径做极坐标约束：沿径向内移，外接圆放不下时才缩小；
+        内移会让宠物互相靠近，经防遮挡修正投影后仍重叠的成对缩小
+        """
+        region = descriptor.pet_circle_region
+        if region is None:
+            return layouts
+        engine = MultiPetLayoutEngine(descriptor.width, descriptor.height, circle_region=region)
+        engine.set_pet_images(pet_images)
+        return engine.apply_anti_overlap_corrections(layouts, [as_cutout(p).size for p in pet_images])
+
     def _composite_pets(
         self,
         template_path: str,
-        pet_images: List[Image.Image],
+        pet_images: List[PetImageLike],
         layouts: List[PetLayout]
     ) -> Image.Image:
         """
-        执行最终的合成操作
+        执行最终的合成操作（预乘 alpha 合成器，只在每只宠物的 ROI 内混合，亚像素定位）
+        变换链：裁剪图 -> 原帧（offset）-> 模板画布（scale + 视觉中心对齐锚点）
         """
-        template = Image.open(template_path).convert("RGBA")
-        template_width, template_height = template.size
-        
-        result = Image.new("RGBA", (template_width, template_height), (0, 0, 0, 0))
-        result.paste(template, (0, 0))
+        compositor = get_compositor(template_path)
+        template_size = compositor.size
         
+        placements = []
         for pet_image, layout in zip(pet_images, layouts):
-            if pet_image.mode != 'RGBA':
-                pet_image = pet_image.convert('RGBA')
+            cutout = as_cutout(pet_image)
+            if cutout.width * layout.scale < 1 or cutout.height * layout.scale < 1:
+                continue
             
-            # 缩放宠物图像
-            scaled_width = int(pet_image.width * layout.scale)
-            scaled_height = int(pet_image.height * layout.scale)
-            
-            if scaled_width > 0 and scaled_height > 0:
-                scaled_pet = pet_image.resize(
-                    (scaled_width, scaled_height),
-                    Image.Resampling.LANCZOS
-                )
-                
-                # 计算缩放后的视觉中心
-                cx_scaled, cy_scaled = compute_visual_center(scaled_pet)
-                
-                # 计算粘贴位置
-                anchor_x_px = layout.anchor[0] * template_width
-                anchor_y_px = layout.anchor[1] * template_height
-                
-                paste_x = int(anchor_x_px - cx_scaled)
-                paste_y = int(anchor_y_px - cy_scaled)
-                
-                # 边界检查
-                if paste_x + scaled_width < 0:
-                    paste_x = -scaled_width + 10
-                if paste_x > template_width:
-                    paste_x = template_width - 10
-                if paste_y + scaled_height < 0:
-                    paste_y = -scaled_height + 10
-                if paste_y > template_height:
-                    paste_y = template_height - 10
-                
-                # 粘贴到结果图
-                result.paste(scaled_pet, (paste_x, paste_y), scaled_pet)
+            # 视觉中心在裁剪区域上计算，只累计变换；像素只在最终合成时重采样一次
+            transform = cutout.frame_transform().then(compute_layout_transform(
+                cutout.visual_center(), cutout.size,
+                layout.scale, layout.anchor, template_size
+            ))
+            placements.append(PetPlacement(cutout.image, transform))
         
-        return result
+        return compositor.render(placements)
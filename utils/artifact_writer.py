@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+后台写出中间产物
+内存交接模式下各步骤直接传递解码后的图像 / 字节，*_no_bg.png、*_extracted.png 等落盘产物
+交给后台线程编码写出，不占关键路径。flush() 等待全部写完并抛出第一个写出错误；
+用作上下文管理器时退出前自动 flush。写出先写临时文件再原子替换。
+"""
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Union
+
+from PIL import Image
+
+# PNG 编码释放 GIL，两个线程足够跟上几只宠物的产出
+WRITER_WORKERS = 2
+
+
+def _write_atomic(path: str, payload: Union[bytes, Image.Image]):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        if isinstance(payload, Image.Image):
+            payload.save(tmp_path, "PNG")
+        else:
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ArtifactWriter:
+    """
+    后台产物写出器；提交的图像在写出前不应再被修改
+
+        with ArtifactWriter() as writer:
+            writer.write_bytes(no_bg_path, no_bg)
+            writer.write_image(output_path, image)
+    """
+
+    def __init__(self, max_workers: int = WRITER_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="artifact-writer")
+        self._futures: List[Future] = []
+        self._lock = threading.Lock()
+
+    def write_image(self, path: str, image: Image.Image) -> Future:
+        """后台编码为 PNG 写出"""
+        return self._submit(path, image)
+
+    def write_bytes(self, path: str, data: bytes) -> Future:
+        """后台原样写出（已编码的文件内容，不再重新编码）"""
+        return self._submit(path, data)
+
+    def _submit(self, path: str, payload: Union[bytes, Image.Image]) -> Future:
+        future = self._executor.submit(_write_atomic, path, payload)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return sum(1 for f in self._futures if not f.done())
+
+    def flush(self):
+        """等待已提交的写出全部完成；有失败时按提交顺序抛出第一个错误"""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "ArtifactWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
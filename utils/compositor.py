@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+预乘 alpha 合成器（NumPy）
+多宠物合成时，画布以预乘 float32 保存，每只宠物只在其裁剪后的 ROI 内做 over 混合：
+- 按累计变换（utils.pet_transform）把缩放与亚像素偏移合并为一次 LANCZOS 重采样
+  （Pillow resize 的 box 参数），不再 int() 截断坐标
+- 模板的预乘缓冲按模板缓存复用，多次渲染之间只恢复上次被改动的 ROI
+因此 N 只宠物的合成开销与宠物面积成正比，而非画布面积。
+"""
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.pet_transform import PetTransform
+from utils.template_registry import TemplateDescriptor, get_template_descriptor
+
+# LANCZOS 核半宽（目标像素），ROI 向外扩展以容纳边缘振铃
+_KERNEL_MARGIN = 2
+_COMPOSITOR_CACHE_SIZE = 8
+
+
+@dataclass
+class PetPlacement:
+    """单只宠物在画布上的放置：transform 为宠物图像坐标 -> 画布坐标的累计变换"""
+    image: Image.Image
+    transform: PetTransform
+
+
+def _premultiply(rgba: np.ndarray) -> np.ndarray:
+    """uint8 RGBA -> 预乘 float32（0-1）"""
+    data = rgba.astype(np.float32) / 255.0
+    data[:, :, :3] *= data[:, :, 3:4]
+    return data
+
+
+def _unpremultiply(data: np.ndarray) -> np.ndarray:
+    """预乘 float32 -> uint8 RGBA"""
+    alpha = data[:, :, 3:4]
+    rgb = np.divide(data[:, :, :3], alpha, out=np.zeros_like(data[:, :, :3]), where=alpha > 1e-6)
+    out = np.concatenate([rgb, alpha], axis=2)
+    return np.clip(out * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+def resample_into_roi(image: Image.Image,
+                      transform: PetTransform,
+                      canvas_size: Tuple[int, int]) -> Optional[Tuple[Tuple[int, int, int, int], np.ndarray]]:
+    """
+    按累计变换将宠物图像一次性重采样到画布上的 ROI（缩放 + 亚像素偏移 + 裁剪合并为一次 LANCZOS）
+
+    Returns:
+        ((x0, y0, x1, y1), 预乘 float32 patch)；完全落在画布外时返回 None
+    """
+    scale = transform.scale
+    if scale <= 0 or image.width == 0 or image.height == 0:
+        return None
+    canvas_w, canvas_h = canvas_size
+    ox, oy = transform.offset
+
+    x0 = max(0, math.floor(ox) - _KERNEL_MARGIN)
+    y0 = max(0, math.floor(oy) - _KERNEL_MARGIN)
+    x1 = min(canvas_w, math.ceil(ox + image.width * scale) + _KERNEL_MARGIN)
+    y1 = min(canvas_h, math.ceil(oy + image.height * scale) + _KERNEL_MARGIN)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    # 源图四周补透明边，使 ROI 对应的源区域 box 始终落在图像内
+    pad = math.ceil((_KERNEL_MARGIN + 1) / scale) + 1
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    padded = Image.new('RGBa', (image.width + 2 * pad, image.height + 2 * pad), (0, 0, 0, 0))
+    padded.paste(image.convert('RGBa'), (pad, pad))
+
+    box = (
+        (x0 - ox) / scale + pad,
+        (y0 - oy) / scale + pad,
+        (x1 - ox) / scale + pad,
+        (y1 - oy) / scale + pad,
+    )
+    patch = padded.resize((x1 - x0, y1 - y0), Image.Resampling.LANCZOS, box=box)
+    data = np.asarray(patch, dtype=np.float32) / 255.0
+    # LANCZOS 振铃可能使预乘颜色略大于 alpha，clip 保证合法
+    np.clip(data, 0.0, 1.0, out=data)
+    np.minimum(data[:, :, :3], data[:, :, 3:4], out=data[:, :, :3])
+    return (x0, y0, x1, y1), data
+
+
+class PremultipliedCompositor:
+    """基于单个模板的预乘 alpha 合成器（模板缓冲跨渲染复用）"""
+
+    def __init__(self, descriptor: TemplateDescriptor):
+        self.descriptor = descriptor
+        self.size = descriptor.size
+        self._base_rgba = descriptor.get_rgba()
+        self._base = _premultiply(self._base_rgba)
+        self._canvas = self._base.copy()
+        self._out = np.array(self._base_rgba)
+        self._dirty: List[Tuple[int, int, int, int]] = []
+        self._lock = threading.Lock()
+
+    def render(self, placements: List[PetPlacement]) -> Image.Image:
+        """按顺序将宠物 over 到模板上，返回新的 RGBA 图像"""
+        with self._lock:
+            # 1. 只恢复上次渲染改动过的区域
+            for x0, y0, x1, y1 in self._dirty:
+                self._canvas[y0:y1, x0:x1] = self._base[y0:y1, x0:x1]
+                self._out[y0:y1, x0:x1] = self._base_rgba[y0:y1, x0:x1]
+            self._dirty = []
+
+            # 2. 每只宠物只在自己的 ROI 内混合
+            for placement in placements:
+                resampled = resample_into_roi(placement.image, placement.transform, self.size)
+                if resampled is None:
+                    continue
+                (x0, y0, x1, y1), patch = resampled
+                roi = self._canvas[y0:y1, x0:x1]
+                roi *= 1.0 - patch[:, :, 3:4]
+                roi += patch
+                self._dirty.append((x0, y0, x1, y1))
+
+            # 3. 只把改动区域写回 uint8 输出
+            for x0, y0, x1, y1 in self._dirty:
+                self._out[y0:y1, x0:x1] = _unpremultiply(self._canvas[y0:y1, x0:x1])
+
+            return Image.fromarray(self._out.copy(), 'RGBA')
+
+
+_compositor_cache: "OrderedDict[Tuple[str, int], PremultipliedCompositor]" = OrderedDict()
+_compositor_cache_lock = threading.Lock()
+
+
+def get_compositor(template_path: str) -> PremultipliedCompositor:
+    """按模板（路径 + mtime）获取复用的合成器"""
+    descriptor = get_template_descriptor(template_path)
+    key = (descriptor.path, descriptor.mtime_ns)
+    with _compositor_cache_lock:
+        compositor = _compositor_cache.get(key)
+        if compositor is not None:
+            _compositor_cache.move_to_end(key)
+            return compositor
+    compositor = PremultipliedCompositor(descriptor)
+    with _compositor_cache_lock:
+        _compositor_cache[key] = compositor
+        while len(_compositor_cache) > _COMPOSITOR_CACHE_SIZE:
+            _compositor_cache.popitem(last=False)
+    return compositor
+
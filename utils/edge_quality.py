@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+抠图边缘质量检查
+多宠物抠图的步骤3（再次去背景）用于清理 nano-banana 输出的白边与残留碎片。步骤2结果本身已经干净时，
+这次远程调用是多余的。判定依据：
+1. 校验指标（ValidationResult）：通过通用校验，且最大连通域占比 >= STEP3_MIN_COMPONENT_RATIO（无残留碎片）
+2. 白边（halo）：边缘带内近白色像素的占比比内部高出的部分（白色宠物内部也白，不会误判）
+3. alpha 双峰性：不透明区域中 alpha 接近 0 / 255 的像素占比（大片半透明说明背景没去干净）
+"""
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+from utils.matting_validation import ValidationResult, validate_pet_matting
+from utils.pet_cutout import PetImageLike, as_cutout
+
+# 边缘带宽度（像素）
+HALO_BAND = 2
+# 近白色：RGB 最小分量高于该值
+HALO_WHITE_MIN = 200
+# 边缘带白色占比比内部高出超过该值判定有白边
+HALO_SCORE_MAX = 0.05
+# alpha 在 (ALPHA_LOW, ALPHA_HIGH) 之间视为半透明
+ALPHA_LOW = 16
+ALPHA_HIGH = 239
+BIMODALITY_MIN = 0.9
+# 跳过步骤3要求的最大连通域占比（高于校验失败线 0.80）
+STEP3_MIN_COMPONENT_RATIO = 0.95
+
+
+@dataclass
+class EdgeQuality:
+    """边缘质量：clean 为 True 时可以跳过再次去背景"""
+    clean: bool
+    reason: str  # 不合格原因；合格时为空
+    halo_score: float
+    bimodality: float
+    validation: ValidationResult
+
+    def summary(self) -> str:
+        return (f"白边 {self.halo_score:.3f}, 双峰性 {self.bimodality:.3f}, "
+                f"最大连通域 {self.validation.largest_component_ratio:.3f}")
+
+
+def compute_halo_score(rgba: np.ndarray) -> float:
+    """边缘带（前景内、距透明 <= HALO_BAND 像素）近白色占比 - 内部近白色占比，下限 0"""
+    opaque = (rgba[:, :, 3] > ALPHA_LOW).astype(np.uint8)
+    if not opaque.any():
+        return 0.0
+    kernel = np.ones((3, 3), np.uint8)
+    # 边界外视为透明：贴边的前景也算边缘
+    interior = cv2.erode(opaque, kernel, iterations=HALO_BAND,
+                         borderType=cv2.BORDER_CONSTANT, borderValue=0).astype(bool)
+    band = opaque.astype(bool) & ~interior
+    white = rgba[:, :, :3].min(axis=2) > HALO_WHITE_MIN
+    band_white = float(white[band].mean()) if band.any() else 0.0
+    interior_white = float(white[interior].mean()) if interior.any() else 0.0
+    return max(0.0, band_white - interior_white)
+
+
+def compute_alpha_bimodality(alpha: np.ndarray) -> float:
+    """非透明像素中 alpha 接近 0 或 255 的占比（无前景时为 1）"""
+    visible = alpha[alpha > 0]
+    if visible.size == 0:
+        return 1.0
+    partial = np.count_nonzero((visible > ALPHA_LOW) & (visible < ALPHA_HIGH))
+    return 1.0 - partial / visible.size
+
+
+def assess_edge_quality(image: PetImageLike, pet_id: str = "unknown",
+                        for_circular_template: bool = False) -> EdgeQuality:
+    """检查抠图边缘是否已经干净（只在裁剪到内容的区域上计算）"""
+    validation = validate_pet_matting(image, pet_id, for_circular_template, tiered=False)
+    rgba = np.asarray(as_cutout(image).image.convert("RGBA"))
+    halo = compute_halo_score(rgba)
+    bimodality = compute_alpha_bimodality(rgba[:, :, 3])
+
+    if not validation.valid:
+        reason = f"校验未通过: {validation.reason}"
+    elif validation.largest_component_ratio < STEP3_MIN_COMPONENT_RATIO:
+        reason = f"存在残留碎片（最大连通域 {validation.largest_component_ratio:.3f}）"
+    elif halo > HALO_SCORE_MAX:
+        reason = f"边缘白边（{halo:.3f}）"
+    elif bimodality < BIMODALITY_MIN:
+        reason = f"半透明区域过多（双峰性 {bimodality:.3f}）"
+    else:
+        reason = ""
+    return EdgeQuality(clean=not reason, reason=reason, halo_score=halo,
+                       bimodality=bimodality, validation=validation)
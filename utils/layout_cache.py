@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+多宠物布局缓存
+同一模板、形状相近的头像抠图会反复出现，自动布局（create_multi_pet_layout + 归一化 + 组合对齐）
+的结果只取决于模板几何与每只宠物的大致形状。缓存键：
+- 模板几何：尺寸、是否圆形、alpha 边界框、视觉中心（不含路径，同一模板的副本共享）
+- 宠物数量与每只宠物的量化形状：长宽比、视觉面积占比、视觉中心偏移、相对尺寸档位
+- 影响布局的选项（边缘处理开关、优化器预算与种子等）
+缓存值中的 scale 以「显示尺寸 / 模板短边」保存，命中时按当前抠图原帧尺寸换回 scale。
+内存 LRU，可选 JSON 文件持久化（原子写入）。
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from utils.multi_pet_layout import PetLayout
+from utils.pet_cutout import PetImageLike, as_cutout
+from utils.template_registry import TemplateDescriptor
+
+# 缓存格式版本：布局算法变化时递增，使旧缓存失效
+LAYOUT_CACHE_VERSION = 2
+DEFAULT_MAX_ENTRIES = 256
+
+# 量化步长
+ASPECT_STEP = 0.05
+AREA_RATIO_STEP = 0.02
+CENTER_OFFSET_STEP = 0.02
+# 相对尺寸（原帧长边 / 模板短边）按 1/4 倍频程分档：scale 上限 1.0 等 clamp 与绝对尺寸有关
+SIZE_OCTAVE_STEPS = 4
+
+
+def _quantize(value: float, step: float) -> int:
+    return int(math.floor(value / step + 0.5))
+
+
+def describe_pet_shape(pet: PetImageLike, template_size: Tuple[int, int]) -> Tuple[int, int, int, int, int]:
+    """
+    宠物的量化形状描述：(长宽比, 视觉面积占比, 视觉中心 x 偏移, y 偏移, 相对尺寸档位)
+    只在裁剪区域上统计
+    """
+    from utils.multi_pet_enhancement import compute_visual_area
+
+    cutout = as_cutout(pet)
+    width, height = cutout.frame_size
+    width, height = max(1, width), max(1, height)
+    area_ratio = compute_visual_area(cutout) / float(width * height)
+    cx, cy = cutout.visual_center()
+    offset_x = (cx + 0.5) / width - 0.5
+    offset_y = (cy + 0.5) / height - 0.5
+    relative_size = max(width, height) / float(max(1, min(template_size)))
+    return (
+        _quantize(width / float(height), ASPECT_STEP),
+        _quantize(area_ratio, AREA_RATIO_STEP),
+        _quantize(offset_x, CENTER_OFFSET_STEP),
+        _quantize(offset_y, CENTER_OFFSET_STEP),
+        int(math.floor(math.log2(relative_size) * SIZE_OCTAVE_STEPS + 0.5)),
+    )
+
+
+def build_layout_cache_key(descriptor: TemplateDescriptor,
+                           pet_images: Sequence[PetImageLike],
+                           options: Optional[Dict[str, Any]] = None) -> str:
+    """缓存键（sha1 十六进制）：模板几何 + 宠物数量与量化形状 + 布局选项"""
+    payload = {
+        "version": LAYOUT_CACHE_VERSION,
+        "template": [
+            descriptor.width, descriptor.height, descriptor.is_circular,
+            list(descriptor.alpha_bbox) if descriptor.alpha_bbox else None,
+            [round(v, 1) for v in descriptor.visual_center],
+        ],
+        "pets": [list(describe_pet_shape(pet, descriptor.size)) for pet in pet_images],
+        "options": options or {},
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+@dataclass
+class CachedLayout:
+    """缓存的布局：anchor 相对坐标，display_size = scale * 原帧长边 / 模板短边"""
+    anchors: List[Tuple[float, float]]
+    display_sizes: List[float]
+
+    @classmethod
+    def from_layouts(cls, layouts: Sequence[PetLayout], pet_images: Sequence[PetImageLike],
+                     template_size: Tuple[int, int]) -> "CachedLayout":
+        short_side = float(min(template_size))
+        return cls(
+            anchors=[(float(l.anchor[0]), float(l.anchor[1])) for l in layouts],
+            display_sizes=[
+                l.scale * max(as_cutout(pet).frame_size) / short_side
+                for l, pet in zip(layouts, pet_images)
+            ],
+        )
+
+    def to_layouts(self, pet_images: Sequence[PetImageLike], template_size: Tuple[int, int],
+                   ids: Optional[Sequence[str]] = None) -> List[PetLayout]:
+        short_side = float(min(template_size))
+        layouts = []
+        for i, (anchor, display, pet) in enumerate(zip(self.anchors, self.display_sizes, pet_images)):
+            scale = min(1.0, display * short_side / max(1, max(as_cutout(pet).frame_size)))
+            layouts.append(PetLayout(ids[i] if ids else f"pet_{i}", tuple(anchor), scale))
+        return layouts
+
+    def to_dict(self) -> Dict:
+        return {"anchors": [list(a) for a in self.anchors], "display_sizes": self.display_sizes}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CachedLayout":
+        return cls([tuple(a) for a in data["anchors"]], [float(v) for v in data["display_sizes"]])
+
+
+class LayoutCache:
+    """布局 LRU 缓存，persist_path 非空时同步写入 JSON 文件"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, persist_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, CachedLayout]" = OrderedDict()
+        self._lock = threading.Lock()
+        if persist_path:
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedLayout]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedLayout):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            snapshot = [(k, v.to_dict()) for k, v in self._entries.items()] if self.persist_path else None
+        if snapshot is not None:
+            self._save(snapshot)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def _load(self):
+        if not os.path.isfile(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != LAYOUT_CACHE_VERSION:
+                return
+            for key, value in data.get("entries", [])[-self.max_entries:]:
+                self._entries[key] = CachedLayout.from_dict(value)
+        except (OSError, ValueError, KeyError, TypeError):
+            self._entries.clear()
+
+    def _save(self, snapshot: List[Tuple[str, Dict]]):
+        tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+        try:
+            directory = os.path.dirname(self.persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": LAYOUT_CACHE_VERSION, "entries": snapshot}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.persist_path)
+        except OSError:
+            # 目录只读等情况：仅保留内存缓存
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_default_cache: Optional[LayoutCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_layout_cache(persist_path: Optional[str] = None) -> LayoutCache:
+    """进程内共享的布局缓存；首次调用时的 persist_path 决定是否持久化"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LayoutCache(persist_path=persist_path)
+        return _default_cache
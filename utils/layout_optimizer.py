@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+目标驱动的多宠物布局优化器
+默认流程把默认锚点、calculate_auto_scale、_fix_overlap、normalize_visual_areas、
+align_group_to_template_center 与 anchor clamp 串联执行，后一步常常抵消前一步。
+优化器把这些规则合并为一个整体评分，对整组 (anchor, scale) 搜索：
+- 重叠：宠物视觉圆（按视觉面积折算半径，视觉中心对齐锚点）两两穿透深度
+- 视觉面积均衡：显示面积对数的方差
+- 组合中心：视觉中心均值偏离目标中心
+- anchor 范围 / 画布边界：越界平方惩罚
+- 圆形模板：宠物外接圆在极坐标下超出可用圆盘（ρ + r > R）的平方惩罚
+- 尺寸：scale 偏离初始布局 scale（防止一味缩小来消除重叠）
+搜索为带种子的模拟退火：每轮随机生成一批候选，NumPy 向量化一次评估整批。
+搜索长度只由迭代数决定：未给出 max_iterations 时按 budget_ms 折算（ITERATIONS_PER_MS），
+温度按迭代序号下降，相同 seed 与迭代数结果完全一致，与机器快慢无关。
+墙钟上限为 budget_ms 的 EMERGENCY_BUDGET_FACTOR（2）倍，触发时打印警告并在结果中标记 truncated。
+取舍：折算系数固定（不按本机速度校准）才能让同一 seed 在任何机器上得到同一布局；代价是比参考机器
+慢的主机会用掉更多时间，最多到预算的 2 倍，超过则提前停止（此时结果不保证可复现）。
+"""
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.multi_pet_layout import PetLayout
+from utils.pet_cutout import PetImageLike, as_cutout
+from utils.polar_constraints import compute_bounding_radius
+
+# 各项权重
+WEIGHT_OVERLAP = 60.0
+WEIGHT_BALANCE = 1.0
+WEIGHT_CENTER = 8.0
+WEIGHT_LIMITS = 200.0
+WEIGHT_BOUNDS = 30.0
+WEIGHT_SCALE = 2.0
+WEIGHT_POLAR = 200.0
+
+DEFAULT_BUDGET_MS = 20.0
+# 由耗时预算折算迭代数（参考机器上每轮约 0.2ms，折算后约用掉预算的 80%）
+ITERATIONS_PER_MS = 4
+DEFAULT_MAX_ITERATIONS = 600
+# 墙钟上限：预算的倍数；慢于参考机器 2.5 倍左右的主机会触发，提前停止并标记 truncated
+EMERGENCY_BUDGET_FACTOR = 2.0
+# 每轮向量化评估的候选数
+DEFAULT_BATCH_SIZE = 32
+# 初始/最终温度（相对初始得分）
+INITIAL_TEMPERATURE = 0.05
+FINAL_TEMPERATURE = 1e-4
+# 扰动步长：锚点（相对坐标）与 scale（对数）
+ANCHOR_STEP = 0.04
+SCALE_STEP = 0.06
+# 候选中整组平移（调整组合中心）的比例
+GROUP_MOVE_RATIO = 0.2
+
+
+@dataclass
+class LayoutObjective:
+    """
+    整体布局评分（越小越好）。所有长度以模板短边归一化。
+
+    Args:
+        template_size: 模板尺寸
+        visual_areas: 每只宠物在原帧中的视觉面积（像素）
+        preferred_scales: 初始 scale（尺寸项的参照）
+        target_center: 组合视觉中心目标（相对坐标）
+        anchor_x_limits / anchor_y_limits: anchor 硬约束范围
+        scale_limits: scale 范围
+        circle_region: 圆形模板的宠物可用圆盘 (圆心像素坐标, 半径像素)
+        bounding_radii: 每只宠物外接圆半径（原帧像素，scale=1），circle_region 非空时必需
+    """
+    template_size: Tuple[int, int]
+    visual_areas: np.ndarray
+    preferred_scales: np.ndarray
+    target_center: Tuple[float, float] = (0.5, 0.5)
+    anchor_x_limits: Tuple[float, float] = (0.0, 1.0)
+    anchor_y_limits: Tuple[float, float] = (0.0, 1.0)
+    scale_limits: Tuple[float, float] = (0.05, 1.0)
+    circle_region: Optional[Tuple[Tuple[float, float], float]] = None
+    bounding_radii: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        self.visual_areas = np.maximum(np.asarray(self.visual_areas, dtype=np.float64), 1.0)
+        self.preferred_scales = np.asarray(self.preferred_scales, dtype=np.float64)
+        width, height = self.template_size
+        self._unit = float(min(width, height))
+        # 相对坐标 -> 短边归一化坐标
+        self._aspect = np.array([width, height], dtype=np.float64) / self._unit
+        # scale=1 时视觉圆半径（短边归一化）
+        self._unit_radii = np.sqrt(self.visual_areas / math.pi) / self._unit
+        if self.circle_region is not None:
+            (cx, cy), radius = self.circle_region
+            self._circle_center = np.array([cx, cy], dtype=np.float64) / self._unit
+            self._circle_radius = radius / self._unit
+            self._bounding_unit = np.asarray(self.bounding_radii, dtype=np.float64) / self._unit
+
+    def terms(self, anchors: np.ndarray, scales: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        批量计算各项得分
+
+        Args:
+            anchors: (B, n, 2) 相对坐标
+            scales: (B, n)
+        Returns:
+            各项 (B,) 数组
+        """
+        points = anchors * self._aspect
+        radii = self._unit_radii * scales
+        count = scales.shape[1]
+
+        # 重叠：两两穿透深度平方和
+        if count > 1:
+            delta = points[:, :, None, :] - points[:, None, :, :]
+            distance = np.sqrt((delta ** 2).sum(axis=-1))
+            penetration = np.maximum(0.0, radii[:, :, None] + radii[:, None, :] - distance)
+            upper = np.triu(np.ones((count, count), dtype=bool), k=1)
+            overlap = (penetration ** 2)[:, upper].sum(axis=1)
+        else:
+            overlap = np.zeros(scales.shape[0])
+
+        # 视觉面积均衡：显示面积对数方差
+        log_areas = np.log(self.visual_areas * scales ** 2)
+        balance = log_areas.var(axis=1) if count > 1 else np.zeros(scales.shape[0])
+
+        # 组合中心
+        center = (anchors.mean(axis=1) - np.asarray(self.target_center)) * self._aspect
+        center_term = (center ** 2).sum(axis=1)
+
+        # anchor 范围
+        x, y = anchors[:, :, 0], anchors[:, :, 1]
+        limits = (
+            np.maximum(0.0, self.anchor_x_limits[0] - x) ** 2
+            + np.maximum(0.0, x - self.anchor_x_limits[1]) ** 2
+            + np.maximum(0.0, self.anchor_y_limits[0] - y) ** 2
+            + np.maximum(0.0, y - self.anchor_y_limits[1]) ** 2
+        ).sum(axis=1)
+
+        # 视觉圆超出画布
+        low = np.maximum(0.0, radii[..., None] - points)
+        high = np.maximum(0.0, points + radii[..., None] - self._aspect)
+        bounds = (low ** 2 + high ** 2).sum(axis=(1, 2))
+
+        # 尺寸：偏离初始 scale（对数）
+        size = (np.log(scales / self.preferred_scales) ** 2).mean(axis=1)
+
+        # 圆形：外接圆极坐标越界
+        if self.circle_region is not None:
+            rho = np.sqrt(((points - self._circle_center) ** 2).sum(axis=-1))
+            overshoot = np.maximum(0.0, rho + self._bounding_unit * scales - self._circle_radius)
+            polar = (overshoot ** 2).sum(axis=1)
+        else:
+            polar = np.zeros(scales.shape[0])
+
+        return {
+            "overlap": overlap,
+            "balance": balance,
+            "center": center_term,
+            "limits": limits,
+            "bounds": bounds,
+            "scale": size,
+            "polar": polar,
+        }
+
+    def evaluate(self, anchors: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        """批量总分 (B,)"""
+        terms = self.terms(anchors, scales)
+        return (
+            WEIGHT_OVERLAP * terms["overlap"]
+            + WEIGHT_BALANCE * terms["balance"]
+            + WEIGHT_CENTER * terms["center"]
+            + WEIGHT_LIMITS * terms["limits"]
+            + WEIGHT_BOUNDS * terms["bounds"]
+            + WEIGHT_SCALE * terms["scale"]
+            + WEIGHT_POLAR * terms["polar"]
+        )
+
+
+@dataclass
+class OptimizationResult:
+    """优化结果：layouts 为新的布局对象（不修改输入）"""
+    layouts: List[PetLayout]
+    score: float
+    initial_score: float
+    iterations: int
+    elapsed_ms: float
+    terms: Dict[str, float] = field(default_factory=dict)
+    # 触发墙钟应急上限而提前停止（此时结果不保证可复现）
+    truncated: bool = False
+
+
+def iterations_for_budget(budget_ms: float) -> int:
+    """耗时预算（毫秒）折算的迭代数，不超过 DEFAULT_MAX_ITERATIONS"""
+    return max(1, min(DEFAULT_MAX_ITERATIONS, int(round(budget_ms * ITERATIONS_PER_MS))))
+
+
+def optimize_layouts(objective: LayoutObjective,
+                     layouts: Sequence[PetLayout],
+                     budget_ms: float = DEFAULT_BUDGET_MS,
+                     seed: int = 0,
+                     max_iterations: Optional[int] = None,
+                     batch_size: int = DEFAULT_BATCH_SIZE) -> OptimizationResult:
+    """
+    带种子、定长的模拟退火
+
+    Args:
+        objective: 评分函数
+        layouts: 初始布局（起点）
+        budget_ms: 耗时预算（毫秒）；未给出 max_iterations 时按固定系数折算为迭代数（结果可复现），
+            实际耗时随机器快慢变化，最多到 EMERGENCY_BUDGET_FACTOR 倍（2 倍）时强制停止、标记 truncated
+        seed: 随机种子
+        max_iterations: 迭代数（温度按其计算，与 seed 一起决定结果）；None 时取 iterations_for_budget(budget_ms)
+        batch_size: 每轮候选数
+    """
+    if max_iterations is None:
+        max_iterations = iterations_for_budget(budget_ms)
+    emergency_ms = budget_ms * EMERGENCY_BUDGET_FACTOR
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    count = len(layouts)
+    s_min, s_max = objective.scale_limits
+
+    anchors = np.array([layout.anchor for layout in layouts], dtype=np.float64).reshape(count, 2)
+    scales = np.clip(np.array([layout.scale for layout in layouts], dtype=np.float64), s_min, s_max)
+    current = float(objective.evaluate(anchors[None], scales[None])[0])
+    initial_score = current
+    best_anchors, best_scales, best = anchors.copy(), scales.copy(), current
+
+    iterations = 0
+    truncated = False
+    if count > 0:
+        temperature0 = max(INITIAL_TEMPERATURE * current, 1e-6)
+        batch_index = np.arange(batch_size)
+        while iterations < max_iterations:
+            if (time.perf_counter() - start) * 1000 >= emergency_ms:
+                truncated = True
+                print(f"布局优化超过应急上限 {emergency_ms:.0f}ms，在第 {iterations}/{max_iterations} 轮停止（结果不保证可复现）")
+                break
+            progress = iterations / max_iterations
+            temperature = temperature0 * (FINAL_TEMPERATURE / INITIAL_TEMPERATURE) ** progress
+            step = 1.0 - 0.8 * progress
+
+            # 候选：随机选一只宠物扰动 anchor 与 scale；部分候选整组平移
+            cand_anchors = np.repeat(anchors[None], batch_size, axis=0)
+            cand_scales = np.repeat(scales[None], batch_size, axis=0)
+            picked = rng.integers(0, count, size=batch_size)
+            anchor_noise = rng.normal(0.0, ANCHOR_STEP * step, size=(batch_size, 2))
+            scale_noise = rng.normal(0.0, SCALE_STEP * step, size=batch_size)
+            group_move = rng.random(batch_size) < GROUP_MOVE_RATIO
+            cand_anchors[batch_index, picked] += np.where(group_move[:, None], 0.0, anchor_noise)
+            cand_anchors[group_move] += anchor_noise[group_move][:, None, :]
+            cand_scales[batch_index, picked] *= np.exp(np.where(group_move, 0.0, scale_noise))
+            np.clip(cand_anchors, 0.0, 1.0, out=cand_anchors)
+            np.clip(cand_scales, s_min, s_max, out=cand_scales)
+
+            scores = objective.evaluate(cand_anchors, cand_scales)
+            choice = int(np.argmin(scores))
+            candidate = float(scores[choice])
+            # Metropolis 接受准则
+            if candidate <= current or rng.random() < math.exp(-(candidate - current) / temperature):
+                anchors, scales, current = cand_anchors[choice], cand_scales[choice], candidate
+                if current < best:
+                    best_anchors, best_scales, best = anchors.copy(), scales.copy(), current
+            iterations += 1
+
+    terms = objective.terms(best_anchors[None], best_scales[None])
+    result_layouts = [
+        PetLayout(layout.id, (float(a[0]), float(a[1])), float(s))
+        for layout, a, s in zip(layouts, best_anchors, best_scales)
+    ]
+    return OptimizationResult(
+        layouts=result_layouts,
+        score=best,
+        initial_score=initial_score,
+        iterations=iterations,
+        elapsed_ms=(time.perf_counter() - start) * 1000,
+        terms={name: float(value[0]) for name, value in terms.items()},
+        truncated=truncated,
+    )
+
+
+def build_layout_objective(pet_images: Sequence[PetImageLike],
+                           layouts: Sequence[PetLayout],
+                           template_size: Tuple[int, int],
+                           target_center: Tuple[float, float] = (0.5, 0.5),
+                           anchor_x_limits: Tuple[float, float] = (0.0, 1.0),
+                           anchor_y_limits: Tuple[float, float] = (0.0, 1.0),
+                           scale_limits: Tuple[float, float] = (0.05, 1.0),
+                           preferred_scale_multiplier: float = 1.0,
+                           circle_region: Optional[Tuple[Tuple[float, float], float]] = None) -> LayoutObjective:
+    """由宠物抠图与初始布局构造评分函数（视觉面积、外接圆在裁剪区域上统计）"""
+    from utils.multi_pet_enhancement import compute_visual_area
+
+    areas = [compute_visual_area(as_cutout(image)) for image in pet_images]
+    bounding_radii = None
+    if circle_region is not None:
+        bounding_radii = np.array([compute_bounding_radius(image) for image in pet_images])
+    preferred = [layout.scale * preferred_scale_multiplier for layout in layouts]
+    return LayoutObjective(
+        template_size=template_size,
+        visual_areas=np.array(areas),
+        preferred_scales=np.clip(np.array(preferred), scale_limits[0], scale_limits[1]),
+        target_center=target_center,
+        anchor_x_limits=anchor_x_limits,
+        anchor_y_limits=anchor_y_limits,
+        scale_limits=scale_limits,
+        circle_region=circle_region,
+        bounding_radii=bounding_radii,
+    )
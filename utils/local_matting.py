@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+本地离线抠图（不访问网络）
+供 LocalMattingBackend 使用：基准测试与 CI 无需令牌即可跑通完整抠图链。效果不及远程模型，只求稳定可用：
+- 不透明输入：以图像边框的中位色估计背景，与背景色相近且连通到边框的像素为确定背景、其余相近像素为可能背景，
+  以此初始化 GrabCut（在长边 LOCAL_WORK_SIDE 的缩小图上计算），取最大连通域并填洞，线性放大回原尺寸作为 alpha
+- 已有透明通道的输入（去背景结果再处理）：沿用原 alpha，只保留最大连通域，清掉残留碎片
+输出与输入同尺寸的 RGBA。
+"""
+import cv2
+import numpy as np
+from PIL import Image
+
+from utils.matting_validation import compute_alpha_stats
+
+# GrabCut 计算尺寸（长边，像素）
+LOCAL_WORK_SIDE = 512
+# 估计背景色时取的边框宽度（像素，缩小图坐标）
+BORDER_WIDTH = 4
+# 与背景色的 RGB 距离小于该值视为背景候选
+BG_DISTANCE = 40.0
+GRABCUT_ITERATIONS = 3
+# 已有 alpha 时，高于该值的像素参与连通域判定
+ALPHA_THRESHOLD = 20
+
+
+def _has_transparency(image: Image.Image) -> bool:
+    if image.mode not in ("RGBA", "LA", "PA") and not (image.mode == "P" and "transparency" in image.info):
+        return False
+    return image.convert("RGBA").getchannel("A").getextrema()[0] < 255
+
+
+def largest_component(mask: np.ndarray) -> np.ndarray:
+    """二值 mask 只保留最大连通域（4 邻域）；无前景时原样返回"""
+    stats = compute_alpha_stats(mask)
+    if stats.component_count <= 1:
+        return mask.astype(bool)
+    _, labels = cv2.connectedComponents(np.ascontiguousarray(mask, dtype=np.uint8), connectivity=4)
+    return labels == stats.largest_index + 1
+
+
+def _fill_holes(mask: np.ndarray) -> np.ndarray:
+    """填充前景内部的封闭空洞（与边框不连通的背景）"""
+    background = (~mask).astype(np.uint8)
+    _, labels = cv2.connectedComponents(background, connectivity=4)
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    return mask | ~np.isin(labels, border[border > 0])
+
+
+def estimate_background_color(rgb: np.ndarray, border: int = BORDER_WIDTH) -> np.ndarray:
+    """边框像素的逐通道中位数"""
+    ring = np.concatenate([
+        rgb[:border].reshape(-1, 3), rgb[-border:].reshape(-1, 3),
+        rgb[:, :border].reshape(-1, 3), rgb[:, -border:].reshape(-1, 3),
+    ])
+    return np.median(ring, axis=0)
+
+
+def _grabcut_seed(rgb: np.ndarray) -> np.ndarray:
+    """GrabCut 初始标记：边框连通的背景色 -> 确定背景；其余背景色 -> 可能背景；其他 -> 可能前景"""
+    distance = np.linalg.norm(rgb.astype(np.float32) - estimate_background_color(rgb), axis=2)
+    similar = (distance < BG_DISTANCE).astype(np.uint8)
+    _, labels = cv2.connectedComponents(similar, connectivity=4)
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    sure_background = np.isin(labels, border[border > 0])
+
+    seed = np.full(rgb.shape[:2], cv2.GC_PR_FGD, np.uint8)
+    seed[similar.astype(bool)] = cv2.GC_PR_BGD
+    seed[sure_background] = cv2.GC_BGD
+    return seed
+
+
+def grabcut_mask(rgb: np.ndarray, iterations: int = GRABCUT_ITERATIONS) -> np.ndarray:
+    """不透明图的前景 mask（bool，与输入同尺寸的缩小图）"""
+    seed = _grabcut_seed(rgb)
+    candidates = (seed == cv2.GC_PR_FGD) | (seed == cv2.GC_PR_BGD)
+    if not candidates.any() or not (seed == cv2.GC_BGD).any():
+        # 全是背景色或边框上没有背景：GrabCut 缺一类样本，直接用颜色判定
+        return seed == cv2.GC_PR_FGD
+    mask = seed.copy()
+    try:
+        cv2.grabCut(np.ascontiguousarray(rgb[:, :, ::-1]), mask, None,
+                    np.zeros((1, 65), np.float64), np.zeros((1, 65), np.float64),
+                    iterations, cv2.GC_INIT_WITH_MASK)
+    except cv2.error:
+        return seed == cv2.GC_PR_FGD
+    return (mask == cv2.GC_FGD) | (mask == cv2.GC_PR_FGD)
+
+
+def remove_background_local(image: Image.Image, work_side: int = LOCAL_WORK_SIDE) -> Image.Image:
+    """本地去背景：返回与输入同尺寸的 RGBA"""
+    rgba = image.convert("RGBA")
+    data = np.array(rgba)
+
+    if _has_transparency(image):
+        keep = largest_component(data[:, :, 3] > ALPHA_THRESHOLD)
+        data[~keep, 3] = 0
+        return Image.fromarray(data, "RGBA")
+
+    width, height = rgba.size
+    scale = min(1.0, work_side / max(width, height))
+    small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = np.asarray(rgba.convert("RGB").resize(small_size, Image.BILINEAR)) if scale < 1.0 \
+        else data[:, :, :3]
+
+    mask = grabcut_mask(small)
+    if mask.any():
+        mask = _fill_holes(largest_component(mask))
+    alpha = mask.astype(np.uint8) * 255
+    if scale < 1.0:
+        # 线性放大：边缘留 1~2 像素过渡，其余仍是 0 / 255
+        alpha = cv2.resize(alpha, (width, height), interpolation=cv2.INTER_LINEAR)
+    data[:, :, 3] = alpha
+    return Image.fromarray(data, "RGBA")
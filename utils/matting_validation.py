@@ -4,11 +4,18 @@
 用于多宠物合成前判断每只宠物的抠图是否「像一只宠物」，任一失败则中断或降级。
 参考：升级方案.md 模块一、圆形双宠规范六。
 """
+import cv2
 import numpy as np
 from PIL import Image
-from typing import Tuple, List, Optional
+from typing import TYPE_CHECKING, Tuple, List, Optional
 from dataclasses import dataclass
 
+from utils.parallel import parallel_map
+from utils.pet_cutout import PetCutout, PetImageLike, as_cutout
+
+if TYPE_CHECKING:
+    from utils.processing_cache import ProcessingCache
+
 
 @dataclass
 class ValidationResult:
@@ -19,6 +26,7 @@ class ValidationResult:
     alpha_ratio: float
     largest_component_ratio: float
     aspect_ratio: float
+    tier: str = "full"  # 判定所在层级：coarse / reduced / full
 
 
 # 通用阈值（升级方案 模块一）
@@ -34,6 +42,18 @@ CIRCLE_ALPHA_RATIO_MAX = 0.70
 CIRCLE_ASPECT_RATIO_MIN = 0.7
 CIRCLE_ASPECT_RATIO_MAX = 1.6
 
+# 分级校验：coarse 层 8× 下采样看覆盖率与长宽比，reduced 层 4× 下采样算连通域，
+# 指标距阈值不足 margin 时升级到全分辨率（full）
+TIER_COARSE = "coarse"
+TIER_REDUCED = "reduced"
+TIER_FULL = "full"
+TIER_COARSE_FACTOR = 8
+TIER_REDUCED_FACTOR = 4
+TIER_COVERAGE_MARGIN = 0.01
+TIER_COMPONENT_MARGIN = 0.02
+# 裁剪区域长边小于该值时直接全分辨率校验
+TIERED_MIN_SIDE = 256
+
 
 def _get_alpha_mask_binary(image: Image.Image, threshold: int = 20) -> np.ndarray:
     """获取二值 alpha mask（> threshold 为 1）"""
@@ -43,73 +63,199 @@ def _get_alpha_mask_binary(image: Image.Image, threshold: int = 20) -> np.ndarra
     return (alpha > threshold).astype(np.uint8)
 
 
-def _largest_connected_component_ratio(alpha_binary: np.ndarray) -> float:
+@dataclass
+class AlphaStats:
     """
-    计算最大连通域占所有 alpha 像素的比例。
-    若 < 80% 判定为抠图碎裂/失败。
+    二值 alpha mask 的连通域统计（cv2.connectedComponentsWithStats 一次得到，4 邻域）
+    bboxes 为 (x, y, w, h)，centroids 为 (x, y)，均为 mask 坐标；背景不计入
     """
-    from scipy import ndimage
-    labeled, num_features = ndimage.label(alpha_binary)
-    if num_features == 0:
-        return 0.0
-    total = np.sum(alpha_binary > 0)
-    if total == 0:
-        return 0.0
-    sizes = ndimage.sum(alpha_binary, labeled, range(1, num_features + 1))
-    if sizes.size == 0:
-        return 0.0
-    largest = float(np.max(sizes))
-    return largest / total
+    foreground: int
+    areas: np.ndarray
+    bboxes: np.ndarray
+    centroids: np.ndarray
 
+    @property
+    def component_count(self) -> int:
+        return int(self.areas.size)
 
-def _largest_connected_component_ratio_cv(alpha_binary: np.ndarray) -> float:
-    """最大连通域占比：优先 scipy，否则 4 邻域 BFS。"""
-    try:
-        from scipy import ndimage
-        labeled, num_features = ndimage.label(alpha_binary)
-        if num_features == 0:
-            return 0.0
-        total = int(np.sum(alpha_binary > 0))
-        if total == 0:
-            return 0.0
-        sizes = ndimage.sum(alpha_binary, labeled, range(1, num_features + 1))
-        if sizes.size == 0:
+    @property
+    def largest_index(self) -> int:
+        """最大连通域下标；无前景时为 -1"""
+        return int(np.argmax(self.areas)) if self.areas.size else -1
+
+    @property
+    def largest_component_ratio(self) -> float:
+        """最大连通域占所有 alpha 像素的比例；< 80% 判定为抠图碎裂/失败"""
+        if self.foreground == 0:
             return 0.0
-        largest = float(np.max(sizes))
-        return largest / total
-    except ImportError:
-        pass
-    # 无 scipy：4 邻域 BFS，只向 alpha 邻居扩展
-    h, w = alpha_binary.shape
-    visited = np.zeros_like(alpha_binary, dtype=bool)
-    total = 0
-    largest = 0
-    for y in range(h):
-        for x in range(w):
-            if alpha_binary[y, x] == 0 or visited[y, x]:
-                continue
-            stack = [(y, x)]
-            count = 0
-            while stack:
-                cy, cx = stack.pop()
-                if cy < 0 or cy >= h or cx < 0 or cx >= w or alpha_binary[cy, cx] == 0 or visited[cy, cx]:
-                    continue
-                visited[cy, cx] = True
-                count += 1
-                for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                    ny, nx = cy + dy, cx + dx
-                    if 0 <= ny < h and 0 <= nx < w and alpha_binary[ny, nx] and not visited[ny, nx]:
-                        stack.append((ny, nx))
-            total += count
-            if count > largest:
-                largest = count
-    return largest / total if total > 0 else 0.0
+        return float(self.areas.max()) / self.foreground
+
+
+def compute_alpha_stats(alpha_binary: np.ndarray) -> AlphaStats:
+    """对二值 mask（非 0 为前景）计算连通域面积、边界框与质心"""
+    mask = np.ascontiguousarray(alpha_binary, dtype=np.uint8)
+    if mask.size == 0:
+        return AlphaStats(0, np.zeros(0, np.int64), np.zeros((0, 4), np.int64), np.zeros((0, 2)))
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=4)
+    # 第 0 个标签是背景
+    areas = stats[1:, cv2.CC_STAT_AREA].astype(np.int64)
+    return AlphaStats(
+        foreground=int(areas.sum()),
+        areas=areas,
+        bboxes=stats[1:, :4].astype(np.int64),
+        centroids=centroids[1:],
+    )
+
+
+def _largest_connected_component_ratio(alpha_binary: np.ndarray) -> float:
+    """最大连通域占所有 alpha 像素的比例"""
+    return compute_alpha_stats(alpha_binary).largest_component_ratio
+
+
+def _thresholds(for_circular_template: bool) -> Tuple[float, float, float, float]:
+    """(覆盖率下限, 覆盖率上限, 长宽比下限, 长宽比上限)"""
+    if for_circular_template:
+        return CIRCLE_ALPHA_RATIO_MIN, CIRCLE_ALPHA_RATIO_MAX, CIRCLE_ASPECT_RATIO_MIN, CIRCLE_ASPECT_RATIO_MAX
+    return ALPHA_RATIO_MIN, ALPHA_RATIO_MAX, ASPECT_RATIO_MIN, ASPECT_RATIO_MAX
+
+
+def _coverage_failure(pet_id: str, alpha_ratio: float, aspect_ratio: float,
+                      alpha_min: float, alpha_max: float, tier: str) -> Optional[ValidationResult]:
+    """规则 1：alpha 覆盖率，不通过时返回结果"""
+    if alpha_ratio < alpha_min:
+        reason = f"alpha 覆盖率过低 ({alpha_ratio:.2%})，可能未抠到主体（要求 {alpha_min:.0%}~{alpha_max:.0%}）"
+    elif alpha_ratio > alpha_max:
+        reason = f"alpha 覆盖率过高 ({alpha_ratio:.2%})，可能整张图被保留（要求 {alpha_min:.0%}~{alpha_max:.0%}）"
+    else:
+        return None
+    return ValidationResult(
+        valid=False, pet_id=pet_id, reason=reason,
+        alpha_ratio=alpha_ratio, largest_component_ratio=0.0, aspect_ratio=aspect_ratio, tier=tier
+    )
+
+
+def _component_failure(pet_id: str, alpha_ratio: float, largest_ratio: float,
+                       aspect_ratio: float, tier: str) -> Optional[ValidationResult]:
+    """规则 2：最大连通域占比，不通过时返回结果"""
+    if largest_ratio >= LARGEST_COMPONENT_MIN_RATIO:
+        return None
+    return ValidationResult(
+        valid=False, pet_id=pet_id,
+        reason=f"最大连通域占比过低 ({largest_ratio:.1%})，抠图可能碎裂/失败（要求 >= {LARGEST_COMPONENT_MIN_RATIO:.0%}）",
+        alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=aspect_ratio, tier=tier
+    )
+
+
+def _aspect_failure(pet_id: str, alpha_ratio: float, largest_ratio: float, aspect_ratio: float,
+                    aspect_min: float, aspect_max: float, tier: str) -> Optional[ValidationResult]:
+    """规则 3：长宽比，不通过时返回结果"""
+    if aspect_min <= aspect_ratio <= aspect_max:
+        return None
+    return ValidationResult(
+        valid=False, pet_id=pet_id,
+        reason=f"长宽比异常 ({aspect_ratio:.2f})，可能为规则方块或拉伸残影（要求 {aspect_min}~{aspect_max}）",
+        alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=aspect_ratio, tier=tier
+    )
+
+
+def _validate_full(cutout: PetCutout, pet_id: str, for_circular_template: bool) -> ValidationResult:
+    """全分辨率校验（tier="full"）"""
+    w, h = cutout.frame_size
+    total_pixels = w * h
+    aspect_ratio = w / h if h else 0
+    alpha_min, alpha_max, aspect_min, aspect_max = _thresholds(for_circular_template)
+
+    alpha_bin = _get_alpha_mask_binary(cutout.image, threshold=20)
+    non_zero = np.sum(alpha_bin > 0)
+    alpha_ratio = non_zero / total_pixels if total_pixels > 0 else 0.0
+
+    failure = _coverage_failure(pet_id, alpha_ratio, aspect_ratio, alpha_min, alpha_max, TIER_FULL)
+    if failure:
+        return failure
+    largest_ratio = compute_alpha_stats(alpha_bin).largest_component_ratio
+    failure = (_component_failure(pet_id, alpha_ratio, largest_ratio, aspect_ratio, TIER_FULL)
+               or _aspect_failure(pet_id, alpha_ratio, largest_ratio, aspect_ratio,
+                                  aspect_min, aspect_max, TIER_FULL))
+    if failure:
+        return failure
+    return ValidationResult(
+        valid=True, pet_id=pet_id, reason="",
+        alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=aspect_ratio,
+        tier=TIER_FULL
+    )
+
+
+def _block_areas(size: Tuple[int, int], factor: int) -> np.ndarray:
+    """按 factor 分块后每块的像素数（右/下边缘不足一格的块更小）"""
+    width, height = size
+    widths = np.minimum(factor, width - np.arange(-(-width // factor)) * factor)
+    heights = np.minimum(factor, height - np.arange(-(-height // factor)) * factor)
+    return np.outer(heights, widths).astype(np.float32)
+
+
+def _reduced_coverage(alpha: Image.Image, factor: int) -> np.ndarray:
+    """二值化后按 factor 做 BOX 下采样，返回每块的前景像素数（浮点）"""
+    binary = alpha.point(lambda v: 255 if v > 20 else 0)
+    fraction = np.asarray(binary.reduce(factor), dtype=np.float32) / 255.0
+    return fraction * _block_areas(alpha.size, factor)
+
+
+def _weighted_largest_ratio(counts: np.ndarray, mask: np.ndarray) -> float:
+    """在下采样 mask 上取连通域，按格内前景像素数加权：最大连通域前景量 / 全部前景量"""
+    total = float(counts.sum())
+    count, labels = cv2.connectedComponents(mask.astype(np.uint8), connectivity=4)
+    if count <= 1 or total <= 0:
+        return 0.0
+    sums = np.bincount(labels.ravel(), weights=counts.ravel(), minlength=count)[1:]
+    return float(sums.max()) / total
+
+
+def _validate_tiered(cutout: PetCutout, pet_id: str,
+                     for_circular_template: bool) -> Optional[ValidationResult]:
+    """
+    下采样分级校验：能明确判定时返回结果，任一指标落在阈值附近时返回 None（升级到全分辨率）
+    - coarse：8× 下采样估计覆盖率，长宽比只取决于原帧尺寸
+    - reduced：4× 下采样上算连通域
+    """
+    w, h = cutout.frame_size
+    total_pixels = w * h
+    aspect_ratio = w / h if h else 0
+    alpha_min, alpha_max, aspect_min, aspect_max = _thresholds(for_circular_template)
+    alpha = cutout.image.getchannel('A')
+
+    # 各格前景像素数之和即全分辨率前景量（仅有 8 bit 量化误差）
+    coarse = _reduced_coverage(alpha, TIER_COARSE_FACTOR)
+    alpha_ratio = float(coarse.sum()) / total_pixels if total_pixels > 0 else 0.0
+    if alpha_ratio < alpha_min - TIER_COVERAGE_MARGIN or alpha_ratio > alpha_max + TIER_COVERAGE_MARGIN:
+        return _coverage_failure(pet_id, alpha_ratio, aspect_ratio, alpha_min, alpha_max, TIER_COARSE)
+    failure = _aspect_failure(pet_id, alpha_ratio, 0.0, aspect_ratio, aspect_min, aspect_max, TIER_COARSE)
+    if failure:
+        return failure
+    if alpha_ratio < alpha_min + TIER_COVERAGE_MARGIN or alpha_ratio > alpha_max - TIER_COVERAGE_MARGIN:
+        return None
+
+    # 任一连通域的像素落在 4 邻接的「有前景」格内 -> loose 占比是上界，只用于拒绝；
+    # 整格前景的 4 邻接格在全分辨率下必然相连 -> strict 占比是下界，只用于通过
+    reduced = _reduced_coverage(alpha, TIER_REDUCED_FACTOR)
+    full_blocks = _block_areas(alpha.size, TIER_REDUCED_FACTOR)
+    loose_ratio = _weighted_largest_ratio(reduced, reduced > 0)
+    if loose_ratio < LARGEST_COMPONENT_MIN_RATIO - TIER_COMPONENT_MARGIN:
+        return _component_failure(pet_id, alpha_ratio, loose_ratio, aspect_ratio, TIER_REDUCED)
+    strict_ratio = _weighted_largest_ratio(reduced, reduced >= full_blocks)
+    if strict_ratio < LARGEST_COMPONENT_MIN_RATIO + TIER_COMPONENT_MARGIN:
+        return None
+    return ValidationResult(
+        valid=True, pet_id=pet_id, reason="",
+        alpha_ratio=alpha_ratio, largest_component_ratio=strict_ratio, aspect_ratio=aspect_ratio,
+        tier=TIER_REDUCED
+    )
 
 
 def validate_pet_matting(
-    image: Image.Image,
+    image: PetImageLike,
     pet_id: str = "unknown",
-    for_circular_template: bool = False
+    for_circular_template: bool = False,
+    tiered: bool = True
 ) -> ValidationResult:
     """
     单只宠物抠图结果有效性校验。
@@ -118,82 +264,59 @@ def validate_pet_matting(
     1. alpha 覆盖率在合理范围内（过小=没抠到，过大=整张图）
     2. 最大连通域占比 >= 80%（否则判定抠图碎裂/失败）
     3. 长宽比 sanity（过滤规则方块、拉伸残影）
+
+    分级（tiered=True 且裁剪区域长边 >= TIERED_MIN_SIDE）：先在下采样 mask 上判定，
+    明显通过/失败时提前返回（alpha_ratio、largest_component_ratio 为下采样估计值），
+    指标落在阈值附近才升级到全分辨率；result.tier 记录判定所在层级。
     
     Args:
-        image: RGBA 抠图结果
+        image: RGBA 抠图结果，或 PetCutout（只在裁剪区域上计数，覆盖率与长宽比按原帧计算）
         pet_id: 宠物 ID，用于返回信息
         for_circular_template: 是否圆形双宠模板（使用更严阈值）
+        tiered: 是否启用下采样分级校验
     
     Returns:
-        ValidationResult(valid, pet_id, reason, alpha_ratio, largest_ratio, aspect_ratio)
+        ValidationResult(valid, pet_id, reason, alpha_ratio, largest_ratio, aspect_ratio, tier)
     """
-    if image.mode != 'RGBA':
-        image = image.convert('RGBA')
-    w, h = image.size
-    total_pixels = w * h
-    
-    alpha_min = CIRCLE_ALPHA_RATIO_MIN if for_circular_template else ALPHA_RATIO_MIN
-    alpha_max = CIRCLE_ALPHA_RATIO_MAX if for_circular_template else ALPHA_RATIO_MAX
-    aspect_min = CIRCLE_ASPECT_RATIO_MIN if for_circular_template else ASPECT_RATIO_MIN
-    aspect_max = CIRCLE_ASPECT_RATIO_MAX if for_circular_template else ASPECT_RATIO_MAX
-    
-    alpha_bin = _get_alpha_mask_binary(image, threshold=20)
-    non_zero = np.sum(alpha_bin > 0)
-    alpha_ratio = non_zero / total_pixels if total_pixels > 0 else 0.0
-    
-    # 规则 1：alpha 覆盖率
-    if alpha_ratio < alpha_min:
-        return ValidationResult(
-            valid=False, pet_id=pet_id,
-            reason=f"alpha 覆盖率过低 ({alpha_ratio:.2%})，可能未抠到主体（要求 {alpha_min:.0%}~{alpha_max:.0%}）",
-            alpha_ratio=alpha_ratio, largest_component_ratio=0.0, aspect_ratio=w/h if h else 0
-        )
-    if alpha_ratio > alpha_max:
-        return ValidationResult(
-            valid=False, pet_id=pet_id,
-            reason=f"alpha 覆盖率过高 ({alpha_ratio:.2%})，可能整张图被保留（要求 {alpha_min:.0%}~{alpha_max:.0%}）",
-            alpha_ratio=alpha_ratio, largest_component_ratio=0.0, aspect_ratio=w/h if h else 0
-        )
-    
-    # 规则 2：最大连通域占比
-    largest_ratio = _largest_connected_component_ratio_cv(alpha_bin)
-    if largest_ratio < LARGEST_COMPONENT_MIN_RATIO:
-        return ValidationResult(
-            valid=False, pet_id=pet_id,
-            reason=f"最大连通域占比过低 ({largest_ratio:.1%})，抠图可能碎裂/失败（要求 >= {LARGEST_COMPONENT_MIN_RATIO:.0%}）",
-            alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=w/h if h else 0
-        )
-    
-    # 规则 3：长宽比
-    aspect_ratio = w / h if h else 0
-    if aspect_ratio < aspect_min or aspect_ratio > aspect_max:
-        return ValidationResult(
-            valid=False, pet_id=pet_id,
-            reason=f"长宽比异常 ({aspect_ratio:.2f})，可能为规则方块或拉伸残影（要求 {aspect_min}~{aspect_max}）",
-            alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=aspect_ratio
-        )
-    
-    return ValidationResult(
-        valid=True, pet_id=pet_id, reason="",
-        alpha_ratio=alpha_ratio, largest_component_ratio=largest_ratio, aspect_ratio=aspect_ratio
-    )
+    cutout = as_cutout(image, crop=False)
+    if tiered and max(cutout.image.size) >= TIERED_MIN_SIDE:
+        result = _validate_tiered(cutout, pet_id, for_circular_template)
+        if result is not None:
+            return result
+    return _validate_full(cutout, pet_id, for_circular_template)
 
 
 def validate_all_pet_mattings(
-    pet_images: List[Image.Image],
+    pet_images: List[PetImageLike],
     pet_ids: List[str],
-    for_circular_template: bool = False
+    for_circular_template: bool = False,
+    max_workers: Optional[int] = None,
+    cache: Optional["ProcessingCache"] = None
 ) -> Tuple[bool, List[ValidationResult]]:
     """
     校验多只宠物抠图结果。任一失败则整体不通过。
+    各宠物在有界线程池中并行校验（max_workers=1 为串行），结果按输入顺序截断到第一个失败，
+    与逐只校验、遇错即停的返回值一致。
+    cache（utils.processing_cache）非空时按抠图内容哈希复用已有校验结果。
     
     Returns:
         (all_valid, list of ValidationResult)
     """
-    results = []
-    for img, pid in zip(pet_images, pet_ids):
+    params = {"for_circular_template": for_circular_template}
+
+    def validate(item) -> ValidationResult:
+        img, pid = item
+        if cache is not None:
+            cached = cache.get_validation(img, pid, params)
+            if cached is not None:
+                return cached
         r = validate_pet_matting(img, pet_id=pid, for_circular_template=for_circular_template)
-        results.append(r)
+        if cache is not None:
+            cache.put_validation(img, params, r)
+        return r
+
+    results = parallel_map(validate, list(zip(pet_images, pet_ids)), max_workers=max_workers)
+    for i, r in enumerate(results):
         if not r.valid:
-            return False, results
+            return False, results[:i + 1]
     return True, results
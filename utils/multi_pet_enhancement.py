@@ -9,11 +9,14 @@
 5. 组合视觉中心对齐
 6. 圆形模板整体缩放
 """
+import cv2
 import numpy as np
 from PIL import Image, ImageFilter
 from typing import List, Tuple, Optional
 import math
 
+from utils.pet_cutout import PetCutout, PetImageLike, as_cutout
+
 
 def clean_alpha_edge(image: Image.Image, threshold: int = 10) -> Image.Image:
     """
@@ -123,32 +126,12 @@ def apply_inner_stroke(image: Image.Image,
     # 获取alpha通道
     alpha = np.array(image.split()[3])
     
-    # 找到边缘（alpha > 0 且周围有alpha=0的像素）
-    edge_mask = np.zeros_like(alpha, dtype=bool)
-    
-    # 检查周围像素
-    h, w = alpha.shape
-    for y in range(h):
-        for x in range(w):
-            if alpha[y, x] > 0:  # 当前像素不透明
-                # 检查周围是否有透明像素
-                is_edge = False
-                for dy in range(-stroke_width, stroke_width + 1):
-                    for dx in range(-stroke_width, stroke_width + 1):
-                        if dx == 0 and dy == 0:
-                            continue
-                        ny, nx = y + dy, x + dx
-                        if 0 <= ny < h and 0 <= nx < w:
-                            if alpha[ny, nx] == 0:
-                                is_edge = True
-                                break
-                        else:
-                            # 边界外视为透明
-                            is_edge = True
-                            break
-                    if is_edge:
-                        break
-                edge_mask[y, x] = is_edge
+    # 找到边缘（alpha > 0 且 (2w+1)² 邻域内有 alpha=0 的像素，边界外视为透明）：
+    # 对不透明 mask 做方形腐蚀，被腐蚀掉的不透明像素即边缘
+    opaque = (alpha > 0).astype(np.uint8)
+    kernel = np.ones((2 * stroke_width + 1, 2 * stroke_width + 1), dtype=np.uint8)
+    eroded = cv2.erode(opaque, kernel, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    edge_mask = (opaque > 0) & (eroded == 0)
     
     # 创建描边图层
     stroke_data = np.array(image.copy())
@@ -165,22 +148,30 @@ def apply_inner_stroke(image: Image.Image,
     return result
 
 
-def process_pet_image_for_display(image: Image.Image,
+def process_pet_image_for_display(image: PetImageLike,
                                  enable_edge_cleaning: bool = True,
                                  enable_feather: bool = True,
-                                 enable_stroke: bool = False) -> Image.Image:
+                                 enable_stroke: bool = False) -> PetImageLike:
     """
     对单只宠物图像进行展示级边缘处理
     
     Args:
-        image: 宠物抠图结果（RGBA）
+        image: 宠物抠图结果（RGBA 或 PetCutout；PetCutout 只处理裁剪后的可见区域）
         enable_edge_cleaning: 是否启用边缘净化
         enable_feather: 是否启用轻度羽化
         enable_stroke: 是否启用内描边
     
     Returns:
-        处理后的图像
+        处理后的图像（与输入类型相同）
     """
+    if isinstance(image, PetCutout):
+        return image.with_image(process_pet_image_for_display(
+            image.image,
+            enable_edge_cleaning=enable_edge_cleaning,
+            enable_feather=enable_feather,
+            enable_stroke=enable_stroke
+        ))
+    
     result = image.copy()
     
     if enable_edge_cleaning:
@@ -195,7 +186,7 @@ def process_pet_image_for_display(image: Image.Image,
     return result
 
 
-def compute_visual_area(image: Image.Image, alpha_threshold: int = 20) -> float:
+def compute_visual_area(image: PetImageLike, alpha_threshold: int = 20) -> float:
     """
     计算宠物主体的视觉面积（基于 alpha mask）
     
@@ -203,7 +194,7 @@ def compute_visual_area(image: Image.Image, alpha_threshold: int = 20) -> float:
     去除毛边噪声，得到"人眼感知面积"的近似值。
     
     Args:
-        image: RGBA图像（宠物抠图结果）
+        image: RGBA图像（宠物抠图结果）或 PetCutout（只统计裁剪区域，结果相同）
         alpha_threshold: Alpha阈值，低于此值的像素视为透明（默认20，用于忽略半透明毛边）
     
     Returns:
@@ -214,6 +205,8 @@ def compute_visual_area(image: Image.Image, alpha_threshold: int = 20) -> float:
         - 得到的是"人眼感知面积"的近似值
         - 几何尺寸 ≠ 视觉尺寸（毛多的狗头视觉面积更大，轮廓紧凑的猫头视觉面积更小）
     """
+    if isinstance(image, PetCutout):
+        image = image.image
     if image.mode != 'RGBA':
         image = image.convert('RGBA')
     
@@ -233,7 +226,7 @@ CIRCLE_FACTOR_CLAMP_MIN = 0.80
 CIRCLE_FACTOR_CLAMP_MAX = 1.20
 
 
-def normalize_visual_areas(pet_images: List[Image.Image],
+def normalize_visual_areas(pet_images: List[PetImageLike],
                           base_scales: List[float],
                           reference_index: int = 0,
                           factor_clamp: Tuple[float, float] = (FACTOR_CLAMP_MIN, FACTOR_CLAMP_MAX),
@@ -245,7 +238,7 @@ def normalize_visual_areas(pet_images: List[Image.Image],
     factor 与 scale 均做 clamp，防止异常 area 导致 scale 爆炸（升级方案 模块二）。
     
     Args:
-        pet_images: RGBA 抠图结果
+        pet_images: RGBA 抠图结果（或 PetCutout）
         base_scales: 当前每只宠物的 scale
         reference_index: 参考宠物索引
         factor_clamp: factor 限制 (min, max)，圆形模板建议 (0.80, 1.20)
@@ -278,7 +271,7 @@ def normalize_visual_areas(pet_images: List[Image.Image],
     return normalized_scales
 
 
-def compute_group_visual_center(pet_images: List[Image.Image],
+def compute_group_visual_center(pet_images: List[PetImageLike],
                                layouts: List,
                                template_size: Tuple[int, int]) -> Tuple[float, float]:
     """
@@ -296,7 +289,7 @@ def compute_group_visual_center(pet_images: List[Image.Image],
         - 只影响 anchor，不修改图像内容
     
     Args:
-        pet_images: 宠物图像列表
+        pet_images: 宠物图像列表（或 PetCutout，按原帧坐标计算）
         layouts: 布局列表（包含anchor和scale）
         template_size: 模板尺寸 (width, height)
     
@@ -314,32 +307,27 @@ def compute_group_visual_center(pet_images: List[Image.Image],
     _PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     if _PROJECT_ROOT not in sys.path:
         sys.path.insert(0, _PROJECT_ROOT)
-    from utils.visual_center import compute_visual_center
+    from utils.pet_transform import compute_centered_transform
     
     if len(pet_images) == 0:
         return (template_size[0] / 2, template_size[1] / 2)
     
     # 步骤1：计算每只宠物在模板坐标系中的视觉中心
+    # 只对视觉中心坐标做变换，不重采样图像（缩放只在最终合成时做一次）
     visual_centers = []
     
     for pet_image, layout in zip(pet_images, layouts):
-        # 缩放图像
-        scaled_width = int(pet_image.width * layout.scale)
-        scaled_height = int(pet_image.height * layout.scale)
-        scaled_pet = pet_image.resize((scaled_width, scaled_height), Image.Resampling.LANCZOS)
-        
-        # 计算缩放后的视觉中心（相对于缩放后图像的坐标）
-        cx_local, cy_local = compute_visual_center(scaled_pet)
+        # 原帧坐标系中的视觉中心（PetCutout 只在裁剪区域上计算）
+        cutout = as_cutout(pet_image, crop=False)
+        local_center = cutout.visual_center()
         
         # 转换为模板坐标系
         anchor_x_px = layout.anchor[0] * template_size[0]
         anchor_y_px = layout.anchor[1] * template_size[1]
         
         # 视觉中心在模板中的位置 = 锚点位置 - (视觉中心相对于图像中心的偏移)
-        pet_center_x = anchor_x_px - (scaled_width / 2 - cx_local)
-        pet_center_y = anchor_y_px - (scaled_height / 2 - cy_local)
-        
-        visual_centers.append((pet_center_x, pet_center_y))
+        transform = compute_centered_transform(cutout.frame_size, layout.scale, (anchor_x_px, anchor_y_px))
+        visual_centers.append(transform.map_point(local_center))
     
     # 步骤2：计算组合中心
     if len(visual_centers) == 1:
@@ -367,7 +355,7 @@ CIRCLE_ANCHOR_Y_LIMITS = (0.42, 0.62)
 CIRCLE_VISUAL_CENTER = (0.5, 0.53)  # 圆形模板视觉重心略低于正中心
 
 
-def align_group_to_template_center(pet_images: List[Image.Image],
+def align_group_to_template_center(pet_images: List[PetImageLike],
                                   layouts: List,
                                   template_size: Tuple[int, int],
                                   target_center: Tuple[float, float] = (0.5, 0.5),
@@ -421,6 +409,8 @@ def is_circular_template(template_path: str) -> bool:
     """
     检测模板是否为圆形或强裁切形状
     
+    结果来自模板描述缓存（utils.template_registry），同一模板只解码一次。
+    
     Args:
         template_path: 模板路径
     
@@ -428,40 +418,9 @@ def is_circular_template(template_path: str) -> bool:
         是否为圆形模板
     """
     try:
-        template = Image.open(template_path).convert('RGBA')
-        
-        # 检查alpha通道：如果是圆形模板，边缘会有大量透明区域
-        alpha = np.array(template.split()[3])
-        
-        # 计算中心区域的非透明像素比例
-        h, w = alpha.shape
-        center_h, center_w = h // 2, w // 2
-        center_region = alpha[center_h-h//4:center_h+h//4, center_w-w//4:center_w+w//4]
-        center_opacity = np.sum(center_region > 128) / center_region.size
-        
-        # 计算边缘区域的非透明像素比例
-        edge_mask = np.zeros_like(alpha, dtype=bool)
-        edge_mask[:h//8, :] = True  # 上边缘
-        edge_mask[-h//8:, :] = True  # 下边缘
-        edge_mask[:, :w//8] = True  # 左边缘
-        edge_mask[:, -w//8:] = True  # 右边缘
-        
-        edge_opacity = np.sum(alpha[edge_mask] > 128) / np.sum(edge_mask)
-        
-        # 如果中心区域不透明但边缘区域透明，可能是圆形模板
-        is_circular = center_opacity > 0.7 and edge_opacity < 0.3
-        
-        # 或者检查文件名（含中文模板名）
-        import os
-        filename = os.path.basename(template_path).lower()
-        if 'circle' in filename or 'circular' in filename or 'round' in filename:
-            is_circular = True
-        # 清新粉蓝等圆形背景模板
-        if '清新粉蓝' in template_path or 'qingxin' in template_path or 'fenlan' in template_path:
-            is_circular = True
-        
-        return is_circular
-    except:
+        from utils.template_registry import get_template_descriptor
+        return get_template_descriptor(template_path).is_circular
+    except Exception:
         return False
 
 
@@ -2,11 +2,35 @@
 """
 多宠物自动布局引擎
 根据模板方向和宠物数量选择布局策略，实现防遮挡的自动排版
+碰撞检测两种模式：rect（占用矩形，默认）/ mask（alpha 占用网格，见 utils.occupancy_grid）
 """
 import math
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional, Sequence
 from dataclasses import dataclass
 
+import numpy as np
+
+from utils.occupancy_grid import OccupancyGrid, PetShape, GRID_CELLS
+from utils.pet_cutout import PetImageLike, as_cutout
+from utils.polar_constraints import compute_bounding_radius, polar_overshoot, project_into_circle
+
+COLLISION_MODES = ("rect", "mask")
+
+# 1-4 只使用预设构图；更多宠物使用打包策略
+MAX_PRESET_PETS = 4
+PACKING_STRATEGIES = ("hex_grid", "row_packing", "concentric_rings")
+# 打包区域（相对坐标 left, top, right, bottom）
+PACKING_BOUNDS = (0.06, 0.08, 0.94, 0.92)
+# 宠物外接圆直径占格子直径的比例，留出间隙
+PACKING_FILL = 0.95
+# 宠物尺寸长边差异超过该倍数时改用行打包
+ROW_PACKING_SIZE_RATIO = 1.5
+# 圆形模板同心环：未提供模板圆形几何时的圆心（相对坐标）与可用半径（占短边比例）
+RING_CENTER = (0.5, 0.53)
+RING_RADIUS_RATIO = 0.42
+# 圆形模板投影后成对缩小的最多轮数（0.9^20 ≈ 0.12）
+MAX_CIRCLE_SHRINK_ROUNDS = 20
+
 
 @dataclass
 class PetLayout:
@@ -20,14 +44,123 @@ class PetLayout:
 class MultiPetLayoutEngine:
     """多宠物自动布局引擎"""
 
-    def __init__(self, template_width: int, template_height: int):
+    def __init__(self, template_width: int, template_height: int,
+                 collision_mode: str = "rect", grid_cells: int = GRID_CELLS,
+                 circular: bool = False,
+                 circle_region: Optional[Tuple[Tuple[float, float], float]] = None):
+        if collision_mode not in COLLISION_MODES:
+            raise ValueError(f"不支持的碰撞检测模式: {collision_mode}")
         self.template_width = template_width
         self.template_height = template_height
         self.orientation = "landscape" if template_width >= template_height else "portrait"
+        self.collision_mode = collision_mode
+        self.circular = circular or circle_region is not None
+        # 圆形模板的宠物可用圆盘：(圆心像素坐标, 半径像素)，见 TemplateDescriptor.pet_area_radius
+        self.circle_region = circle_region
+        self.grid = OccupancyGrid((template_width, template_height), grid_cells)
+        self._pet_cutouts = []
+        self._pet_centers = []
+        self._bounding_radii: Optional[List[float]] = None
+        self._shape_cache: Dict[Tuple[int, float], PetShape] = {}
+
+    def set_pet_images(self, pet_images: Sequence[PetImageLike]):
+        """提供宠物抠图（mask 模式必需）：裁剪到内容并预计算视觉中心"""
+        self._pet_cutouts = [as_cutout(image) for image in pet_images]
+        self._pet_centers = [cutout.visual_center() for cutout in self._pet_cutouts]
+        self._bounding_radii = None
+        self._shape_cache = {}
+
+    @property
+    def uses_mask_collision(self) -> bool:
+        return self.collision_mode == "mask" and bool(self._pet_cutouts)
+
+    def get_pet_shape(self, index: int, scale: float) -> PetShape:
+        """第 index 只宠物在给定 scale 下的网格形状（按 scale 缓存）"""
+        key = (index, round(scale, 4))
+        shape = self._shape_cache.get(key)
+        if shape is None:
+            shape = self.grid.rasterize_shape(
+                self._pet_cutouts[index], scale, self._pet_centers[index]
+            )
+            self._shape_cache[key] = shape
+        return shape
+
+    def get_bounding_radii(self, pet_sizes: Sequence[Tuple[int, int]]) -> np.ndarray:
+        """每只宠物外接圆半径（原帧像素，scale=1）；未提供抠图时以原帧长边一半近似"""
+        if self._pet_cutouts and len(self._pet_cutouts) == len(pet_sizes):
+            if self._bounding_radii is None:
+                self._bounding_radii = [compute_bounding_radius(c) for c in self._pet_cutouts]
+            return np.array(self._bounding_radii, dtype=np.float64)
+        return np.array([max(size) / 2.0 for size in pet_sizes], dtype=np.float64)
+
+    def check_circle_constraints(self, layouts: List["PetLayout"],
+                                 pet_sizes: Sequence[Tuple[int, int]]) -> np.ndarray:
+        """极坐标检查：每只宠物外接圆超出可用圆盘的距离（像素，0 为满足）"""
+        if self.circle_region is None or not layouts:
+            return np.zeros(len(layouts))
+        center, limit = self.circle_region
+        points = np.array([self._anchor_px(l.anchor) for l in layouts], dtype=np.float64)
+        radii = self.get_bounding_radii(pet_sizes) * np.array([l.scale for l in layouts])
+        return polar_overshoot(points, radii, center, limit)
+
+    def apply_circle_constraints(self, layouts: List["PetLayout"],
+                                 pet_sizes: Sequence[Tuple[int, int]]) -> List["PetLayout"]:
+        """
+        将每只宠物的外接圆约束进可用圆盘（向量化）：沿径向内移，外接圆本身放不下时才缩小
+        """
+        if self.circle_region is None or not layouts:
+            return layouts
+        center, limit = self.circle_region
+        points = np.array([self._anchor_px(l.anchor) for l in layouts], dtype=np.float64)
+        scales = np.array([l.scale for l in layouts], dtype=np.float64)
+        radii = self.get_bounding_radii(pet_sizes) * scales
+        projected, shrink = project_into_circle(points, radii, center, limit)
+        for layout, point, factor in zip(layouts, projected, shrink):
+            layout.anchor = self._relative_anchor((float(point[0]), float(point[1])))
+            layout.scale = float(layout.scale * factor)
+        return layouts
+
+    def _anchor_px(self, anchor: Tuple[float, float]) -> Tuple[float, float]:
+        return (anchor[0] * self.template_width, anchor[1] * self.template_height)
 
-    def select_layout_strategy(self, pet_count: int) -> str:
-        """根据宠物数量选择布局策略"""
-        if pet_count == 1:
+    def rasterize_layout(self, index: int, layout: "PetLayout") -> np.ndarray:
+        """第 index 只宠物按 layout 放置后的占用位集"""
+        shape = self.get_pet_shape(index, layout.scale)
+        return self.grid.place(shape, self._anchor_px(layout.anchor))
+
+    def compute_mask_overlap(self, layouts: List["PetLayout"], i: int, j: int) -> float:
+        """两只宠物 alpha 占用的重叠面积（模板像素²）"""
+        return self.grid.overlap_area(
+            self.rasterize_layout(i, layouts[i]), self.rasterize_layout(j, layouts[j])
+        )
+
+    def evaluate_candidate_anchors(self, layouts: List["PetLayout"], index: int,
+                                   candidate_anchors: np.ndarray,
+                                   scale: Optional[float] = None) -> np.ndarray:
+        """
+        批量评估第 index 只宠物的候选锚点（相对坐标，N x 2）：
+        返回每个候选与其余宠物占用并集的重叠面积（模板像素²，长度 N）
+        """
+        occupied = self.grid.union(
+            self.rasterize_layout(k, layout) for k, layout in enumerate(layouts) if k != index
+        )
+        shape = self.get_pet_shape(index, layouts[index].scale if scale is None else scale)
+        anchors_px = np.asarray(candidate_anchors, dtype=np.float64).reshape(-1, 2) \
+            * np.array([self.template_width, self.template_height], dtype=np.float64)
+        return self.grid.overlap_areas(shape, anchors_px, occupied)
+
+    def select_layout_strategy(self, pet_count: int,
+                               pet_sizes: Optional[Sequence[Tuple[int, int]]] = None) -> str:
+        """根据宠物数量选择布局策略（5 只以上：圆形模板同心环，尺寸差异大时行打包，否则六边形网格）"""
+        if pet_count > MAX_PRESET_PETS:
+            if self.circular:
+                return "concentric_rings"
+            if pet_sizes:
+                long_sides = [max(w, h) for w, h in pet_sizes]
+                if max(long_sides) > ROW_PACKING_SIZE_RATIO * max(1, min(long_sides)):
+                    return "row_packing"
+            return "hex_grid"
+        elif pet_count == 1:
             return "single"
         elif pet_count == 2:
             return "side_by_side" if self.orientation == "landscape" else "vertical_stack"
@@ -38,9 +171,26 @@ class MultiPetLayoutEngine:
         else:
             raise ValueError(f"不支持 {pet_count} 只宠物")
 
-    def get_default_layouts(self, pet_count: int) -> List[PetLayout]:
-        """获取默认布局配置"""
-        strategy = self.select_layout_strategy(pet_count)
+    def get_default_layouts(self, pet_count: int,
+                            pet_sizes: Optional[Sequence[Tuple[int, int]]] = None) -> List[PetLayout]:
+        """获取默认布局配置（打包策略按 pet_sizes 计算每只宠物的 scale）"""
+        strategy = self.select_layout_strategy(pet_count, pet_sizes)
+
+        if strategy in PACKING_STRATEGIES:
+            if pet_sizes is None:
+                side = min(self.template_width, self.template_height)
+                pet_sizes = [(side, side)] * pet_count
+            if strategy == "row_packing":
+                return self._row_packing_layouts(pet_sizes)
+            if strategy == "concentric_rings":
+                anchors_px, diameter = self._concentric_ring_anchors(pet_count)
+            else:
+                anchors_px, diameter = self._hex_grid_anchors(pet_count)
+            return [
+                PetLayout(f"pet_{i}", self._relative_anchor(anchor),
+                          min(1.0, diameter * PACKING_FILL / max(1, max(pet_sizes[i]))))
+                for i, anchor in enumerate(anchors_px)
+            ]
 
         if strategy == "single":
             return [PetLayout("pet_0", (0.5, 0.55), 1.0)]
@@ -80,6 +230,121 @@ class MultiPetLayoutEngine:
                 PetLayout("pet_3", (0.65, base_y + 0.25), 0.85)
             ]
 
+    def _relative_anchor(self, anchor_px: Tuple[float, float]) -> Tuple[float, float]:
+        return (anchor_px[0] / self.template_width, anchor_px[1] / self.template_height)
+
+    def _packing_area(self) -> Tuple[float, float, float, float]:
+        """打包区域（像素 left, top, width, height）"""
+        left, top, right, bottom = PACKING_BOUNDS
+        return (left * self.template_width, top * self.template_height,
+                (right - left) * self.template_width, (bottom - top) * self.template_height)
+
+    def _hex_grid_anchors(self, pet_count: int) -> Tuple[List[Tuple[float, float]], float]:
+        """
+        六边形网格：奇数行右移半格、行距 √3/2 格，枚举列数取格子直径最大者（O(n)）
+        返回 (锚点像素坐标列表, 格子直径像素)
+        """
+        left, top, area_w, area_h = self._packing_area()
+        row_step = math.sqrt(3) / 2
+        best = None
+        for cols in range(1, pet_count + 1):
+            rows = math.ceil(pet_count / cols)
+            width_units = cols + (0.5 if rows > 1 else 0.0)
+            height_units = 1 + (rows - 1) * row_step
+            diameter = min(area_w / width_units, area_h / height_units)
+            if best is None or diameter > best[0]:
+                best = (diameter, cols, rows, width_units, height_units)
+
+        diameter, cols, rows, width_units, height_units = best
+        x0 = left + (area_w - width_units * diameter) / 2
+        y0 = top + (area_h - height_units * diameter) / 2
+        anchors = []
+        for row in range(rows):
+            count = min(cols, pet_count - row * cols)
+            shift = 0.5 if row % 2 == 1 else 0.0
+            # 不满的行仍落在本行格点上并尽量居中，保证与相邻行的间距
+            start = (cols - count) // 2
+            y = y0 + (0.5 + row * row_step) * diameter
+            for col in range(start, start + count):
+                anchors.append((x0 + (col + 0.5 + shift) * diameter, y))
+        return anchors, diameter
+
+    def _concentric_ring_anchors(self, pet_count: int) -> Tuple[List[Tuple[float, float]], float]:
+        """
+        圆形模板同心环：中心 1 只，第 k 环半径 k·d，容量 floor(π / asin(1/2k))（k=1 时为 6）；
+        由内向外填满，最外环均匀分布。返回 (锚点像素坐标列表, 格子直径像素)
+        """
+        if self.circle_region is not None:
+            (cx, cy), radius = self.circle_region
+        else:
+            cx = RING_CENTER[0] * self.template_width
+            cy = RING_CENTER[1] * self.template_height
+            radius = RING_RADIUS_RATIO * min(self.template_width, self.template_height)
+
+        capacities = [1]
+        while sum(capacities) < pet_count:
+            k = len(capacities)
+            # 加微小余量：k=1 时浮点结果为 5.999…
+            capacities.append(int(math.floor(math.pi / math.asin(1.0 / (2 * k)) + 1e-9)))
+        rings = len(capacities) - 1
+        diameter = radius / (rings + 0.5)
+
+        anchors = [(cx, cy)]
+        remaining = pet_count - 1
+        for k in range(1, rings + 1):
+            count = min(capacities[k], remaining)
+            remaining -= count
+            for n in range(count):
+                angle = -math.pi / 2 + 2 * math.pi * n / count
+                anchors.append((cx + k * diameter * math.cos(angle),
+                                cy + k * diameter * math.sin(angle)))
+        return anchors, diameter
+
+    def _row_packing_layouts(self, pet_sizes: Sequence[Tuple[int, int]]) -> List[PetLayout]:
+        """
+        行打包（尺寸差异大的宠物）：所有宠物统一显示高度 t，按顺序贪心装行；
+        二分查找使总行高放得下的最大 t（每次 O(n)）
+        """
+        left, top, area_w, area_h = self._packing_area()
+        aspects = [w / float(max(1, h)) for w, h in pet_sizes]
+        # 单只宠物宽度也不能超过可用宽度
+        t_max = min([area_h] + [area_w / a for a in aspects if a > 0])
+
+        def pack(t: float) -> List[List[int]]:
+            rows, current, used = [], [], 0.0
+            for i, aspect in enumerate(aspects):
+                width = aspect * t
+                if current and used + width > area_w:
+                    rows.append(current)
+                    current, used = [], 0.0
+                current.append(i)
+                used += width
+            rows.append(current)
+            return rows
+
+        lo, hi = 0.0, t_max
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            if len(pack(mid)) * mid <= area_h:
+                lo = mid
+            else:
+                hi = mid
+        t = lo
+        rows = pack(t)
+
+        layouts = [None] * len(pet_sizes)
+        y = top + (area_h - len(rows) * t) / 2 + t / 2
+        for row in rows:
+            row_width = sum(aspects[i] * t for i in row)
+            x = left + (area_w - row_width) / 2
+            for i in row:
+                width = aspects[i] * t
+                scale = min(1.0, t * PACKING_FILL / max(1, pet_sizes[i][1]))
+                layouts[i] = PetLayout(f"pet_{i}", self._relative_anchor((x + width / 2, y)), scale)
+                x += width
+            y += t
+        return layouts
+
     def calculate_occupancy_rect(self, pet: PetLayout, pet_image_size: Tuple[int, int]) -> Tuple[float, float, float, float]:
         """
         计算宠物的占用矩形（基于缩放后的尺寸和锚点位置）
@@ -114,36 +379,110 @@ class MultiPetLayoutEngine:
             top1 >= bottom2
         )
 
+    def find_overlapping_pairs(self, rects: Sequence[Tuple[float, float, float, float]]) -> List[Tuple[int, int]]:
+        """
+        空间哈希：桶边长取最大矩形边长，每个矩形只落入至多 4 个桶，只比较同桶矩形（期望 O(n)）
+        返回矩形相交的 (i, j) 对，i < j，按 i、j 排序
+        """
+        if len(rects) < 2:
+            return []
+        bucket = max(max(r[2] - r[0], r[3] - r[1]) for r in rects)
+        if bucket <= 0:
+            return []
+        buckets: Dict[Tuple[int, int], List[int]] = {}
+        for index, (left, top, right, bottom) in enumerate(rects):
+            for bx in range(int(left // bucket), int(right // bucket) + 1):
+                for by in range(int(top // bucket), int(bottom // bucket) + 1):
+                    buckets.setdefault((bx, by), []).append(index)
+
+        pairs = set()
+        for members in buckets.values():
+            for a in range(len(members)):
+                for b in range(a + 1, len(members)):
+                    i, j = members[a], members[b]
+                    if self.check_overlap(rects[i], rects[j]):
+                        pairs.add((i, j) if i < j else (j, i))
+        return sorted(pairs)
+
+    def _collision_rect(self, layouts: List[PetLayout], index: int) -> Tuple[float, float, float, float]:
+        """重叠粗筛用的矩形：mask 模式取占用网格形状的实际包围盒（视觉中心对齐锚点）"""
+        if not self.uses_mask_collision:
+            return layouts[index].rect
+        shape = self.get_pet_shape(index, layouts[index].scale)
+        ys, xs = np.nonzero(shape.cells)
+        if ys.size == 0:
+            return (0.0, 0.0, 0.0, 0.0)
+        cell = self.grid.cell_size
+        ax, ay = self._anchor_px(layouts[index].anchor)
+        x0 = math.floor(ax / cell + shape.origin[0] + 0.5)
+        y0 = math.floor(ay / cell + shape.origin[1] + 0.5)
+        return ((x0 + xs.min()) * cell / self.template_width,
+                (y0 + ys.min()) * cell / self.template_height,
+                (x0 + xs.max() + 1) * cell / self.template_width,
+                (y0 + ys.max() + 1) * cell / self.template_height)
+
     def apply_anti_overlap_corrections(self, layouts: List[PetLayout],
                                       pet_sizes: List[Tuple[int, int]]) -> List[PetLayout]:
         """
         应用防遮挡修正
         优先级：横向拉开 → 纵向错位 → 缩小兜底
+        打包布局（5 只以上）按外接圆检测、只做缩小兜底，避免推挤破坏打包结构
+        圆形模板先投影进可用圆盘，之后只缩小：拉开会与径向内移来回抵消、让宠物互相靠近，
+        而缩小不会超出圆盘，修正后无需再次投影
         """
+        packed = len(layouts) > MAX_PRESET_PETS
+        circular = self.circle_region is not None
+        if circular:
+            layouts = self.apply_circle_constraints(layouts, pet_sizes)
         # 更新所有rect
         for i, layout in enumerate(layouts):
             layout.rect = self.calculate_occupancy_rect(layout, pet_sizes[i])
 
-        # 检测并修正重叠
-        max_iterations = 3
+        # 检测并修正重叠：空间哈希粗筛候选对，再逐对精确判断（mask 模式按 alpha 占用网格）
+        max_iterations = MAX_CIRCLE_SHRINK_ROUNDS if circular else 3
         for iteration in range(max_iterations):
-            has_overlap = False
-
-            # 检查所有宠物对的重叠
-            for i in range(len(layouts)):
-                for j in range(i + 1, len(layouts)):
-                    if self.check_overlap(layouts[i].rect, layouts[j].rect):
-                        has_overlap = True
-                        self._fix_overlap(layouts[i], layouts[j], pet_sizes[i], pet_sizes[j])
-                        # 重新计算受影响的rect
-                        layouts[i].rect = self.calculate_occupancy_rect(layouts[i], pet_sizes[i])
-                        layouts[j].rect = self.calculate_occupancy_rect(layouts[j], pet_sizes[j])
-
-            if not has_overlap:
+            if not self._correct_overlaps(layouts, pet_sizes, packed, shrink=packed or circular):
                 break
 
         return layouts
 
+    def _correct_overlaps(self, layouts: List[PetLayout], pet_sizes: List[Tuple[int, int]],
+                          packed: bool, shrink: bool) -> bool:
+        """修正一轮重叠（shrink=True 时只缩小，不移动）；有重叠时返回 True"""
+        has_overlap = False
+        candidates = self.find_overlapping_pairs(
+            [self._collision_rect(layouts, i) for i in range(len(layouts))]
+        )
+        for i, j in candidates:
+            if not self._layouts_overlap(layouts, pet_sizes, i, j, packed):
+                continue
+            has_overlap = True
+            if shrink:
+                self._shrink_overlap(layouts[i], layouts[j])
+            else:
+                self._fix_overlap(layouts[i], layouts[j], pet_sizes[i], pet_sizes[j])
+            # 重新计算受影响的rect
+            layouts[i].rect = self.calculate_occupancy_rect(layouts[i], pet_sizes[i])
+            layouts[j].rect = self.calculate_occupancy_rect(layouts[j], pet_sizes[j])
+        return has_overlap
+
+    def _layouts_overlap(self, layouts: List[PetLayout], pet_sizes: List[Tuple[int, int]],
+                         i: int, j: int, packed: bool = False) -> bool:
+        if self.uses_mask_collision:
+            return self.compute_mask_overlap(layouts, i, j) > 0
+        if packed:
+            # 打包布局以外接圆为单元：圆心距小于半径和才算重叠
+            (x1, y1), (x2, y2) = self._anchor_px(layouts[i].anchor), self._anchor_px(layouts[j].anchor)
+            r1 = max(pet_sizes[i]) * layouts[i].scale / 2
+            r2 = max(pet_sizes[j]) * layouts[j].scale / 2
+            return math.hypot(x2 - x1, y2 - y1) < (r1 + r2) * (1 - 1e-6)
+        return self.check_overlap(layouts[i].rect, layouts[j].rect)
+
+    def _shrink_overlap(self, layout1: PetLayout, layout2: PetLayout, factor: float = 0.9):
+        """缩小兜底：重叠的两只宠物同时缩小"""
+        layout1.scale *= factor
+        layout2.scale *= factor
+
     def _fix_overlap(self, layout1: PetLayout, layout2: PetLayout,
                     size1: Tuple[int, int], size2: Tuple[int, int]):
         """修正两个宠物的重叠"""
@@ -211,24 +550,37 @@ class MultiPetLayoutEngine:
         
         return auto_scale
 
-    def generate_layout(self, pet_count: int, pet_sizes: List[Tuple[int, int]]) -> List[PetLayout]:
-        """生成完整的布局配置"""
-        layouts = self.get_default_layouts(pet_count)
+    def generate_layout(self, pet_count: int, pet_sizes: List[Tuple[int, int]],
+                        pet_images: Optional[Sequence[PetImageLike]] = None) -> List[PetLayout]:
+        """生成完整的布局配置（传入 pet_images 时 mask 模式按 alpha 占用检测重叠）"""
+        if pet_images is not None:
+            self.set_pet_images(pet_images)
+        layouts = self.get_default_layouts(pet_count, pet_sizes)
         
-        # 根据实际图像尺寸自动调整缩放比例
-        for i, (layout, pet_size) in enumerate(zip(layouts, pet_sizes)):
-            auto_scale = self.calculate_auto_scale(pet_size, layout)
-            layout.scale = auto_scale
+        # 根据实际图像尺寸自动调整缩放比例（打包策略已按格子计算 scale）
+        if pet_count <= MAX_PRESET_PETS:
+            for i, (layout, pet_size) in enumerate(zip(layouts, pet_sizes)):
+                auto_scale = self.calculate_auto_scale(pet_size, layout)
+                layout.scale = auto_scale
         
+        # 圆形模板在修正循环内把外接圆约束进可用圆盘（极坐标）
         layouts = self.apply_anti_overlap_corrections(layouts, pet_sizes)
         return layouts
 
 
 def create_multi_pet_layout(template_size: Tuple[int, int],
                           pet_count: int,
-                          pet_sizes: List[Tuple[int, int]]) -> List[PetLayout]:
+                          pet_sizes: List[Tuple[int, int]],
+                          pet_images: Optional[Sequence[PetImageLike]] = None,
+                          collision_mode: str = "rect",
+                          circular: bool = False,
+                          circle_region: Optional[Tuple[Tuple[float, float], float]] = None) -> List[PetLayout]:
     """
     便捷函数：创建多宠物布局
+    collision_mode="mask" 且提供 pet_images 时，按 alpha 占用网格检测重叠；
+    circular=True 时 5 只以上使用同心环布局；提供 circle_region 时宠物外接圆约束在该圆盘内
     """
-    engine = MultiPetLayoutEngine(template_size[0], template_size[1])
-    return engine.generate_layout(pet_count, pet_sizes)
\ No newline at end of file
+    engine = MultiPetLayoutEngine(template_size[0], template_size[1],
+                                  collision_mode=collision_mode, circular=circular,
+                                  circle_region=circle_region)
+    return engine.generate_layout(pet_count, pet_sizes, pet_images)
\ No newline at end of file
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+宠物占用网格（alpha 感知的碰撞检测）
+布局引擎默认用 calculate_occupancy_rect 的轴对齐矩形判断重叠，圆润的宠物头部四角大多透明，
+矩形会高估重叠，导致过度拉开与缩小。占用网格模式：
+- 按粗粒度网格（长边 GRID_CELLS 格）对每只宠物的 alpha 做 BOX 下采样并二值化
+- 每行用 np.packbits 打包为位集，重叠检测 = 按位 AND + popcount，结果为重叠面积（模板像素²）
+- 候选位置批量评估：一次性把同一形状平移到 N 个锚点，向量化 AND/popcount，得到 N 个重叠面积
+坐标约定与合成一致：宠物视觉中心对齐锚点（见 utils.pet_transform.compute_layout_transform）。
+"""
+import math
+from dataclasses import dataclass
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.pet_cutout import PetImageLike, as_cutout
+
+# 网格长边格数（1000px 模板约 8px 一格）
+GRID_CELLS = 128
+# 粗网格格内平均 alpha 超过该值视为占用
+CELL_ALPHA_THRESHOLD = 32
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits: np.ndarray) -> np.ndarray:
+    """逐字节 popcount（uint8 数组），NumPy 2.0+ 使用 np.bitwise_count"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits)
+    return _POPCOUNT_TABLE[bits]
+
+
+@dataclass
+class PetShape:
+    """
+    宠物在网格上的粗粒度形状（与位置无关）
+    cells: bool (rows, cols)；origin: 形状左上角相对锚点的偏移（单位：格）
+    """
+    cells: np.ndarray
+    origin: Tuple[float, float]
+
+    @property
+    def cell_count(self) -> int:
+        return int(self.cells.sum())
+
+
+class OccupancyGrid:
+    """模板画布上的粗粒度占用网格，负责栅格化与位集重叠计算"""
+
+    def __init__(self, template_size: Tuple[int, int], cells: int = GRID_CELLS):
+        width, height = template_size
+        self.template_size = (width, height)
+        self.cell_size = max(width, height) / float(cells)
+        self.cols = max(1, math.ceil(width / self.cell_size))
+        self.rows = max(1, math.ceil(height / self.cell_size))
+        self.row_bytes = (self.cols + 7) // 8
+        # 每格对应的模板像素面积
+        self.cell_area = self.cell_size * self.cell_size
+
+    def rasterize_shape(self, pet: PetImageLike, scale: float,
+                        visual_center: Optional[Tuple[float, float]] = None) -> PetShape:
+        """
+        按布局 scale 将宠物 alpha 栅格化到网格分辨率
+
+        Args:
+            pet: 宠物 RGBA 或 PetCutout（只在裁剪区域上下采样）
+            scale: 布局 scale
+            visual_center: 原帧坐标系中的视觉中心；None 时现算
+        """
+        cutout = as_cutout(pet)
+        if visual_center is None:
+            visual_center = cutout.visual_center()
+        crop_w, crop_h = cutout.image.size
+        cols = max(1, math.ceil(crop_w * scale / self.cell_size))
+        rows = max(1, math.ceil(crop_h * scale / self.cell_size))
+        alpha = cutout.image.getchannel('A').resize((cols, rows), Image.Resampling.BOX)
+        cells = np.asarray(alpha) > CELL_ALPHA_THRESHOLD
+
+        # 裁剪图左上角在画布上相对锚点的位置（与 compute_layout_transform 的 +0.5 约定一致）
+        origin_x = (cutout.offset[0] - (visual_center[0] + 0.5)) * scale / self.cell_size
+        origin_y = (cutout.offset[1] - (visual_center[1] + 0.5)) * scale / self.cell_size
+        return PetShape(cells, (origin_x, origin_y))
+
+    def _cell_positions(self, shape: PetShape, anchors_px: np.ndarray) -> np.ndarray:
+        """锚点（模板像素，N x 2）-> 形状左上角所在格（N x 2，int）"""
+        anchors_cell = anchors_px / self.cell_size
+        return np.floor(anchors_cell + np.asarray(shape.origin) + 0.5).astype(np.int64)
+
+    def place_many(self, shape: PetShape, anchors_px: np.ndarray) -> np.ndarray:
+        """
+        将形状批量放到 N 个锚点，返回打包位集 (N, rows, row_bytes)；超出网格的格子被裁掉
+        """
+        anchors_px = np.asarray(anchors_px, dtype=np.float64).reshape(-1, 2)
+        count = anchors_px.shape[0]
+        grid = np.zeros((count, self.rows, self.cols), dtype=bool)
+        ys, xs = np.nonzero(shape.cells)
+        if count == 0 or ys.size == 0:
+            return np.packbits(grid, axis=2)
+
+        positions = self._cell_positions(shape, anchors_px)
+        gx = xs[None, :] + positions[:, 0:1]
+        gy = ys[None, :] + positions[:, 1:2]
+        inside = (gx >= 0) & (gx < self.cols) & (gy >= 0) & (gy < self.rows)
+        index = np.broadcast_to(np.arange(count)[:, None], gx.shape)
+        grid[index[inside], gy[inside], gx[inside]] = True
+        return np.packbits(grid, axis=2)
+
+    def place(self, shape: PetShape, anchor_px: Tuple[float, float]) -> np.ndarray:
+        """将形状放到单个锚点，返回打包位集 (rows, row_bytes)"""
+        return self.place_many(shape, np.array([anchor_px]))[0]
+
+    def empty(self) -> np.ndarray:
+        return np.zeros((self.rows, self.row_bytes), dtype=np.uint8)
+
+    def union(self, bitsets: Iterable[np.ndarray]) -> np.ndarray:
+        occupied = self.empty()
+        for bits in bitsets:
+            occupied |= bits
+        return occupied
+
+    def overlap_area(self, bits1: np.ndarray, bits2: np.ndarray) -> float:
+        """两个位集的重叠面积（模板像素²）"""
+        return float(popcount(bits1 & bits2).sum(dtype=np.int64)) * self.cell_area
+
+    def overlap_areas(self, shape: PetShape, anchors_px: np.ndarray,
+                      occupied: np.ndarray) -> np.ndarray:
+        """
+        批量评估候选锚点：形状放在每个锚点时与 occupied 的重叠面积（模板像素²，长度 N）
+        """
+        placed = self.place_many(shape, anchors_px)
+        counts = popcount(placed & occupied[None]).sum(axis=(1, 2), dtype=np.int64)
+        return counts.astype(np.float64) * self.cell_area
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+逐宠物并行执行
+解码 PNG、NumPy、OpenCV 与 PIL 的滤镜 / 缩放都会释放 GIL，逐宠物的解码、校验、边缘处理
+放进有界线程池即可多核并行。结果按输入顺序返回，与串行执行一致。
+"""
+import os
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# 线程数上限（宠物数量通常 <= 8，再多也只是排队）
+MAX_WORKERS = 8
+
+
+def resolve_workers(count: int, max_workers: Optional[int] = None) -> int:
+    """实际线程数：不超过任务数、CPU 数与 MAX_WORKERS；max_workers 显式指定时以其为上限"""
+    limit = max_workers if max_workers is not None else min(MAX_WORKERS, os.cpu_count() or 1)
+    return max(1, min(count, limit))
+
+
+def parallel_map(fn: Callable[[T], R], items: Sequence[T],
+                 max_workers: Optional[int] = None) -> List[R]:
+    """
+    有界线程池版 map，结果按 items 顺序返回
+
+    只有一个任务或 max_workers=1 时直接串行执行（不创建线程池）。
+    任一任务抛出异常后不再启动排队中的任务（已在运行的任务无法中断，等其结束），
+    再按输入顺序抛出第一个异常（与串行执行一致）。
+    """
+    items = list(items)
+    workers = resolve_workers(len(items), max_workers)
+    if workers == 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, item) for item in items]
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        if any(future.exception() is not None for future in done):
+            for future in futures:
+                future.cancel()
+    for future in futures:
+        if not future.cancelled() and future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+裁剪到内容的宠物抠图表示（PetCutout）
+make_square_1to1 输出的正方形抠图中，透明补边往往占一半以上像素。
+PetCutout 只保存 alpha 边界框（外扩少量边距）内的像素，另记录其在原帧中的偏移与原帧尺寸：
+- 边缘净化 / 羽化 / 描边、视觉面积、视觉中心、重采样都只处理可见主体
+- 需要原帧坐标的地方（布局尺寸、视觉中心、合成变换）通过 offset 换算，结果与原帧一致
+"""
+from dataclasses import dataclass
+from typing import Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from utils.pet_transform import PetTransform
+from utils.visual_center import compute_visual_center
+
+# 裁剪外扩边距：羽化（GaussianBlur radius=1.5）会向外扩散 alpha，保留透明边距保证结果与原帧一致
+CROP_MARGIN = 6
+
+
+@dataclass
+class PetCutout:
+    """宠物抠图的紧凑表示：image 为裁剪后的 RGBA，offset 为其左上角在原帧中的位置"""
+    image: Image.Image
+    offset: Tuple[int, int]
+    frame_size: Tuple[int, int]
+
+    @classmethod
+    def from_image(cls, image: Image.Image, margin: int = CROP_MARGIN) -> "PetCutout":
+        """按 alpha 边界框裁剪；完全透明时保留 1x1 透明像素"""
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        width, height = image.size
+        bbox = image.getchannel('A').getbbox()
+        if bbox is None:
+            return cls(Image.new('RGBA', (1, 1), (0, 0, 0, 0)), (0, 0), (width, height))
+        left = max(0, bbox[0] - margin)
+        top = max(0, bbox[1] - margin)
+        right = min(width, bbox[2] + margin)
+        bottom = min(height, bbox[3] + margin)
+        if (left, top, right, bottom) == (0, 0, width, height):
+            return cls(image, (0, 0), (width, height))
+        return cls(image.crop((left, top, right, bottom)), (left, top), (width, height))
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """原帧尺寸（布局、校验长宽比使用）"""
+        return self.frame_size
+
+    @property
+    def width(self) -> int:
+        return self.frame_size[0]
+
+    @property
+    def height(self) -> int:
+        return self.frame_size[1]
+
+    @property
+    def frame_area(self) -> int:
+        return self.frame_size[0] * self.frame_size[1]
+
+    def frame_transform(self) -> PetTransform:
+        """裁剪图坐标 -> 原帧坐标"""
+        return PetTransform.translation(self.offset[0], self.offset[1])
+
+    def visual_center(self) -> Tuple[float, float]:
+        """原帧坐标系中的视觉中心（只在裁剪区域上计算）"""
+        cx, cy = compute_visual_center(self.image)
+        return (float(cx) + self.offset[0], float(cy) + self.offset[1])
+
+    def alpha_array(self) -> np.ndarray:
+        """裁剪区域的 alpha（uint8）"""
+        return np.array(self.image.getchannel('A'))
+
+    def with_image(self, image: Image.Image) -> "PetCutout":
+        """替换像素（如边缘处理后），保持偏移与原帧尺寸"""
+        return PetCutout(image, self.offset, self.frame_size)
+
+    def to_image(self) -> Image.Image:
+        """还原为原帧大小的 RGBA（仅在需要落盘或兼容旧接口时使用）"""
+        frame = Image.new('RGBA', self.frame_size, (0, 0, 0, 0))
+        frame.paste(self.image, self.offset)
+        return frame
+
+
+PetImageLike = Union[Image.Image, PetCutout]
+
+
+def as_cutout(pet: PetImageLike, crop: bool = True) -> PetCutout:
+    """
+    统一为 PetCutout：已是 PetCutout 原样返回；
+    Image 在 crop=True 时裁剪到内容，否则整帧包装（不复制像素）
+    """
+    if isinstance(pet, PetCutout):
+        return pet
+    if crop:
+        return PetCutout.from_image(pet)
+    if pet.mode != 'RGBA':
+        pet = pet.convert('RGBA')
+    return PetCutout(pet, (0, 0), pet.size)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+宠物图层的累计仿射变换
+从抠图原图到最终画布只记录「等比缩放 + 平移」的累计变换（补正方形、缩放、锚点偏移），
+中间步骤只变换坐标、不重采样像素，最终由合成器按累计变换做唯一一次高质量重采样。
+"""
+import math
+from dataclasses import dataclass
+from typing import Tuple
+
+
+@dataclass(frozen=True)
+class PetTransform:
+    """源图像素坐标 -> 目标像素坐标：x' = scale * x + tx，y' = scale * y + ty"""
+    scale: float = 1.0
+    tx: float = 0.0
+    ty: float = 0.0
+
+    @classmethod
+    def translation(cls, dx: float, dy: float) -> "PetTransform":
+        return cls(1.0, float(dx), float(dy))
+
+    @classmethod
+    def scaling(cls, scale: float) -> "PetTransform":
+        return cls(float(scale), 0.0, 0.0)
+
+    @property
+    def offset(self) -> Tuple[float, float]:
+        """源图原点 (0, 0) 在目标坐标系中的位置"""
+        return (self.tx, self.ty)
+
+    def then(self, other: "PetTransform") -> "PetTransform":
+        """先应用 self，再应用 other"""
+        return PetTransform(
+            self.scale * other.scale,
+            self.tx * other.scale + other.tx,
+            self.ty * other.scale + other.ty,
+        )
+
+    def then_translate(self, dx: float, dy: float) -> "PetTransform":
+        return PetTransform(self.scale, self.tx + dx, self.ty + dy)
+
+    def then_scale(self, scale: float) -> "PetTransform":
+        return PetTransform(self.scale * scale, self.tx * scale, self.ty * scale)
+
+    def inverse(self) -> "PetTransform":
+        if self.scale == 0:
+            raise ValueError("scale 为 0 的变换不可逆")
+        return PetTransform(1.0 / self.scale, -self.tx / self.scale, -self.ty / self.scale)
+
+    def map_point(self, point: Tuple[float, float]) -> Tuple[float, float]:
+        return (self.scale * point[0] + self.tx, self.scale * point[1] + self.ty)
+
+    def map_size(self, size: Tuple[float, float]) -> Tuple[float, float]:
+        return (size[0] * self.scale, size[1] * self.scale)
+
+
+def compute_square_padding(image_size: Tuple[int, int],
+                           bbox: Tuple[int, int, int, int],
+                           visual_center: Tuple[float, float]) -> Tuple[int, PetTransform]:
+    """
+    补正方形（1:1）：以非透明区域最大边为边长，使视觉中心对齐正方形中心。
+    补边只是整数平移（无重采样），返回 (正方形边长, 原图 -> 正方形 的平移变换)。
+
+    Args:
+        image_size: 原图尺寸 (width, height)
+        bbox: 非透明区域 (left, top, right, bottom)，right/bottom 不含
+        visual_center: 原图坐标系中的视觉中心
+    """
+    width, height = image_size
+    left, top, right, bottom = bbox
+    square_size = max(right - left, bottom - top)
+
+    # 视觉中心是像素索引坐标，正方形中心索引为 (square_size - 1) / 2；
+    # 四舍五入而非 int() 向零截断，避免负偏移时多裁掉一列/行边缘
+    square_center = (square_size - 1) / 2
+    paste_x = math.floor(square_center - visual_center[0] + 0.5)
+    paste_y = math.floor(square_center - visual_center[1] + 0.5)
+
+    # 允许部分超出，但至少有一部分在画布内
+    if paste_x + width < 0:
+        paste_x = -width + 10
+    if paste_x > square_size:
+        paste_x = int(square_size - 10)
+    if paste_y + height < 0:
+        paste_y = -height + 10
+    if paste_y > square_size:
+        paste_y = int(square_size - 10)
+
+    return square_size, PetTransform.translation(paste_x, paste_y)
+
+
+def compute_layout_transform(visual_center: Tuple[float, float],
+                             frame_size: Tuple[float, float],
+                             scale: float,
+                             anchor: Tuple[float, float],
+                             template_size: Tuple[int, int]) -> PetTransform:
+    """
+    宠物帧 -> 模板画布 的变换：按 scale 缩放，视觉中心对齐锚点（亚像素，不截断）。
+    完全超出画布时拉回至至少露出 10 像素（与旧 paste 逻辑一致）。
+
+    Args:
+        visual_center: 宠物帧坐标系中的视觉中心
+        frame_size: 宠物帧尺寸（未缩放）
+        scale: 布局 scale
+        anchor: 相对锚点 (0-1)
+        template_size: 模板尺寸
+    """
+    template_width, template_height = template_size
+    scaled_width, scaled_height = frame_size[0] * scale, frame_size[1] * scale
+    # 视觉中心是像素索引坐标，像素 i 覆盖 [i, i+1)，其连续坐标为 i + 0.5
+    offset_x = anchor[0] * template_width - (visual_center[0] + 0.5) * scale
+    offset_y = anchor[1] * template_height - (visual_center[1] + 0.5) * scale
+
+    if offset_x + scaled_width < 0:
+        offset_x = -scaled_width + 10
+    if offset_x > template_width:
+        offset_x = template_width - 10
+    if offset_y + scaled_height < 0:
+        offset_y = -scaled_height + 10
+    if offset_y > template_height:
+        offset_y = template_height - 10
+    return PetTransform(scale, offset_x, offset_y)
+
+
+def compute_centered_transform(frame_size: Tuple[float, float],
+                               scale: float,
+                               anchor_px: Tuple[float, float]) -> PetTransform:
+    """宠物帧 -> 模板画布 的变换：按 scale 缩放，帧几何中心落在 anchor_px"""
+    return PetTransform(
+        scale,
+        anchor_px[0] - frame_size[0] * scale / 2,
+        anchor_px[1] - frame_size[1] * scale / 2,
+    )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+圆形模板的极坐标布局约束
+圆形模板的可用区域是一个圆盘（圆形内、文字环以内，见 TemplateDescriptor.pet_area_radius）。
+每只宠物用「外接圆」表示：以视觉中心（对齐锚点）为圆心、到最远可见像素的距离为半径，
+与旋转无关。约束在以模板圆心为原点的极坐标下检查：ρ + r ≤ R。
+- 检查与投影均对 N 只宠物向量化
+- 投影：外接圆本身放不下时按 R / r 缩小，其余只沿径向内移，角度 θ 不变
+取代矩形 anchor 范围（CIRCLE_ANCHOR_X/Y_LIMITS）与一刀切的 0.85 缩放。
+"""
+from typing import Tuple
+
+import numpy as np
+
+from utils.pet_cutout import PetImageLike, as_cutout
+
+# 外接圆统计的 alpha 阈值（与 compute_visual_area 一致，忽略半透明毛边）
+BOUNDING_ALPHA_THRESHOLD = 20
+
+
+def compute_bounding_radius(pet: PetImageLike, alpha_threshold: int = BOUNDING_ALPHA_THRESHOLD) -> float:
+    """宠物外接圆半径（原帧像素，scale=1）：视觉中心到最远可见像素角点的距离"""
+    cutout = as_cutout(pet)
+    ys, xs = np.nonzero(cutout.alpha_array() > alpha_threshold)
+    if ys.size == 0:
+        return 0.0
+    cx, cy = cutout.visual_center()
+    # 像素 i 覆盖 [i, i+1)，视觉中心连续坐标为 i + 0.5；取像素外侧角点
+    dx = np.maximum(np.abs(xs + cutout.offset[0] - (cx + 0.5)), np.abs(xs + cutout.offset[0] + 1 - (cx + 0.5)))
+    dy = np.maximum(np.abs(ys + cutout.offset[1] - (cy + 0.5)), np.abs(ys + cutout.offset[1] + 1 - (cy + 0.5)))
+    return float(np.sqrt((dx.astype(np.float64) ** 2 + dy.astype(np.float64) ** 2).max()))
+
+
+def to_polar(points: np.ndarray, center: Tuple[float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """(N, 2) 像素坐标 -> (ρ, θ)"""
+    delta = np.asarray(points, dtype=np.float64) - np.asarray(center, dtype=np.float64)
+    return np.hypot(delta[:, 0], delta[:, 1]), np.arctan2(delta[:, 1], delta[:, 0])
+
+
+def polar_overshoot(points: np.ndarray, radii: np.ndarray,
+                    center: Tuple[float, float], limit_radius: float) -> np.ndarray:
+    """每只宠物外接圆超出可用圆盘的距离（像素，未超出为 0）"""
+    rho, _ = to_polar(points, center)
+    return np.maximum(0.0, rho + np.asarray(radii, dtype=np.float64) - limit_radius)
+
+
+def project_into_circle(points: np.ndarray, radii: np.ndarray,
+                        center: Tuple[float, float], limit_radius: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    将外接圆投影进可用圆盘
+
+    Returns:
+        (新圆心 (N, 2) 像素坐标, 缩放系数 (N,)，放得下的宠物为 1.0)
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    rho, theta = to_polar(points, center)
+    shrink = np.where(radii > limit_radius, limit_radius / np.maximum(radii, 1e-9), 1.0)
+    rho = np.minimum(rho, np.maximum(0.0, limit_radius - radii * shrink))
+    projected = np.stack([center[0] + rho * np.cos(theta), center[1] + rho * np.sin(theta)], axis=1)
+    return projected, shrink
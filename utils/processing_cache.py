@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+抠图校验 / 边缘处理结果缓存
+布局调整、对齐、换字体等重合成只改布局或文字，*_extracted.png 不变，却每次重跑
+validate_pet_matting 与 process_pet_image_for_display。本缓存按「抠图内容哈希 + 处理参数」保存：
+- 校验结果（ValidationResult，JSON）
+- 边缘处理后的裁剪 RGBA（PNG）及其在原帧中的偏移
+存放在会话目录下（sessions/<session_id>/processing_cache/），抠图重做后内容哈希变化自然失效。
+"""
+import dataclasses
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from utils.matting_validation import ValidationResult
+from utils.pet_cutout import PetCutout, PetImageLike, as_cutout
+
+# 缓存格式版本：校验阈值或边缘处理算法变化时递增，使旧缓存失效
+PROCESSING_CACHE_VERSION = 1
+PROCESSING_CACHE_DIRNAME = "processing_cache"
+
+
+def compute_content_hash(pet: PetImageLike) -> str:
+    """抠图内容哈希（sha1）：裁剪区域像素 + 在原帧中的偏移与原帧尺寸"""
+    cutout = as_cutout(pet)
+    image = cutout.image if cutout.image.mode == 'RGBA' else cutout.image.convert('RGBA')
+    digest = hashlib.sha1()
+    digest.update(json.dumps([image.size, list(cutout.offset), list(cutout.frame_size)]).encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ProcessingCache:
+    """会话目录下的校验 / 边缘处理结果缓存（文件名即缓存键，多线程安全）"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 同一图像对象只哈希一次（校验与边缘处理共用）：id -> (图像, 哈希)
+        self._hashes: Dict[int, Any] = {}
+
+    @classmethod
+    def for_session(cls, session_id: str, sessions_dir: str = "sessions") -> "ProcessingCache":
+        return cls(os.path.join(sessions_dir, session_id, PROCESSING_CACHE_DIRNAME))
+
+    def content_hash(self, pet: PetImageLike) -> str:
+        image = as_cutout(pet).image
+        with self._lock:
+            entry = self._hashes.get(id(image))
+            if entry is not None and entry[0] is image:
+                return entry[1]
+        value = compute_content_hash(pet)
+        with self._lock:
+            self._hashes[id(image)] = (image, value)
+        return value
+
+    def _key(self, kind: str, pet: PetImageLike, params: Dict[str, Any]) -> str:
+        payload = json.dumps(
+            {"version": PROCESSING_CACHE_VERSION, "kind": kind, "content": self.content_hash(pet),
+             "params": params},
+            sort_keys=True,
+        )
+        return f"{kind}_{hashlib.sha1(payload.encode('utf-8')).hexdigest()}"
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    # ---------- 校验结果 ----------
+
+    def get_validation(self, pet: PetImageLike, pet_id: str,
+                       params: Dict[str, Any]) -> Optional[ValidationResult]:
+        """命中时返回校验结果（pet_id 替换为当前宠物）"""
+        path = os.path.join(self.cache_dir, self._key("validation", pet, params) + ".json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            result = dataclasses.replace(ValidationResult(**data), pet_id=pet_id)
+        except (OSError, ValueError, TypeError):
+            self._count(False)
+            return None
+        self._count(True)
+        return result
+
+    def put_validation(self, pet: PetImageLike, params: Dict[str, Any], result: ValidationResult):
+        data = dataclasses.asdict(result)
+        for name in ("alpha_ratio", "largest_component_ratio", "aspect_ratio"):
+            data[name] = float(data[name])
+        path = os.path.join(self.cache_dir, self._key("validation", pet, params) + ".json")
+        self._write(path, lambda tmp: _dump_json(tmp, data))
+
+    # ---------- 边缘处理结果 ----------
+
+    def get_processed(self, pet: PetImageLike, params: Dict[str, Any]) -> Optional[PetCutout]:
+        """命中时返回边缘处理后的 PetCutout"""
+        base = os.path.join(self.cache_dir, self._key("processed", pet, params))
+        try:
+            with open(base + ".json", 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with Image.open(base + ".png") as image:
+                image.load()
+                processed = PetCutout(image.convert('RGBA'), tuple(meta["offset"]), tuple(meta["frame_size"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            self._count(False)
+            return None
+        self._count(True)
+        return processed
+
+    def put_processed(self, pet: PetImageLike, params: Dict[str, Any], processed: PetImageLike):
+        cutout = as_cutout(processed)
+        base = os.path.join(self.cache_dir, self._key("processed", pet, params))
+        # 先写像素再写元数据：元数据存在即视为完整条目
+        if self._write(base + ".png", lambda tmp: cutout.image.save(tmp, "PNG")):
+            meta = {"offset": list(cutout.offset), "frame_size": list(cutout.frame_size)}
+            self._write(base + ".json", lambda tmp: _dump_json(tmp, meta))
+
+    def _write(self, path: str, writer) -> bool:
+        """原子写入（临时文件 + os.replace）；目录只读等情况下放弃缓存"""
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            writer(tmp_path)
+            os.replace(tmp_path, path)
+            return True
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+
+def _dump_json(path: str, data: Dict[str, Any]):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
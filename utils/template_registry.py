@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+模板描述缓存（Template Registry）
+模板的尺寸、是否圆形、alpha 边界框、视觉中心、解码后的 RGBA 缓冲只计算一次：
+- 内存缓存：按「绝对路径 + mtime」为键，模板文件被修改后自动失效
+- sidecar 持久化：元数据写入 <模板>.descriptor.json，下个会话无需再解码整张 PNG 判断圆形
+RGBA 缓冲不落盘，首次合成时懒加载并常驻内存。
+"""
+import json
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from utils.visual_center import compute_visual_center
+
+# sidecar 格式版本：检测规则变化时递增，使旧 sidecar 失效
+DESCRIPTOR_VERSION = 2
+SIDECAR_SUFFIX = ".descriptor.json"
+
+# 圆形模板环形文字区（与 circle_text_skill 清新粉蓝预设一致：半径 = 短边 40%，字号 = 短边 8%）
+TEXT_RING_RADIUS_RATIO = 0.40
+TEXT_RING_FONT_RATIO = 0.08
+# 字符以环半径为中心绘制，半宽取字号的 0.6（含字形上下留白）
+TEXT_RING_HALF_WIDTH = 0.6
+
+
+@dataclass
+class TemplateDescriptor:
+    """单个模板的描述信息"""
+    path: str
+    mtime_ns: int
+    width: int
+    height: int
+    is_circular: bool
+    alpha_bbox: Optional[Tuple[int, int, int, int]]  # (left, top, right, bottom)，全透明时为 None
+    visual_center: Tuple[float, float]  # alpha 加权质心（像素坐标）
+    # 圆形模板几何（非圆形为 None）：圆心、半径、环形文字区 (内半径, 外半径)，均为像素
+    circle_center: Optional[Tuple[float, float]] = None
+    circle_radius: Optional[float] = None
+    text_annulus: Optional[Tuple[float, float]] = None
+    rgba: Optional[np.ndarray] = field(default=None, repr=False, compare=False)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return (self.width, self.height)
+
+    @property
+    def pet_area_radius(self) -> Optional[float]:
+        """宠物可用圆盘半径：圆形内且不进入文字环"""
+        if self.circle_radius is None:
+            return None
+        if self.text_annulus is None:
+            return self.circle_radius
+        return min(self.circle_radius, self.text_annulus[0])
+
+    @property
+    def pet_circle_region(self) -> Optional[Tuple[Tuple[float, float], float]]:
+        """(圆心, 宠物可用半径)，供布局引擎做极坐标约束；非圆形模板为 None"""
+        if self.circle_center is None or self.circle_radius is None:
+            return None
+        return (self.circle_center, self.pet_area_radius)
+
+    def get_rgba(self) -> np.ndarray:
+        """解码后的 RGBA 缓冲（只读，H x W x 4 uint8）；首次调用时解码"""
+        if self.rgba is None:
+            with Image.open(self.path) as template:
+                data = np.array(template.convert("RGBA"))
+            data.setflags(write=False)
+            self.rgba = data
+        return self.rgba
+
+    def to_image(self) -> Image.Image:
+        """返回模板的 RGBA 副本（可自由修改，不影响缓存）"""
+        return Image.fromarray(self.get_rgba().copy(), "RGBA")
+
+    def to_dict(self) -> Dict:
+        return {
+            "version": DESCRIPTOR_VERSION,
+            "mtime_ns": self.mtime_ns,
+            "width": self.width,
+            "height": self.height,
+            "is_circular": self.is_circular,
+            "alpha_bbox": list(self.alpha_bbox) if self.alpha_bbox else None,
+            "visual_center": list(self.visual_center),
+            "circle_center": list(self.circle_center) if self.circle_center else None,
+            "circle_radius": self.circle_radius,
+            "text_annulus": list(self.text_annulus) if self.text_annulus else None,
+        }
+
+    @classmethod
+    def from_dict(cls, path: str, data: Dict) -> "TemplateDescriptor":
+        bbox = data.get("alpha_bbox")
+        circle_center = data.get("circle_center")
+        text_annulus = data.get("text_annulus")
+        return cls(
+            path=path,
+            mtime_ns=int(data["mtime_ns"]),
+            width=int(data["width"]),
+            height=int(data["height"]),
+            is_circular=bool(data["is_circular"]),
+            alpha_bbox=tuple(bbox) if bbox else None,
+            visual_center=tuple(data["visual_center"]),
+            circle_center=tuple(circle_center) if circle_center else None,
+            circle_radius=data.get("circle_radius"),
+            text_annulus=tuple(text_annulus) if text_annulus else None,
+        )
+
+
+def _detect_circular(alpha: np.ndarray, template_path: str) -> bool:
+    """
+    检测模板是否为圆形或强裁切形状：
+    中心区域不透明、边缘区域透明；或文件名命中圆形模板关键词。
+    """
+    h, w = alpha.shape
+    center_h, center_w = h // 2, w // 2
+    center_region = alpha[center_h-h//4:center_h+h//4, center_w-w//4:center_w+w//4]
+    center_opacity = np.sum(center_region > 128) / center_region.size
+
+    edge_mask = np.zeros_like(alpha, dtype=bool)
+    edge_mask[:h//8, :] = True  # 上边缘
+    edge_mask[-h//8:, :] = True  # 下边缘
+    edge_mask[:, :w//8] = True  # 左边缘
+    edge_mask[:, -w//8:] = True  # 右边缘
+    edge_opacity = np.sum(alpha[edge_mask] > 128) / np.sum(edge_mask)
+
+    is_circular = center_opacity > 0.7 and edge_opacity < 0.3
+
+    # 或者检查文件名（含中文模板名）
+    filename = os.path.basename(template_path).lower()
+    if 'circle' in filename or 'circular' in filename or 'round' in filename:
+        is_circular = True
+    # 清新粉蓝等圆形背景模板
+    if '清新粉蓝' in template_path or 'qingxin' in template_path or 'fenlan' in template_path:
+        is_circular = True
+    return bool(is_circular)
+
+
+def _detect_circle_geometry(alpha: np.ndarray) -> Tuple[Tuple[float, float], float, Tuple[float, float]]:
+    """
+    圆形模板的圆心、半径与环形文字区：
+    圆盘取不透明区域（alpha > 128）的边界框；整幅不透明（按文件名识别的圆形背景）时取画布内切圆。
+    """
+    h, w = alpha.shape
+    rows = np.flatnonzero((alpha > 128).any(axis=1))
+    cols = np.flatnonzero((alpha > 128).any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        left, top, right, bottom = 0, 0, w, h
+    else:
+        left, top, right, bottom = cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+    center = (float(left + right) / 2.0, float(top + bottom) / 2.0)
+    radius = float(min(right - left, bottom - top)) / 2.0
+
+    min_dim = min(w, h)
+    text_radius = TEXT_RING_RADIUS_RATIO * min_dim
+    half_width = TEXT_RING_HALF_WIDTH * TEXT_RING_FONT_RATIO * min_dim
+    return center, radius, (text_radius - half_width, text_radius + half_width)
+
+
+def build_template_descriptor(template_path: str, mtime_ns: int) -> TemplateDescriptor:
+    """解码模板并计算完整描述（冷启动路径）"""
+    with Image.open(template_path) as template:
+        rgba_image = template.convert("RGBA")
+    rgba = np.array(rgba_image)
+    rgba.setflags(write=False)
+    alpha = rgba[:, :, 3]
+
+    bbox = rgba_image.getchannel("A").getbbox()
+    visual_center = compute_visual_center(rgba_image)
+    is_circular = _detect_circular(alpha, template_path)
+    circle_center, circle_radius, text_annulus = (
+        _detect_circle_geometry(alpha) if is_circular else (None, None, None)
+    )
+
+    return TemplateDescriptor(
+        path=template_path,
+        mtime_ns=mtime_ns,
+        width=rgba_image.width,
+        height=rgba_image.height,
+        is_circular=is_circular,
+        alpha_bbox=tuple(int(v) for v in bbox) if bbox else None,
+        visual_center=(float(visual_center[0]), float(visual_center[1])),
+        circle_center=circle_center,
+        circle_radius=circle_radius,
+        text_annulus=text_annulus,
+        rgba=rgba,
+    )
+
+
+class TemplateRegistry:
+    """模板描述注册表：内存缓存 + sidecar 持久化"""
+
+    def __init__(self, use_sidecar: bool = True):
+        self.use_sidecar = use_sidecar
+        self._cache: Dict[Tuple[str, int], TemplateDescriptor] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sidecar_path(template_path: str) -> str:
+        return template_path + SIDECAR_SUFFIX
+
+    def get(self, template_path: str) -> TemplateDescriptor:
+        """获取模板描述；模板不存在时抛 FileNotFoundError"""
+        path = os.path.abspath(template_path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        key = (path, mtime_ns)
+
+        with self._lock:
+            descriptor = self._cache.get(key)
+        if descriptor is not None:
+            return descriptor
+
+        descriptor = self._load_sidecar(path, mtime_ns)
+        if descriptor is None:
+            descriptor = build_template_descriptor(path, mtime_ns)
+            self._save_sidecar(descriptor)
+
+        with self._lock:
+            # 同一路径的旧 mtime 条目一并清理
+            for stale in [k for k in self._cache if k[0] == path]:
+                del self._cache[stale]
+            self._cache[key] = descriptor
+        return descriptor
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _load_sidecar(self, path: str, mtime_ns: int) -> Optional[TemplateDescriptor]:
+        if not self.use_sidecar:
+            return None
+        sidecar = self.sidecar_path(path)
+        if not os.path.isfile(sidecar):
+            return None
+        try:
+            with open(sidecar, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") != DESCRIPTOR_VERSION or int(data.get("mtime_ns", -1)) != mtime_ns:
+                return None
+            return TemplateDescriptor.from_dict(path, data)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _save_sidecar(self, descriptor: TemplateDescriptor):
+        if not self.use_sidecar:
+            return
+        sidecar = self.sidecar_path(descriptor.path)
+        tmp_path = f"{sidecar}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(descriptor.to_dict(), f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, sidecar)
+        except OSError:
+            # 模板目录只读等情况：仅保留内存缓存
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+_default_registry = TemplateRegistry()
+
+
+def get_template_registry() -> TemplateRegistry:
+    """进程内共享的默认注册表"""
+    return _default_registry
+
+
+def get_template_descriptor(template_path: str) -> TemplateDescriptor:
+    """便捷函数：从默认注册表获取模板描述"""
+    return _default_registry.get(template_path)